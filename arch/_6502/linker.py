@@ -17,7 +17,7 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import os, sys
+import os, re, sys
 import UEFfile
 
 def system(command):
@@ -81,6 +81,130 @@ def write_routines(f, routines, names):
             elif name in names:
                 f.write("".join(routine))
 
+def routine_name(routine):
+
+    line = routine[0]
+    if ":" in line and not line.startswith(";"):
+        return line[:line.find(":")]
+    else:
+        return None
+
+def routine_labels(routine):
+
+    # Return the labels defined inside the routine.
+    labels = []
+    for line in routine[1:]:
+        l = line.split(";")[0]
+        if ":" in l:
+            labels.append(l[:l.find(":")].strip())
+    
+    return labels
+
+def routine_instructions(routine):
+
+    # Return a list of the mnemonics and operands of the instructions in the
+    # routine.
+    instructions = []
+    for line in routine[1:]:
+        l = line.split(";")[0]
+        if ":" in l:
+            l = l[l.find(":") + 1:]
+        words = l.split()
+        if words and not words[0].startswith("."):
+            instructions.append((words[0].lower(), " ".join(words[1:])))
+    
+    return instructions
+
+branch_mnemonics = ("bcc", "bcs", "beq", "bmi", "bne", "bpl", "bvc", "bvs")
+
+def can_fuse(routine):
+
+    # Return whether a copy of the routine can be used in a superinstruction.
+    # It must only branch to labels inside itself, leave by jumping to the
+    # next instruction and not run on into the following routine.
+    labels = routine_labels(routine)
+    instructions = routine_instructions(routine)
+    
+    for mnemonic, operand in instructions:
+        if mnemonic in branch_mnemonics and operand not in labels:
+            return False
+        elif mnemonic == "jmp" and operand not in labels and \
+             operand != "next_instruction" and not operand.startswith("("):
+            return False
+        elif mnemonic == "rts":
+            return False
+    
+    return instructions != [] and instructions[-1][0] in ("jmp", "brk")
+
+def fusible_routines():
+
+    """Returns the names of the routines for opcodes that can be used in
+    superinstructions."""
+    
+    routines = read_routines(open("arch/_6502/routines.oph").readlines())
+    
+    names = []
+    for routine in routines:
+        name = routine_name(routine)
+        if name and not name.startswith("_") and can_fuse(routine):
+            names.append(name)
+    
+    return names
+
+def fuse_routines(name, parts):
+
+    # Return the lines of a routine with the given name that performs the
+    # routines given in turn. Each routine is copied with its labels renamed,
+    # and all but the last continue with the next routine instead of the next
+    # instruction.
+    lines = [name + ":\n"]
+    
+    i = 0
+    for routine in parts:
+    
+        prefix = "%s_%i_" % (name, i)
+        labels = routine_labels(routine)
+        body = []
+        for line in routine[1:]:
+            for label in labels:
+                line = re.sub(r"\b%s\b" % label, prefix + label, line)
+            body.append(line)
+        
+        if i < len(parts) - 1:
+        
+            next_label = "%s_%i" % (name, i + 1)
+            
+            # Fall through to the next routine instead of jumping to it at
+            # the end of this one.
+            j = len(body) - 1
+            while j >= 0 and not body[j].split(";")[0].strip():
+                j -= 1
+            if re.match(r"\s*jmp\s+next_instruction\b", body[j]):
+                del body[j]
+            
+            for j in range(len(body)):
+                body[j] = re.sub(r"\bjmp\s+next_instruction\b",
+                                 "jmp " + next_label, body[j])
+            
+            # Leave the registers as the dispatch code leaves them.
+            body.append("    %s:\n" % next_label)
+            body.append("    ldy #0\n")
+            body.append("    clc\n")
+        
+        lines += body
+        i += 1
+    
+    return lines
+
+def write_fused_routines(f, routines, fused_routines):
+
+    named = {}
+    for routine in routines:
+        named[routine_name(routine)] = routine
+    
+    for name, parts in fused_routines.items():
+        f.write("".join(fuse_routines(name, map(lambda part: named[part], parts))))
+
 def write_lookup_tables(f, names):
 
     f.write("\nlookup_low:\n")
@@ -119,7 +243,7 @@ def save_opcodes_oph(file_name_or_obj, program_address, start_address,
         f.close()
 
 def link(program_opcodes, program_address, start_address, routines_used,
-         manifest_file, output_file, version):
+         manifest_file, output_file, version, fused_routines = None):
 
     # Write the program file, including only the required routines from the
     # routines.oph file.
@@ -135,6 +259,8 @@ def link(program_opcodes, program_address, start_address, routines_used,
     
     # Write the routines corresponding to the opcodes and lookup tables for them.
     write_routines(f, routines, routines_used)
+    if fused_routines:
+        write_fused_routines(f, routines, fused_routines)
     write_lookup_tables(f, routines_used)
     
     f.write("\n_stack:\n")
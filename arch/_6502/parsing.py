@@ -1,4 +1,4 @@
-import compiler, generator, opcodes, tokeniser
+import opcodes, tokeniser
 
 # System call definitions
 
@@ -7,20 +7,20 @@ system_call_parameters = [("address", opcodes.address_size),
                           ("X", opcodes.register_size),
                           ("Y", opcodes.register_size)]
 
-def parse_system_call(stream):
+def parse_system_call(compiler, stream):
 
     '<system call> = _call "(" <address> [<A> [<X> [<Y>]]] ")"'
     
-    top = len(compiler.used)
+    top = compiler.mark()
     token = compiler.get_token(stream)
     
     if token != tokeniser.system_call_token:
-        compiler.put_tokens(top)
+        compiler.rewind(top)
         return False
     
     token = compiler.get_token(stream)
     if token != tokeniser.arguments_begin_token:
-        raise SyntaxError("Arguments must follow '(' at line %i.\n" % tokeniser.line)
+        raise SyntaxError("Arguments must follow '(' at line %i.\n" % stream.line)
     
     # Parse the arguments corresponding to the system call parameters.
     # These take the form <address> <A> <X> <Y>.
@@ -32,7 +32,7 @@ def parse_system_call(stream):
     
         name, size = system_call_parameters[i]
         
-        top = len(compiler.used)
+        top = compiler.mark()
         token = compiler.get_token(stream)
         
         if token == tokeniser.arguments_end_token:
@@ -40,24 +40,24 @@ def parse_system_call(stream):
             # address has been given.
             if name != "address":
                 # Recover the token and break.
-                compiler.put_tokens(top)
+                compiler.rewind(top)
                 break
             else:
-                raise SyntaxError("System call lacks an address at line %i.\n" % tokeniser.line)
+                raise SyntaxError("System call lacks an address at line %i.\n" % stream.line)
         else:
             # Recover the token.
-            compiler.put_tokens(top)
+            compiler.rewind(top)
         
         if i > 0:
             token = compiler.get_token(stream)
             if token != ",":
-                raise SyntaxError("Expected a comma before system call argument '%s' at line %i.\n" % (name, tokeniser.line))
+                raise SyntaxError("Expected a comma before system call argument '%s' at line %i.\n" % (name, stream.line))
         
         if not compiler.parse_expression(stream):
-            raise SyntaxError("Invalid system call argument for parameter '%s' at line %i.\n" % (name, tokeniser.line))
+            raise SyntaxError("Invalid system call argument for parameter '%s' at line %i.\n" % (name, stream.line))
         
         if compiler.current_size != size:
-            raise SyntaxError("Incompatible types in system call argument for parameter '%s' at line %i.\n" % (name, tokeniser.line))
+            raise SyntaxError("Incompatible types in system call argument for parameter '%s' at line %i.\n" % (name, stream.line))
         
         total_args_size += size
         
@@ -65,14 +65,14 @@ def parse_system_call(stream):
     
     token = compiler.get_token(stream)
     if token != tokeniser.arguments_end_token:
-        raise SyntaxError("Arguments must be terminated with ')' at line %i.\n" % tokeniser.line)
+        raise SyntaxError("Arguments must be terminated with ')' at line %i.\n" % stream.line)
     
     compiler.debug_print("system call", system_call_parameters)
     
     # Call the system routine with the total size of the arguments supplied.
     # This enables the generated code to retrieve the arguments from the stack.
     
-    generator.generate_system_call(total_args_size)
+    compiler.generator.generate_system_call(total_args_size)
     
     # Set the size of the return value to ensure that it is assigned or
     # discarded as necessary.
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""
+bench_tokeniser.py - Compares the throughput of the tokenisers.
+
+Copyright (C) 2014 David Boddie <david@boddie.org.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import glob, os, sys, time
+import tokeniser
+from arguments import find_option
+
+def tokenise(file_name, buffered):
+
+    """Returns the list of tokens read from the named file using either the
+    buffered or character-based tokeniser."""
+    
+    t = tokeniser.Tokeniser(open(file_name), buffered)
+    
+    tokens = []
+    while not t.at_eof:
+        tokens.append(t.read_token())
+    
+    return tokens
+
+def benchmark(file_names, buffered, repeats):
+
+    """Tokenises each of the files the given number of times, returning the
+    time taken."""
+    
+    start = time.time()
+    i = 0
+    while i < repeats:
+        for file_name in file_names:
+            tokenise(file_name, buffered)
+        i += 1
+    
+    return time.time() - start
+
+
+if __name__ == "__main__":
+
+    this_program, args = sys.argv[0], sys.argv[1:]
+    repeats, number = find_option(args, "-n", 1)
+    
+    if repeats:
+        repeats = int(number)
+    else:
+        repeats = 20
+    
+    if args:
+        file_names = args
+    else:
+        file_names = glob.glob(os.path.join("Examples", "*.*")) + \
+                     glob.glob(os.path.join("Examples", "*", "*.txt")) + \
+                     glob.glob(os.path.join("include", "*", "*.ind"))
+        file_names.sort()
+    
+    # Check that both tokenisers produce the same tokens before timing them.
+    total_chars = 0
+    for file_name in file_names:
+        if tokenise(file_name, False) != tokenise(file_name, True):
+            sys.stderr.write("Tokenisers disagree for file: %s\n" % file_name)
+            sys.exit(1)
+        total_chars += os.path.getsize(file_name)
+    
+    print "Tokenising %i files (%i characters) %i times." % (
+        len(file_names), total_chars, repeats)
+    
+    for label, buffered in (("character", False), ("buffered", True)):
+        t = benchmark(file_names, buffered, repeats)
+        print "%-10s %8.3f s %10.0f chars/s" % (label, t, (total_chars * repeats) / t)
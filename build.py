@@ -18,7 +18,7 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import os, stat, struct, sys
-import compiler, opcodes, simulator
+import compiler, opcodes, simulator, superinstructions
 from arguments import find_option
 
 # The version is obtained from the compiler module.
@@ -39,11 +39,12 @@ def address_length_end(address, data):
     end_high = end >> 8
     return address_low, address_high, length_low, length_high, end_low, end_high
 
-def opcode_routines(opcodes_used):
+def opcode_routines(opcodes_used, code):
 
     """Returns the names of the routines needed by the opcodes used by the
     program. These needs to be passed to the linker to ensure that the
-    compiled program has all the support functions it needs."""
+    compiled program has all the support functions it needs. The opcodes in
+    the code are renumbered in place."""
     
     items = opcodes_used.items()
     items.sort()
@@ -57,9 +58,9 @@ def opcode_routines(opcodes_used):
     
     # Replace the old opcodes with the renumbered ones.
     i = 0
-    while i < len(compiler.generator.code):
-        value = compiler.generator.code[i]
-        compiler.generator.code[i] = mapping.get(value, value)
+    while i < len(code):
+        value = code[i]
+        code[i] = mapping.get(value, value)
         i += 1
     
     names = []
@@ -74,17 +75,69 @@ if __name__ == "__main__":
     this_program, args = sys.argv[0], sys.argv[1:]
     target, architecture = find_option(args, "-t", 1)
     output, output_file = find_option(args, "-o", 1)
-    compiler.debug = find_option(args, "-d", 0)
+    debug = find_option(args, "-d", 0)
+    packrat = find_option(args, "-p", 0)
+    jobs, number = find_option(args, "-j", 1)
+    
+    if jobs:
+        jobs = int(number)
+    
+    cache, cache_dir = find_option(args, "-c", 1)
+    tail_calls = find_option(args, "-T", 0)
+    inline, threshold = find_option(args, "-i", 1)
+    
+    if inline:
+        inline = int(threshold)
+    
+    eliminate = find_option(args, "-e", 0)
+    fold = find_option(args, "-f", 0)
+    strength = find_option(args, "-R", 0)
+    narrow = find_option(args, "-N", 0)
+    hoist = find_option(args, "-L", 0)
+    reuse = find_option(args, "-V", 0)
+    optimise = find_option(args, "-O", 0)
+    exclude, rules = find_option(args, "-x", 1)
+    
+    if exclude:
+        disabled_rules = rules.split(",")
+    else:
+        disabled_rules = ()
+    
+    fuse, number = find_option(args, "-s", 1)
+    
+    if fuse:
+        fuse = int(number)
     
     if not 1 <= len(args) <= 2 or not target:
         sys.stderr.write(
-            "Usage: %s <program file> [<manifest file>] -t <target> -o <output file>\n\n"
+            "Usage: %s <program file> [<manifest file>] -t <target> [-j <n>] [-c <cache directory>] [-T] [-i <n>] [-e] [-f] [-R] [-N] [-L] [-V] [-O [-x <rules>]] [-s <n>] -o <output file>\n\n"
             "-t    Generate code for the specified <target> architecture.\n"
             "-o    Write the generated code to the specified <output file>.\n"
-            "-d    Write debugging information to stdout.\n\n" % this_program)
+            "-d    Write debugging information to stdout.\n"
+            "-p    Cache parsing results and report the cache hit rates.\n"
+            "-j    Compile function definitions using <n> worker processes.\n"
+            "-c    Cache compiled include files in the <cache directory> given.\n"
+            "-T    Replace tail calls that functions make to themselves with jumps.\n"
+            "-i    Inline calls adding up to <n> bytes per dispatch saved and report them.\n"
+            "-e    Remove unused functions and report the bytes saved.\n"
+            "-f    Fold constant expressions and report the opcodes removed.\n"
+            "-R    Replace multiplications and divisions by constants with shifts.\n"
+            "-N    Narrow multi-byte comparisons of values that fit in a byte.\n"
+            "-L    Hoist loop-invariant expressions out of loops and report them.\n"
+            "-V    Reuse values already computed in the same block and report them.\n"
+            "-O    Apply peephole optimisations and report the rules applied.\n"
+            "-x    Exclude the comma-separated peephole <rules> given.\n"
+            "-s    Fuse the <n> most frequent opcode sequences into superinstructions.\n\n" % this_program)
         sys.exit(1)
     
-    compiler.include_dir = os.path.join(os.path.split(this_program)[0], "include", architecture)
+    include_dir = os.path.join(os.path.split(this_program)[0], "include", architecture)
+    c = compiler.Compiler(include_dir, debug = debug, packrat = packrat,
+                          jobs = jobs, cache_dir = cache_dir, fold = fold,
+                          optimise = optimise, disabled_rules = disabled_rules,
+                          superinstructions = fuse, eliminate = eliminate,
+                          inline = inline, tail_calls = tail_calls,
+                          strength = strength, narrow = narrow, hoist = hoist,
+                          reuse = reuse)
     
     input_file = args.pop(0)
     if args:
@@ -96,27 +149,77 @@ if __name__ == "__main__":
     
     if architecture == "6502":
         from arch._6502 import config, linker, parsing
-        compiler.parsing = parsing
-        compiler.types["address"] = config.address_size
+        c.parsing = parsing
+        c.types["address"] = config.address_size
+        
+        # Only fuse opcodes whose routines can be combined by the linker.
+        fusible = linker.fusible_routines()
+        c.fusible = []
+        for opcode, routine in simulator.lookup.items():
+            if routine.__name__ in fusible:
+                c.fusible.append(opcode)
         program_address = linker.get_program_address()
     else:
         sys.stderr.write("Unknown target architecture specified: %s\n" % architecture)
         sys.exit(1)
     
     try:
-        start_address = compiler.parse_program(stream, program_address)
+        program = c.compile(stream, program_address)
     except SyntaxError as exception:
         sys.stderr.write(str(exception) + "\n")
         sys.exit(1)
     
-    program_length = len(compiler.generator.code)
+    if packrat:
+        c.print_packrat_stats()
+    
+    if tail_calls:
+        c.print_tail_call_stats()
+    
+    if inline:
+        c.print_inlining_stats()
+    
+    if eliminate:
+        c.print_elimination_stats()
+    
+    if fold:
+        c.print_fold_stats()
+    
+    if strength:
+        c.print_strength_stats()
+    
+    if narrow:
+        c.print_narrowing_stats()
+    
+    if hoist:
+        c.print_hoisting_stats()
+    
+    if reuse:
+        c.print_reuse_stats()
+    
+    if optimise:
+        c.print_peephole_stats()
+    
+    if fuse:
+        c.print_superinstruction_stats()
+    
+    program_length = len(program.code)
     print "Program is", program_length, "bytes long."
     
-    # Find the opcodes used and the corresponding routines for them.
-    opcodes_used = compiler.get_opcodes_used()
-    routines_used = opcode_routines(opcodes_used)
+    # Find the opcodes used and the corresponding routines for them,
+    # including the routines for superinstructions, which are made from the
+    # routines for the opcodes they combine.
+    simulator.add_superinstructions(program.superinstructions)
+    
+    fused_routines = {}
+    for sequence in program.superinstructions.values():
+        fused_routines[superinstructions.routine_name(sequence)] = \
+            map(lambda opcode: simulator.lookup[opcode].__name__, sequence)
+    
+    opcodes_used = program.get_opcodes_used()
+    routines_used = opcode_routines(opcodes_used, program.code)
     
-    linker.link(compiler.generator.code, program_address, start_address,
-                routines_used, manifest_file, output_file, version)
+    linker.link(program.code, program_address, program.start_address,
+                routines_used, manifest_file, output_file, version,
+                fused_routines)
     # Exit
     sys.exit()
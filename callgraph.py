@@ -0,0 +1,146 @@
+"""
+callgraph.py - Analysis of the calls between functions in generated code.
+
+Copyright (C) 2014 David Boddie <david@boddie.org.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# The code for a program, in the form described in the ir module, holds the
+# code for each function in turn, starting with the label for the function,
+# followed by the main program. Functions are referred to by name in the
+# operands of the instructions that call them. The function label given to
+# each function here is called with a name to obtain the label of the function
+# that the name refers to, as for the ir.lower function.
+
+import ir
+
+def function_extents(code, entry_labels):
+
+    """Returns a dictionary mapping each of the entry labels given to the
+    start and end of the code following it, up to the next entry label or
+    the end of the code."""
+    
+    entries = []
+    i = 0
+    for instruction in code:
+        if instruction[0] == "label" and instruction[1] in entry_labels:
+            entries.append(i)
+        i += 1
+    
+    extents = {}
+    i = 0
+    while i < len(entries):
+        start = entries[i]
+        if i + 1 < len(entries):
+            end = entries[i + 1]
+        else:
+            end = len(code)
+        extents[code[start][1]] = (start, end)
+        i += 1
+    
+    return extents
+
+def called_labels(code, function_label):
+
+    """Returns a set containing the labels of the functions referred to in
+    the code given."""
+    
+    labels = set()
+    for instruction in code:
+        for operand in instruction[1:]:
+            if isinstance(operand, str):
+                labels.add(function_label(operand))
+    
+    return labels
+
+def calls(code, extents, function_label):
+
+    """Returns a dictionary mapping the label of each function in the extents
+    given to the set of labels of the functions it refers to."""
+    
+    graph = {}
+    for label, (start, end) in extents.items():
+        graph[label] = called_labels(code[start:end], function_label)
+    
+    return graph
+
+def reachable(roots, graph):
+
+    """Returns the set of labels of functions that can be reached from the
+    set of roots given by following the calls in the graph."""
+    
+    found = set()
+    pending = list(roots)
+    while pending:
+        label = pending.pop()
+        if label in found or label not in graph:
+            continue
+        found.add(label)
+        pending += list(graph[label])
+    
+    return found
+
+def remove_unreachable_functions(code, functions, start_label, function_label):
+
+    """Removes the code for the functions that cannot be reached from the
+    main program, which starts at the start label given. Returns a list of
+    the functions removed, each with the number of bytes its code occupied."""
+    
+    entry_labels = set(map(lambda function: function[3], functions))
+    entry_labels.add(start_label)
+    
+    extents = function_extents(code, entry_labels)
+    graph = calls(code, extents, function_label)
+    
+    # Any code before the first function is treated as part of the main
+    # program.
+    first = min(map(lambda (start, end): start, extents.values()))
+    roots = called_labels(code[:first], function_label)
+    roots.add(start_label)
+    
+    found = reachable(roots, graph)
+    
+    removed = []
+    for function in functions:
+        if function[3] not in found and function[3] in extents:
+            start, end = extents[function[3]]
+            removed.append((function, ir.code_size(code[start:end])))
+    
+    # Rebuild the code from the reachable pieces in their original order.
+    new_code = []
+    removed_labels = set(map(lambda (function, size): function[3], removed))
+    i = 0
+    while i < len(code):
+        instruction = code[i]
+        if instruction[0] == "label" and instruction[1] in removed_labels:
+            i = extents[instruction[1]][1]
+        else:
+            new_code.append(instruction)
+            i += 1
+    
+    code[:] = new_code
+    return removed
+
+def recursive(graph):
+
+    """Returns the set of labels of functions in the graph that can call
+    themselves, either directly or through other functions."""
+    
+    found = set()
+    for label, called in graph.items():
+        if label in reachable(called, graph):
+            found.add(label)
+    
+    return found
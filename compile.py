@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 import os, pprint, sys
-import compiler, generator, simulator, tokeniser
+import compiler, simulator
 from arguments import find_option
 
 
@@ -12,23 +12,75 @@ if __name__ == "__main__":
     target, architecture = find_option(args, "-t", 1)
     output, file_name = find_option(args, "-o", 1)
     debug = find_option(args, "-d", 0)
+    packrat = find_option(args, "-p", 0)
+    jobs, number = find_option(args, "-j", 1)
+    
+    if jobs:
+        jobs = int(number)
+    
+    cache, cache_dir = find_option(args, "-c", 1)
+    tail_calls = find_option(args, "-T", 0)
+    inline, threshold = find_option(args, "-i", 1)
+    
+    if inline:
+        inline = int(threshold)
+    
+    eliminate = find_option(args, "-e", 0)
+    fold = find_option(args, "-f", 0)
+    strength = find_option(args, "-R", 0)
+    narrow = find_option(args, "-N", 0)
+    hoist = find_option(args, "-L", 0)
+    reuse = find_option(args, "-V", 0)
+    optimise = find_option(args, "-O", 0)
+    exclude, rules = find_option(args, "-x", 1)
+    
+    if exclude:
+        disabled_rules = rules.split(",")
+    else:
+        disabled_rules = ()
+    
+    fuse, number = find_option(args, "-s", 1)
+    
+    if fuse:
+        fuse = int(number)
     
     if len(args) != 1 or (not target and not run):
         sys.stderr.write(
-            "Usage: %s [-r] [-t <target>] <file> [-o <output file>]\n\n"
+            "Usage: %s [-r] [-t <target>] [-j <n>] [-c <cache directory>] [-T] [-i <n>] [-e] [-f] [-R] [-N] [-L] [-V] [-O [-x <rules>]] [-s <n>] <file> [-o <output file>]\n\n"
             "-r    Run the generated code in a simulator.\n"
             "-t    Generate code for the specified <target> architecture.\n"
             "-o    Write the generated code to the specified <output file>.\n"
-            "-d    Write debugging information to stdout.\n\n" % this_program)
+            "-d    Write debugging information to stdout.\n"
+            "-p    Cache parsing results and report the cache hit rates.\n"
+            "-j    Compile function definitions using <n> worker processes.\n"
+            "-c    Cache compiled include files in the <cache directory> given.\n"
+            "-T    Replace tail calls that functions make to themselves with jumps.\n"
+            "-i    Inline calls adding up to <n> bytes per dispatch saved and report them.\n"
+            "-e    Remove unused functions and report the bytes saved.\n"
+            "-f    Fold constant expressions and report the opcodes removed.\n"
+            "-R    Replace multiplications and divisions by constants with shifts.\n"
+            "-N    Narrow multi-byte comparisons of values that fit in a byte.\n"
+            "-L    Hoist loop-invariant expressions out of loops and report them.\n"
+            "-V    Reuse values already computed in the same block and report them.\n"
+            "-O    Apply peephole optimisations and report the rules applied.\n"
+            "-x    Exclude the comma-separated peephole <rules> given.\n"
+            "-s    Fuse the <n> most frequent opcode sequences into superinstructions.\n\n" % this_program)
         sys.exit(1)
     
-    compiler.include_dir = os.path.join(os.path.split(this_program)[0], "include", architecture)
+    include_dir = os.path.join(os.path.split(this_program)[0], "include", architecture)
+    c = compiler.Compiler(include_dir, debug = debug, packrat = packrat,
+                          jobs = jobs, cache_dir = cache_dir, fold = fold,
+                          optimise = optimise, disabled_rules = disabled_rules,
+                          superinstructions = fuse, eliminate = eliminate,
+                          inline = inline, tail_calls = tail_calls,
+                          strength = strength, narrow = narrow, hoist = hoist,
+                          reuse = reuse)
     
     stream = open(args[0])
     
     if architecture == "6502":
         from arch._6502 import linker, parsing
-        compiler.parsing = parsing
+        c.parsing = parsing
         program_address = linker.get_program_address()
     elif run:
         program_address = 0
@@ -37,25 +89,61 @@ if __name__ == "__main__":
         sys.exit(1)
     
     try:
-        start_address = compiler.parse_program(stream, program_address)
+        program = c.compile(stream, program_address)
     except SyntaxError as exception:
         sys.stderr.write(str(exception) + "\n")
         sys.exit(1)
     
+    if packrat:
+        c.print_packrat_stats()
+    
+    if tail_calls:
+        c.print_tail_call_stats()
+    
+    if inline:
+        c.print_inlining_stats()
+    
+    if eliminate:
+        c.print_elimination_stats()
+    
+    if fold:
+        c.print_fold_stats()
+    
+    if strength:
+        c.print_strength_stats()
+    
+    if narrow:
+        c.print_narrowing_stats()
+    
+    if hoist:
+        c.print_hoisting_stats()
+    
+    if reuse:
+        c.print_reuse_stats()
+    
+    if optimise:
+        c.print_peephole_stats()
+    
+    if fuse:
+        c.print_superinstruction_stats()
+    
     print "Functions:"
-    pprint.pprint(compiler.functions)
+    pprint.pprint(program.functions)
     
     print "Main variables:"
-    pprint.pprint(compiler.local_variables)
+    pprint.pprint(c.local_variables)
     
     print "Main code:"
     addr = program_address
-    for v in generator.code:
+    for v in program.code:
         print "%04x: %03i (%02x)" % (addr, v, v)
         addr += 1
     
+    # Make the superinstructions used by the program known to the simulator.
+    simulator.add_superinstructions(program.superinstructions)
+    
     print "Opcode usage:"
-    d = compiler.get_opcodes_used()
+    d = program.get_opcodes_used()
     freq = map(lambda (k, v): (v, k), d.items())
     freq.sort()
     for v, k in freq:
@@ -63,9 +151,9 @@ if __name__ == "__main__":
     
     if run:
         print "Loading"
-        simulator.load(generator.code, program_address)
+        simulator.load(program.code, program_address)
         print "Running"
-        print simulator.run(start_address)
+        print simulator.run(program.start_address)
     
     if output:
-        compiler.save_opcodes(file_name)
+        program.save_opcodes(file_name)
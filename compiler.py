@@ -17,83 +17,99 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import os, string
-import generator, opcodes, tokeniser
-from tokeniser import read_token
+import importlib, multiprocessing, os, string, StringIO
+import callgraph, folding, generator, inlining, ir, objects, opcodes, peephole
+import loops, numbering, ranges, strength, superinstructions, tailcalls
+import tokeniser
 
 version = "0.3"
 
-# Token handling - lists of incoming tokens and those tentatively processed
+# Symbol tables
 
-tokens = []
-used = []
+class SymbolTable:
 
-# Variable and type definitions
-
-global_variables = []
-local_variables = []
-current_size = 0
-current_element_size = 0
-current_array = False
-
-# Function definitions
-
-functions = []
-in_function = False
-
-# Include directory
-
-include_dir = ""
-
-# Debugging
-debug = False
-
-def debug_print(*args):
-    global debug
-    if not debug:
-        return
-    for arg in args:
-        print arg,
-    print
-
-# Constant and type handling
-
-types = {"byte": 1, "int8": 1, "int16": 2, "int32": 4,
-         "int8_array": 2, "int16_array": 2, "int32_array": 2, "string": 2}
-array_types = {"int8_array": 1, "int16_array": 2, "int32_array": 4, "string": 1}
-
-def is_constant(token):
-
-    if is_boolean(token):
-        return True
+    """Holds a list of entries in the order in which they were defined and a
+    dictionary mapping the name of each entry to a record for it. Only the
+    first entry with a given name can be found by name."""
     
-    if is_number(token):
-        return True
+    def __init__(self):
     
-    if is_string(token):
-        return True
+        self.clear()
+    
+    def clear(self):
+    
+        self.entries = []
+        self.records = {}
+    
+    def append(self, entry):
+    
+        name = entry[0]
+        if name not in self.records:
+            self.records[name] = self.record(entry)
+        self.entries.append(entry)
+    
+    def truncate(self, length):
+    
+        # Discard the entries after the given number of entries.
+        entries = self.entries[:length]
+        self.clear()
+        for entry in entries:
+            self.append(entry)
+    
+    def record(self, entry):
+    
+        return entry
+    
+    def find(self, name):
+    
+        return self.records.get(name)
+    
+    def __getitem__(self, index):
+    
+        return self.entries[index]
+    
+    def __iter__(self):
+    
+        return iter(self.entries)
     
-    return False
+    def __len__(self):
+    
+        return len(self.entries)
+    
+    def __repr__(self):
+    
+        return repr(self.entries)
 
-def get_size(token):
+class Variables(SymbolTable):
 
-    global current_size, current_element_size, current_array
+    """Holds variables as (name, size, element size, array) entries, recording
+    the offset of each variable from the start of the space allocated for
+    them so that lookups do not need to add up the sizes of the preceding
+    variables."""
     
-    if is_boolean(token):
-        current_size = current_element_size = 1
-        return current_size
+    def clear(self):
     
-    if is_number(token):
-        current_size = current_element_size = number_size(token)
-        return current_size
+        SymbolTable.clear(self)
+        self.size = 0
     
-    if is_string(token):
-        current_size = len(decode_string(token))
-        current_element_size = array_types["string"]
-        current_array = True
-        return current_size
+    def append(self, entry):
     
-    raise SyntaxError, "Unknown size for constant '%s' at line %i." % (token, tokeniser.line)
+        SymbolTable.append(self, entry)
+        self.size += entry[1]
+    
+    def record(self, entry):
+    
+        # The record contains the offset, size, element size and array flag.
+        name, size, element_size, array = entry
+        return (self.size, size, element_size, array)
+
+# Type definitions
+
+types = {"byte": 1, "int8": 1, "int16": 2, "int32": 4,
+         "int8_array": 2, "int16_array": 2, "int32_array": 2, "string": 2}
+array_types = {"int8_array": 1, "int16_array": 2, "int32_array": 4, "string": 1}
+
+# Constant handling
 
 def is_boolean(token):
 
@@ -106,10 +122,6 @@ def boolean_value(token):
     else:
         return 0
 
-def is_function_name(token):
-
-    return is_variable(token)
-
 def is_number(token):
 
     if token[0] == "-":
@@ -166,66 +178,6 @@ def get_number_base(token):
     else:
         return 10
 
-def is_string(token):
-
-    if len(token) >= 2 and token[0] == '"' and token[-1] == '"':
-        return decode_string(token)
-    else:
-        return False
-
-def is_type(token):
-
-    return token in types
-
-def decode_string(token):
-
-    # Discard the leading and trailing quotation marks and convert any encoded
-    # characters to bytes.
-    new = ""
-    i = 1
-    
-    while i < len(token) - 1:
-        ch = token[i]
-        if ch == "\\":
-            j = i + 1
-            if j == len(token) - 1:
-                raise SyntaxError, "Incomplete escape at line %i." % tokeniser.line
-            ch = token[j]
-            if ch == "\\":
-                new += ch
-            elif ch == '"':
-                new += ch
-            elif ch == "n":
-                new += "\n"
-            elif ch == "r":
-                new += "\r"
-            elif ch == "n":
-                new += "\n"
-            elif ch == "t":
-                new += "\t"
-            elif ch == "x":
-                k = 2
-                total = 0
-                while k > 0 and j < len(token) - 1:
-                    j += 1
-                    k -= 1
-                    ch = token[j]
-                    if ch in string.hexdigits:
-                        total += (string.hexdigits.index(ch.lower()) << (k * 4))
-                    else:
-                        raise SyntaxError, "Invalid escape at line %i." % tokeniser.line
-                if k != 0:
-                    raise SyntaxError, "Invalid escape at line %i." % tokeniser.line
-                new += chr(total)
-            else:
-                raise SyntaxError, "Invalid escape at line %i." % tokeniser.line
-            i = j + 1
-        else:
-            new += ch
-            i += 1
-    
-    return new
-
 # Variable handling
 
 variable_chars = string.letters + string.digits + "_"
@@ -243,48 +195,6 @@ def is_variable(token):
     
     return True
 
-def find_local_variable(token):
-
-    index = 0
-    for name, size, element_size, array in local_variables:
-        if name == token:
-            debug_print("local variable", token, size, element_size, array)
-            return index
-        index += 1
-    
-    return -1
-
-def local_variable_offset(index):
-
-    offset = 0
-    while index > 0:
-        index -= 1
-        name, size, element_size, array = local_variables[index]
-        offset += size
-    
-    return offset
-
-def find_global_variable(token):
-
-    index = 0
-    for name, size, element_size, array in global_variables:
-        if name == token:
-            debug_print("global variable", token)
-            return index
-        index += 1
-    
-    return -1
-
-def global_variable_offset(index):
-
-    offset = 0
-    while index > 0:
-        index -= 1
-        name, size, element_size, array = global_variables[index]
-        offset += size
-    
-    return offset
-
 def total_variable_size(variables):
 
     total_var_size = 0
@@ -293,1213 +203,2345 @@ def total_variable_size(variables):
     
     return total_var_size
 
-# Function handling
-
-def find_function(token):
+def is_function_name(token):
 
-    index = 0
-    for name, parameters, variables, address, rsize, return_array in functions:
-        if name == token:
-            return index
-        index += 1
-    
-    return -1
+    return is_variable(token)
 
-def function_address(token):
+# Operators
 
-    address = 0
-    for name, parameters, variables, address, rsize, return_array in functions:
-        if name == token:
-            return address
-        address += len(code)
-    
-    return -1
+unary_operators = ("not", "-", "~")
+operators = ("==", "!=", "<", ">", "+", "-", "*", "/", "and", "or", "&", "|", "^", "<<", ">>")
+asymmetric_operators = ("<<", ">>", "&")
 
-# Token handling
+# Packrat parsing
 
-def get_token(stream):
+def memoize(rule, successes = True):
 
-    if tokens:
-        token = tokens.pop(0)
-    else:
-        token = read_token(stream)
-        if token.startswith(tokeniser.comment_token):
-            while True:
-                token = read_token(stream)
-                if token == tokeniser.newline_token:
-                    break
+    # Return a function that calls the given parsing rule or, in packrat mode,
+    # reuses the result of an earlier call at the same token position. The
+    # cache holds the result, the position after the rule was applied, any
+    # code it generated and the size of the value it produced. Copies of the
+    # code are stored and reused because instructions may be changed after
+    # they are generated.
+    # Rules that define variables and functions or generate code that depends
+    # on its address are only memoized when they fail.
     
-    # Transfer the token to the list of used tokens but also return it.
-    used.append(token)
+    name = rule.__name__
     
-    #print_tokens()
-    return token
-
-def put_tokens(index):
-
-    tokens[:] = used[index:] + tokens
-    used[:] = used[:index]
-    #print_tokens()
-
-def peek_token(stream):
-
-    top = len(used)
-    token = get_token(stream)
-    put_tokens(top)
-    return token
+    def parse(self, stream):
+    
+        if not self.packrat:
+            return rule(self, stream)
+        
+        key = (name, self.position)
+        stats = self.packrat_stats.setdefault(name, [0, 0, 0])
+        
+        if key in self.packrat_cache:
+            result, end, code, sizes = self.packrat_cache[key]
+            stats[0] += 1
+            stats[2] += end - self.position
+            self.position = end
+            
+            if result:
+                self.generator.code.extend(ir.copy_code(code))
+                (self.current_size, self.current_element_size,
+                 self.current_array) = sizes
+            
+            return result
+        
+        stats[1] += 1
+        address = len(self.generator.code)
+        
+        result = rule(self, stream)
+        
+        if successes or not result:
+            self.packrat_cache[key] = (result, self.position,
+                ir.copy_code(self.generator.code[address:]), (self.current_size,
+                self.current_element_size, self.current_array))
+        return result
+    
+    parse.__name__ = name
+    parse.__doc__ = rule.__doc__
+    return parse
 
-def discard_tokens():
+def memoize_failures(rule):
 
-    used[:] = []
-    #print_tokens()
+    return memoize(rule, False)
 
-def print_tokens():
+# Compilation of function definitions in worker processes
 
-    used_str = " ".join(map(repr, used))
-    print used_str, " ".join(map(repr, tokens))
-    print " "*len(used_str) + "^"
+class TokenList:
 
-# Parsing functions
+    """Reads tokens from a list of (token, line) pairs recorded from another
+    tokeniser, returning the end of file token when there are no more."""
+    
+    def __init__(self, tokens):
+    
+        self.tokens = tokens
+        self.index = 0
+        self.line = tokens[0][1]
+        self.at_eof = False
+        self.buffered = False
+    
+    def read_token(self):
+    
+        if self.index == len(self.tokens):
+            self.at_eof = True
+            return tokeniser.eof_token
+        
+        token, self.line = self.tokens[self.index]
+        self.index += 1
+        return token
 
-def parse_array_index(stream):
+def compile_definition(arguments):
 
-    '<array index> = "[" <expression> "]"'
+    # Compile a function definition, given the functions and global variables
+    # that it can refer to. Return the code, the definition of the function,
+    # any global variables
+    # it defines, the size of the last value produced and the packrat cache
+    # statistics, or the exception raised for a syntax error.
+    tokens, functions, global_variables, settings = arguments
+    include_dir, parsing, types, debug, packrat = settings
     
-    top = len(used)
-    token = get_token(stream)
+    if parsing:
+        parsing = importlib.import_module(parsing)
     
-    if token != tokeniser.index_begin_token:
-        put_tokens(top)
-        return False
+    c = Compiler(include_dir, parsing, debug, packrat)
+    c.types = types
     
-    if not parse_expression(stream):
-        raise SyntaxError, "Invalid index value at line %i." % tokeniser.line
+    for function in functions:
+        c.functions.append(function)
+    for variable in global_variables:
+        c.global_variables.append(variable)
     
-    token = get_token(stream)
+    stream = TokenList(tokens)
+    c.source = stream
     
-    if token != tokeniser.index_end_token:
-        raise SyntaxError, "Expected ']' at line %i." % tokeniser.line
+    try:
+        if not c.parse_definition(stream) or c.position != len(c.tokens) or \
+           stream.index != len(tokens):
+            raise SyntaxError, "Invalid function definition at line %i." % stream.line
+    except SyntaxError as exception:
+        return exception
     
-    debug_print("array index")
-    return True
+    return (c.generator.code, c.functions[-1],
+            c.global_variables.entries[len(global_variables):],
+            (c.current_size, c.current_element_size, c.current_array),
+            c.packrat_stats)
 
-def parse_body(stream):
+class Program:
 
-    '<body> = <indent> (<control> | <return> | <statement>)+ <dedent>'
+    """Holds the code generated for a program, the address of its first
+    instruction and the functions and global variables it defines. The
+    superinstructions used by the code are given as a dictionary mapping their
+    opcodes to the sequences of opcodes they perform."""
     
-    if not parse_indent(stream):
-        return False
+    def __init__(self, code, base_address, start_address, functions,
+                 global_variables, superinstructions = None):
     
-    has_body = False
-    while True:
-    
-        if parse_control(stream):
-            debug_print("control")
-        elif in_function and parse_return(stream):
-            debug_print("return")
-        elif parse_statement(stream):
-            debug_print("statement")
-        elif parse_separator(stream):
-            # Handle blank lines.
-            debug_print("separator (blank)")
-        elif parse_dedent(stream):
-            break
-        else:
-            return False
+        if superinstructions is None:
+            superinstructions = {}
         
-        has_body = True
+        self.code = code
+        self.base_address = base_address
+        self.start_address = start_address
+        self.functions = functions
+        self.global_variables = global_variables
+        self.superinstructions = superinstructions
     
-    if not has_body:
-        return False
+    def save_opcodes(self, file_name):
     
-    debug_print("body")
-    return True
-
-# This function tries to parse tokens as a built-in call.
-# Currently, it only supports the _addr, _load and _store functions.
-
-def parse_builtin_call(stream):
-
-    if parse_builtin_call_addr(stream):
-        return True
-    elif parse_builtin_call_load(stream):
-        return True
-    elif parse_builtin_call_store(stream):
-        return True
-    else:
-        return False
-
-def parse_builtin_call_addr(stream):
-
-    '<built-in _addr> = "_addr" "(" <variable> ")"'
+        f = open(file_name, "wb")
+        f.write("".join(map(chr, map(lambda x: x & 0xff, self.code))))
+        f.close()
     
-    global current_size, current_element_size, current_array
+    def get_opcodes_used(self):
+    
+        d = {}
+        
+        for v in self.code:
+            if v > 255:
+                d[v] = d.get(v, 0) + 1
+        
+        return d
+
+class Compiler:
+
+    """Compiles programs using the architecture specific parsing module given,
+    reading included files from the include directory. Each call to compile
+    starts with new symbol tables and generated code, so one instance can be
+    used to compile many programs.
+    
+    If jobs is nonzero, function definitions are read before any of them are
+    compiled, then their bodies are compiled separately, using the given
+    number of worker processes if more than one. The code produced is the same
+    as when they are compiled in turn.
+    
+    If a cache directory is given, included files are compiled to object
+    modules that are stored in it, keyed by the contents of the files, and
+    linked into later programs that include the same files.
+    
+    If tail_calls is True, calls that functions make to themselves as the
+    last thing they do are replaced with jumps to the start of their bodies.
+    
+    If inline is nonzero, calls to functions that do not call themselves are
+    replaced with copies of their code if each copy adds no more than that
+    number of bytes for each instruction dispatch it saves.
+    
+    If eliminate is True, functions that cannot be reached from the main
+    program are removed.
+    
+    If fold is True, operations on constants are evaluated when the program
+    is compiled and operations that leave values unchanged are removed.
+    
+    If strength is True, multiplications and divisions by constants are
+    replaced with shifts and additions where the table of costs in the
+    strength module shows that these are cheaper.
+    
+    If narrow is True, multi-byte comparisons in functions are replaced with
+    single byte comparisons where the ranges of the values compared show
+    that they always fit in a byte.
+    
+    If hoist is True, expressions in the loops of functions that produce the
+    same value on every iteration are evaluated once before each loop and
+    their values stored in new local variables.
+    
+    If reuse is True, values that functions produce again in the same basic
+    block, without changes to the variables they depend on, are stored in
+    new local variables when first produced and loaded from them afterwards.
+    
+    If optimise is True, the rules in the peephole module are applied to the
+    code, except for those named in the disabled rules.
+    
+    If superinstructions is nonzero, up to that number of the most frequent
+    sequences of opcodes in the program are fused into superinstructions. If
+    a collection of fusible opcodes is given, only those opcodes are fused."""
+    
+    def __init__(self, include_dir = "", parsing = None, debug = False,
+                 packrat = False, jobs = 0, cache_dir = None, fold = False,
+                 optimise = False, disabled_rules = (), superinstructions = 0,
+                 fusible = None, eliminate = False, inline = 0,
+                 tail_calls = False, strength = False, narrow = False,
+                 hoist = False, reuse = False):
+    
+        self.include_dir = include_dir
+        self.parsing = parsing
+        self.debug = debug
+        self.packrat = packrat
+        self.jobs = jobs
+        self.cache_dir = cache_dir
+        self.tail_calls = tail_calls
+        self.inline = inline
+        self.eliminate = eliminate
+        self.fold = fold
+        self.strength = strength
+        self.narrow = narrow
+        self.hoist = hoist
+        self.reuse = reuse
+        self.optimise = optimise
+        self.disabled_rules = disabled_rules
+        self.superinstructions = superinstructions
+        self.fusible = fusible
+        self.types = types.copy()
+        
+        self.reset(0)
     
-    top = len(used)
-    token = get_token(stream)
+    def reset(self, base_address):
     
-    if token != "_addr":
-        put_tokens(top)
-        return False
+        # Token handling - an array of the tokens read but not yet discarded
+        # and the position of the next token to be used in the array
+        self.tokens = []
+        self.position = 0
+        
+        # Packrat parsing - the results of parsing rules cached by rule and
+        # token position, and the number of hits and misses for each rule
+        self.packrat_cache = {}
+        self.packrat_stats = {}
+        
+        # The tokeniser for the file currently being parsed
+        self.source = None
+        
+        # Variable and type definitions
+        self.global_variables = Variables()
+        self.local_variables = Variables()
+        self.current_size = 0
+        self.current_element_size = 0
+        self.current_array = False
+        
+        # Function definitions
+        self.functions = SymbolTable()
+        self.in_function = False
+        
+        # Function definitions read but not yet compiled
+        self.definitions = []
+        
+        # The object module for the included file being compiled and the
+        # names looked up by the function being defined in it
+        self.module = None
+        self.lookups = None
+        
+        self.generator = generator.Generator(base_address)
+        
+        # The functions with tail calls replaced, the call sites inlined and
+        # the functions removed with the sizes of their code
+        self.tail_calls_replaced = []
+        self.inlined = []
+        self.removed_functions = []
+        
+        # The number of instructions removed by constant folding, the
+        # number of operations replaced by strength reduction with the
+        # cycles saved, the number of multi-byte operations narrowed, the
+        # loops with expressions hoisted out of them, the functions with
+        # values reused, the number of times each peephole rule was applied,
+        # and the superinstructions used with the number of times each was
+        # used
+        self.folded = 0
+        self.reduced = (0, 0)
+        self.narrowed = 0
+        self.hoisted = []
+        self.reused = []
+        self.peephole_stats = {}
+        self.fused = {}
+        self.fused_uses = {}
+    
+    def compile(self, stream, base_address, buffered = False):
+    
+        """Compiles the program read from the stream for the given base address,
+        returning a Program object."""
+        
+        self.reset(base_address)
+        start = self.parse_program(stream, base_address, buffered)
+        
+        if self.tail_calls:
+            self.tail_calls_replaced = tailcalls.eliminate_tail_calls(
+                self.generator.code, self.functions, start, self.function_address)
+        
+        if self.inline:
+            self.inlined = inlining.inline_functions(self.generator.code,
+                self.functions, start, self.function_address, self.inline)
+        
+        if self.eliminate:
+            self.eliminate_functions(start)
+        
+        if self.fold:
+            self.folded = folding.fold_constants(self.generator.code)
+        
+        if self.strength:
+            self.reduced = strength.reduce_strength(self.generator.code)
+        
+        if self.narrow:
+            self.narrowed = ranges.narrow_comparisons(self.generator.code,
+                self.functions, start)
+        
+        if self.hoist:
+            self.hoisted = loops.hoist_invariants(self.generator.code,
+                self.functions, start)
+        
+        if self.reuse:
+            self.reused = numbering.reuse_values(self.generator.code,
+                self.functions, start)
+        
+        if self.optimise:
+            self.peephole_stats = peephole.optimise(self.generator.code,
+                                                    self.disabled_rules)
+        
+        if self.superinstructions:
+            counts = {}
+            superinstructions.count_sequences(self.generator.code, counts,
+                                              self.fusible)
+            sequences = superinstructions.choose_sequences(counts,
+                                                           self.superinstructions)
+            self.fused, self.fused_uses = superinstructions.fuse(
+                self.generator.code, sequences)
+        
+        # Lower the code to bytes and fill in the addresses of the functions.
+        code, addresses = self.generator.lower(self.function_address)
+        
+        for function in self.functions:
+            function[3] = addresses[function[3]]
+        
+        return Program(code, base_address, addresses[start], self.functions,
+                       self.global_variables, self.fused)
     
-    token = get_token(stream)
-    if token != tokeniser.arguments_begin_token:
-        raise SyntaxError, "Arguments must follow '(' at line %i.\n" % tokeniser.line
+    def eliminate_functions(self, start):
     
-    var_token = get_token(stream)
-    if not is_variable(var_token):
-        raise SyntaxError, "Argument must be a variable at line %i.\n" % tokeniser.line
+        # Remove the code for unreachable functions and their entries in the
+        # function table.
+        self.removed_functions = callgraph.remove_unreachable_functions(
+            self.generator.code, self.functions, start, self.function_address)
+        
+        removed = set(map(lambda (function, size): function[3],
+                          self.removed_functions))
+        functions = SymbolTable()
+        for function in self.functions:
+            if function[3] not in removed:
+                functions.append(function)
+        
+        self.functions = functions
     
-    index = find_local_variable(var_token)
-    if index != -1:
-        name, size, element_size, array = local_variables[index]
-        offset = local_variable_offset(index)
+    # Debugging
     
-    token = get_token(stream)
-    if token != tokeniser.arguments_end_token:
-        raise SyntaxError, "Arguments must be terminated with ')' at line %i.\n" % tokeniser.line
+    def debug_print(self, *args):
+        if not self.debug:
+            return
+        for arg in args:
+            print arg,
+        print
     
-    debug_print("addr call")
+    # Constant and type handling
     
-    generator.generate_get_variable_address(offset)
+    def is_constant(self, token):
     
-    # Set the size of the return value to ensure that it is assigned or
-    # discarded as necessary.
-    current_size = current_element_size = opcodes.address_size
-    current_array = False
+        if is_boolean(token):
+            return True
+        
+        if is_number(token):
+            return True
+        
+        if self.is_string(token):
+            return True
+        
+        return False
     
-    return True
-
-def parse_builtin_call_load(stream):
-
-    '<built-in _store> = "_load" "(" <value expression>, <address expression> ")"'
+    def get_size(self, token):
     
-    global current_size, current_element_size, current_array
+        if is_boolean(token):
+            self.current_size = self.current_element_size = 1
+            self.current_array = False
+            return self.current_size
+        
+        if is_number(token):
+            self.current_size = self.current_element_size = number_size(token)
+            self.current_array = False
+            return self.current_size
+        
+        if self.is_string(token):
+            self.current_size = len(self.decode_string(token))
+            self.current_element_size = array_types["string"]
+            self.current_array = True
+            return self.current_size
+        
+        raise SyntaxError, "Unknown size for constant '%s' at line %i." % (token, self.source.line)
     
-    top = len(used)
-    token = get_token(stream)
+    def is_string(self, token):
     
-    if token != "_load":
-        put_tokens(top)
-        return False
+        if len(token) >= 2 and token[0] == '"' and token[-1] == '"':
+            return self.decode_string(token)
+        else:
+            return False
     
-    token = get_token(stream)
-    if token != tokeniser.arguments_begin_token:
-        raise SyntaxError, "Arguments must follow '(' at line %i.\n" % tokeniser.line
+    def is_type(self, token):
     
-    # Parse the size.
-    token = get_token(stream)
-    if not is_number(token):
-        raise SyntaxError, "Argument must be a constant integer at line %i.\n" % tokeniser.line
+        return token in self.types
     
-    base = get_number_base(token)
-    size = int(token, base)
+    def decode_string(self, token):
     
-    token = get_token(stream)
-    if token != ",":
-        raise SyntaxError("Expected a comma before the address at line %i.\n" % tokeniser.line)
+        # Discard the leading and trailing quotation marks and convert any encoded
+        # characters to bytes.
+        new = ""
+        i = 1
+        
+        while i < len(token) - 1:
+            ch = token[i]
+            if ch == "\\":
+                j = i + 1
+                if j == len(token) - 1:
+                    raise SyntaxError, "Incomplete escape at line %i." % self.source.line
+                ch = token[j]
+                if ch == "\\":
+                    new += ch
+                elif ch == '"':
+                    new += ch
+                elif ch == "n":
+                    new += "\n"
+                elif ch == "r":
+                    new += "\r"
+                elif ch == "n":
+                    new += "\n"
+                elif ch == "t":
+                    new += "\t"
+                elif ch == "x":
+                    k = 2
+                    total = 0
+                    while k > 0 and j < len(token) - 1:
+                        j += 1
+                        k -= 1
+                        ch = token[j]
+                        if ch in string.hexdigits:
+                            total += (string.hexdigits.index(ch.lower()) << (k * 4))
+                        else:
+                            raise SyntaxError, "Invalid escape at line %i." % self.source.line
+                    if k != 0:
+                        raise SyntaxError, "Invalid escape at line %i." % self.source.line
+                    new += chr(total)
+                else:
+                    raise SyntaxError, "Invalid escape at line %i." % self.source.line
+                i = j + 1
+            else:
+                new += ch
+                i += 1
+        
+        return new
     
-    # Parse the address.
-    if not parse_expression(stream):
-        raise SyntaxError, "Argument must be a valid expression at line %i.\n" % tokeniser.line
+    # Variable handling
     
-    if current_size != opcodes.address_size:
-        raise SyntaxError, "Address argument must have the size of an address at line %i.\n" % tokeniser.line
+    def find_local_variable(self, token):
     
-    token = get_token(stream)
-    if token != tokeniser.arguments_end_token:
-        raise SyntaxError, "Arguments must be terminated with ')' at line %i.\n" % tokeniser.line
+        # Return the offset, size, element size and array flag for the variable
+        # or None if it is not defined.
+        variable = self.local_variables.find(token)
+        if variable:
+            self.debug_print("local variable", token, *variable[1:])
+        
+        return variable
     
-    debug_print("load call")
+    def find_global_variable(self, token):
     
-    generator.generate_load_memory_value(size)
+        variable = self.global_variables.find(token)
+        if variable:
+            self.debug_print("global variable", token)
+        
+        if self.lookups is not None:
+            self.lookups.setdefault(("global", token), variable)
+        
+        return variable
     
-    # Set the size of the return value to ensure that it is assigned or
-    # discarded as necessary.
-    current_size = current_element_size = size
-    current_array = False
+    # Function handling
     
-    return True
-
-def parse_builtin_call_store(stream):
-
-    '<built-in _store> = "_store" "(" <value expression>, <address expression> ")"'
+    def find_function(self, token):
     
-    global current_size, current_element_size, current_array
+        # Return the definition of the function with the given name in the format
+        # <name> <parameters> <local variables> <address> <return size> <return array>
+        # or None if it is not defined.
+        if self.lookups is not None:
+            self.lookups.setdefault(("function", token),
+                                    self.lookup_function(token))
+        
+        return self.functions.find(token)
+    
+    def lookup_function(self, token):
+    
+        # Return the definition of a function without its address, which is
+        # only known when the code that uses it is linked, or "self" if it is
+        # the function being defined.
+        function = self.functions.find(token)
+        if not function:
+            return None
+        elif function is self.functions[-1]:
+            return "self"
+        
+        name, parameters, variables, address, rsize, return_array = function
+        return (name, parameters, variables, rsize, return_array)
     
-    top = len(used)
-    token = get_token(stream)
+    def function_address(self, token):
     
-    if token != "_store":
-        put_tokens(top)
-        return False
+        function = self.functions.find(token)
+        if function:
+            return function[3]
+        
+        return -1
     
-    token = get_token(stream)
-    if token != tokeniser.arguments_begin_token:
-        raise SyntaxError, "Arguments must follow '(' at line %i.\n" % tokeniser.line
+    # Token handling
     
-    # Parse the value.
-    if not parse_expression(stream):
-        raise SyntaxError, "Argument must be a valid expression at line %i.\n" % tokeniser.line
+    def get_token(self, stream):
     
-    size = current_size
+        if self.position == len(self.tokens):
+            token = stream.read_token()
+            if token.startswith(tokeniser.comment_token):
+                while True:
+                    token = stream.read_token()
+                    if token == tokeniser.newline_token:
+                        break
+            
+            self.tokens.append(token)
+        else:
+            token = self.tokens[self.position]
+        
+        # Move past the token but also return it.
+        self.position += 1
+        
+        #self.print_tokens()
+        return token
     
-    token = get_token(stream)
-    if token != ",":
-        raise SyntaxError("Expected a comma before the address at line %i.\n" % tokeniser.line)
+    def mark(self):
     
-    # Parse the address.
-    if not parse_expression(stream):
-        raise SyntaxError, "Argument must be a valid expression at line %i.\n" % tokeniser.line
+        # Return the position of the next token so that parsing functions can
+        # rewind to it if they fail to match their input.
+        return self.position
     
-    if current_size != opcodes.address_size:
-        raise SyntaxError, "Address argument must have the size of an address at line %i.\n" % tokeniser.line
+    def rewind(self, index):
     
-    token = get_token(stream)
-    if token != tokeniser.arguments_end_token:
-        raise SyntaxError, "Arguments must be terminated with ')' at line %i.\n" % tokeniser.line
+        # Put back the tokens used after the index given. Indexes beyond the
+        # current position leave it unchanged.
+        if index < self.position:
+            self.position = index
+        #self.print_tokens()
     
-    debug_print("store call")
+    def peek_token(self, stream):
     
-    generator.generate_store_memory_value(size)
+        top = self.mark()
+        token = self.get_token(stream)
+        self.rewind(top)
+        return token
     
-    # Set the size of the return value to ensure that it is assigned or
-    # discarded as necessary.
-    current_size = current_element_size = 0
-    current_array = False
+    def discard_tokens(self):
     
-    return True
-
-def parse_control(stream):
-
-    '<control> = ("if" <expression> <body> "else" <body>) | ("while" <expression> <body>)'
+        # Remove the tokens that have been used from the array. Cached results
+        # refer to positions in the array so these are also discarded.
+        del self.tokens[:self.position]
+        self.position = 0
+        self.packrat_cache.clear()
+        #self.print_tokens()
     
-    top = len(used)
-    token = get_token(stream)
+    def print_packrat_stats(self):
     
-    if token == "if":
-        if parse_expression(stream):
-            debug_print("expression")
-            
-            if current_size != 1:
-                raise SyntaxError, "Invalid condition type at line %i." % tokeniser.line
-            
-            # Insert a placeholder branch instruction.
-            if_address = generator.generate_if()
-            
-            if not parse_body(stream):
-                raise SyntaxError, "Invalid if body at line %i." % tokeniser.line
-            
-            debug_print("if")
-            
-            top = len(used)
-            token = get_token(stream)
-            if token == "else":
-            
-                # Add a placeholder branch to the if code.
-                if_exit_address = generator.generate_else()
-                
-                # Fill in the branch offset for the if condition.
-                generator.generate_target(if_address)
-                
-                if not parse_body(stream):
-                    raise SyntaxError, "Invalid else body at line %i." % tokeniser.line
-                
-                # Fill in the branch offset for the if body.
-                generator.generate_target(if_exit_address)
-            
-            else:
-                # Put the token back in the queue.
-                put_tokens(top)
-                
-                # Fill in the branch offset for the if condition.
-                generator.generate_target(if_address)
-            
-            return True
+        print "Packrat cache:"
+        total_hits = total_misses = 0
+        
+        names = self.packrat_stats.keys()
+        names.sort()
+        for name in names:
+            hits, misses, reused = self.packrat_stats[name]
+            print "  %-24s %5i hits %5i misses %5.1f%% (%i tokens reused)" % (
+                name, hits, misses, (100.0 * hits) / (hits + misses), reused)
+            total_hits += hits
+            total_misses += misses
         
-        raise SyntaxError, "Invalid if structure at line %i." % tokeniser.line
+        if total_hits + total_misses > 0:
+            print "  %-24s %5i hits %5i misses %5.1f%%" % ("total", total_hits,
+                total_misses, (100.0 * total_hits) / (total_hits + total_misses))
     
-    elif token == "while":
+    def print_tail_call_stats(self):
     
-        loop_address = len(generator.code)
+        print "Tail calls replaced:"
+        total = 0
+        for name, calls in self.tail_calls_replaced:
+            print "  %-24s %5i" % (name, calls)
+            total += calls
         
-        if parse_expression(stream):
-            debug_print("expression")
-            
-            if current_size != 1:
-                raise SyntaxError, "Invalid condition type at line %i." % tokeniser.line
-            
-            # Insert a placeholder branch instruction.
-            address = generator.generate_while()
-            
-            if parse_body(stream):
-                debug_print("while")
-                # Generate a branch to the condition code.
-                generator.generate_branch(loop_address)
-                # Fill in the branch offset.
-                generator.generate_target(address)
-                return True
+        print "  %i calls replaced with jumps." % total
+    
+    def print_inlining_stats(self):
+    
+        print "Calls inlined:"
+        for caller, name, size, saved in self.inlined:
+            if caller is None:
+                caller = "(main program)"
+            print "  %-24s %-24s %5i bytes %3i dispatches saved" % (
+                caller, name, size, saved)
         
-        raise SyntaxError, "Invalid while structure at line %i." % tokeniser.line
+        print "  %i calls inlined." % len(self.inlined)
     
-    put_tokens(top)
-    return False
-
-def parse_dedent(stream):
-
-    top = len(used)
-    while True:
+    def print_elimination_stats(self):
     
-        token = get_token(stream)
-        if token == tokeniser.newline_token:
-            pass
-        elif token == tokeniser.dedent_token:
-            break
-        else:
-            put_tokens(top)
-            return False
+        print "Unused functions removed:"
+        saved = 0
+        for function, size in self.removed_functions:
+            print "  %-24s %5i bytes" % (function[0], size)
+            saved += size
+        
+        print "  %i bytes saved." % saved
     
-    return True
-
-def parse_definition(stream):
-
-    '<definition> = "def" <name> (<var name> "(" <var type> ")")+ <body>'
+    def print_fold_stats(self):
     
-    global in_function
+        print "Constant folding removed %i opcodes." % self.folded
     
-    top = len(used)
-    token = get_token(stream)
+    def print_strength_stats(self):
     
-    # Record the start of the generated code.
-    code_start = len(generator.code)
+        print "Strength reduction replaced %i operations, saving about %i cycles." % self.reduced
     
-    if token == "def":
+    def print_narrowing_stats(self):
     
-        # Clear the list of local variables.
-        local_variables[:] = []
-        
-        token = get_token(stream)
-        if not is_function_name(token):
-            raise SyntaxError, "Invalid function name '%s' at line %i." % (
-                token, tokeniser.line)
-        
-        function_name = token
-        parameters = []
+        print "Range analysis narrowed %i multi-byte operations." % self.narrowed
+    
+    def print_hoisting_stats(self):
+    
+        print "Loop-invariant expressions hoisted:"
+        total = 0
+        for name, number, expressions in self.hoisted:
+            for expression in expressions:
+                names = map(lambda instruction:
+                    superinstructions.opcode_names[instruction[0]], expression)
+                print "  %-24s loop %-3i %s" % (name, number, " ".join(names))
+            total += len(expressions)
         
-        # Read the parameters, appending the names and types to the list of
-        # local variables.
-        while True:
+        print "  %i expressions hoisted from %i loops." % (total, len(self.hoisted))
+    
+    def print_reuse_stats(self):
+    
+        print "Values reused:"
+        total = 0
+        for name, reused in self.reused:
+            print "  %-24s %5i" % (name, reused)
+            total += reused
         
-            token = get_token(stream)
-            if token == tokeniser.newline_token:
-                break
-            
-            elif not is_variable(token):
-                raise SyntaxError, "Invalid parameter name '%s' at line %i." % (
-                    token, tokeniser.line)
-            
-            name = token
-            token = get_token(stream)
-            if token != tokeniser.arguments_begin_token:
-                raise SyntaxError, "Expected '(' after parameter name '%s' at line %i." % (
-                    name, tokeniser.line)
-            
-            type_token = get_token(stream)
-            if not is_type(type_token):
-                raise SyntaxError, "Expected type after parameter name '%s' at line %i." % (
-                    name, tokeniser.line)
-            
-            token = get_token(stream)
-            if token != tokeniser.arguments_end_token:
-                raise SyntaxError, "Expected ')' after type '%s' at line %i." % (
-                    type_token, tokeniser.line)
-            
-            local_variables.append((name, types[type_token],
-                                    array_types.get(type_token, types[type_token]),
-                                    type_token in array_types))
-            parameters.append((name, types[type_token],
-                               array_types.get(type_token, types[type_token]),
-                               type_token in array_types))
-        
-        # Write code to handle entry into the function, passing a placeholder
-        # value for the space required for local variables.
-        total_param_size = total_variable_size(parameters)
-        enter_address = len(generator.code)
-        generator.generate_enter_frame(total_param_size, 0)
+        print "  %i values reused." % total
+    
+    def print_peephole_stats(self):
+    
+        print "Peephole rules:"
+        names = peephole.rule_names()
+        width = max(map(len, names))
+        for name in names:
+            if name in self.peephole_stats:
+                print "  %-*s %5i" % (width, name, self.peephole_stats[name])
+            else:
+                print "  %-*s disabled" % (width, name)
+    
+    def print_superinstruction_stats(self):
+    
+        print "Superinstructions:"
+        saved = 0
+        for opcode, sequence in sorted(self.fused.items()):
+            uses = self.fused_uses[opcode]
+            print "  %5i uses  %s" % (uses, superinstructions.routine_name(sequence))
+            saved += uses * (len(sequence) - 1)
         
-        # Tentatively add the function to the list of definitions with the
-        # format:
-        # <name> <parameters> <local variables> <address> <return size> <return array>
-        functions.append([function_name, parameters, local_variables[:],
-                          generator.base_address + enter_address, 0, False])
+        print "  %i dispatches removed from the code." % saved
+    
+    def print_tokens(self):
+    
+        used_str = " ".join(map(repr, self.tokens[:self.position]))
+        print used_str, " ".join(map(repr, self.tokens[self.position:]))
+        print " "*len(used_str) + "^"
+    
+    # Deferred compilation of function definitions
+    
+    def scan_definition(self, stream):
+    
+        # Read the tokens of a function definition without compiling it,
+        # recording the line number of each token for use in error messages.
+        top = self.mark()
+        token = self.get_token(stream)
         
-        # Indicate that we are parsing a function and reset the default return
-        # size.
-        in_function = True
+        if token != "def":
+            self.rewind(top)
+            return False
         
-        if not parse_body(stream):
-            raise SyntaxError, "Invalid function definition at line %i." % tokeniser.line
+        tokens = [(token, stream.line)]
+        names = set()
+        depth = 0
         
-        in_function = False
+        while True:
         
-        # The code to handle the exit from the function follows the function
-        # body. Return calls should be branches to here.
+            token = self.get_token(stream)
+            tokens.append((token, stream.line))
+            names.add(token)
+            
+            if token == tokeniser.indent_token:
+                depth += 1
+            elif token == tokeniser.dedent_token:
+                depth -= 1
+                if depth <= 0:
+                    break
+            elif token == tokeniser.eof_token:
+                break
+            elif depth == 0 and token == tokeniser.newline_token:
+                if self.peek_token(stream) not in (tokeniser.indent_token,
+                                                   tokeniser.newline_token):
+                    break
         
-        generator.fix_returns(code_start)
+        if depth != 0 or token != tokeniser.dedent_token:
+            # Leave definitions without a well-formed body to be compiled in
+            # turn so that errors are reported in the usual way.
+            self.rewind(top)
+            self.compile_definitions()
+            return False
         
-        # Write code to handle exit from the function.
+        self.definitions.append((tokens, names))
+        return True
+    
+    def compile_definitions(self):
+    
+        # Compile the bodies of the function definitions read so far. Each
+        # definition depends on the earlier ones whose names it uses, and those
+        # that use the global keyword depend on all the definitions before them
+        # and are dependencies of all those after them. Definitions are compiled
+        # in waves, each containing those whose dependencies have already been
+        # compiled, then their code is appended in the order they were read.
         
-        # Note that the stack at this point will contain the following:
-        # <local vars> <return value> <parent frame addr> <args> <local vars> <value>
-        #                                                ^
-        #                                       frame base address
-        # We will recover the parent frame and copy the value from the top of the
-        # child frame to the top of the parent frame, leaving the following:
-        # <local vars> <return value>
+        definitions = self.definitions
+        if not definitions:
+            return
         
-        total_var_size = total_variable_size(local_variables) - total_param_size
+        self.definitions = []
         
-        # The return details are filled in by the parse_return function.
-        return_size, return_array = functions[-1][-2:]
+        first = {}
+        levels = []
+        dependencies = []
+        barrier = None
         
-        generator.generate_function_tidy(total_var_size + total_param_size,
-                                         return_size)
+        i = 0
+        for tokens, names in definitions:
         
-        generator.generate_return()
+            if "global" in names:
+                depends = range(i)
+            else:
+                depends = []
+                for name in names:
+                    if name in first:
+                        depends.append(first[name])
+                if barrier is not None:
+                    depends.append(barrier)
+                
+                depends = list(set(depends))
+                depends.sort()
+            
+            if "global" in names:
+                barrier = i
+            
+            if not self.functions.find(tokens[1][0]):
+                first.setdefault(tokens[1][0], i)
+            
+            level = 0
+            for j in depends:
+                level = max(level, levels[j] + 1)
+            
+            levels.append(level)
+            dependencies.append(depends)
+            i += 1
         
-        # Fill in the size of the local variables. We can only do this after
-        # the body has been generated because we don't know the sizes of the
-        # types beforehand.
-        generator.code[enter_address + 3] = total_var_size
+        settings = (self.include_dir, self.parsing and self.parsing.__name__,
+                    self.types, self.debug, self.packrat)
         
-        # Clear the list of local variables.
-        local_variables[:] = []
+        if self.jobs > 1:
+            pool = multiprocessing.Pool(self.jobs)
+            map_function = pool.map
+        else:
+            pool = None
+            map_function = map
         
-        return True
-    
-    else:
-        put_tokens(top)
-        generator.discard_code(code_start)
-        return False
-
-def parse_eof(stream):
-
-    top = len(used)
-    token = get_token(stream)
-    
-    if token == tokeniser.eof_token:
-        return True
-    else:
-        put_tokens(top)
-        return False
-
-unary_operators = ("not", "-", "~")
-
-def parse_expression(stream):
-
-    '<expression> = ["not" | "-" | "~"] ["("] <operand> [<operator> <operand>]+ [")"]'
-    
-    top = len(used)
-    token = get_token(stream)
+        results = [None] * len(definitions)
+        error = len(definitions)
+        
+        try:
+            level = 0
+            while level <= max(levels):
+            
+                # Only compile the definitions before the first one that could
+                # not be compiled.
+                wave = []
+                for i in range(error):
+                    if levels[i] == level:
+                        wave.append(i)
+                
+                arguments = []
+                for i in wave:
+                
+                    functions = self.functions.entries[:]
+                    for j in dependencies[i]:
+                        functions.append(results[j][1])
+                    
+                    # Definitions after a barrier see the global variables it
+                    # defines.
+                    global_variables = self.global_variables.entries[:]
+                    for j in range(i):
+                        if results[j] and "global" in definitions[j][1]:
+                            global_variables += results[j][2]
+                    
+                    arguments.append((definitions[i][0], functions,
+                                      global_variables, settings))
+                
+                for i, result in zip(wave, map_function(compile_definition, arguments)):
+                    results[i] = result
+                    if isinstance(result, SyntaxError):
+                        error = min(error, i)
+                
+                level += 1
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        
+        if error < len(definitions):
+            raise results[error]
+        
+        # Append the code for each function and record its definition.
+        for code, function, new_globals, sizes, stats in results:
+        
+            self.functions.append(function)
+            self.generator.code += code
+            
+            for entry in new_globals:
+                self.global_variables.append(entry)
+            
+            self.current_size, self.current_element_size, self.current_array = sizes
+            
+            for name, values in stats.items():
+                totals = self.packrat_stats.setdefault(name, [0, 0, 0])
+                totals[:] = map(lambda x, y: x + y, totals, values)
+        
+        self.packrat_cache.clear()
     
-    # Find an optional unary operator.
-    if token in unary_operators:
-        unary_token = token
-    else:
-        # No optional operator was found so we put the token back in the stream
-        # so that the caller can continue.
-        put_tokens(top)
-        unary_token = None
+    # Object modules for included files
     
-    # Get the following token if we encountered a unary operator, or the token
-    # pushed back into the stream if not.
-    top = len(used)
-    token = get_token(stream)
+    def include_module(self, f, stream):
     
-    if token == "(":
-        if not parse_expression(stream):
-            raise SyntaxError, "Invalid expression at line %i." % tokeniser.line
+        # Link the object module for the file if it has already been compiled
+        # and can be reused here, otherwise compile the file and store its
+        # object module in the cache directory.
+        text = f.read()
+        f.close()
         
-        token = get_token(stream)
-        if token != ")":
-            raise SyntaxError, "Expected closing ')' at line %i." % tokeniser.line
+        # Deferred definitions are compiled first so that the module is
+        # linked after them.
+        self.compile_definitions()
         
-    else:
-        # Just look for an operand.
-        put_tokens(top)
-        if not parse_operand_value(stream):
-            return False
-    
-    while True:
+        key = objects.module_key(text, version, self.types)
+        file_name = os.path.join(self.cache_dir, key + ".obj")
+        
+        enclosing = self.module, self.lookups
+        self.module = self.lookups = None
+        
+        module = objects.load(file_name)
+        if module and self.link_module(module, stream):
+            self.module, self.lookups = enclosing
+            return
+        
+        self.module = objects.ObjectModule()
+        
+        self.source = tokeniser.Tokeniser(StringIO.StringIO(text), stream.buffered)
+        self.parse_program_definitions(self.source)
+        self.source = stream
+        
+        if self.module.cacheable:
+            self.module.save(file_name)
+        
+        self.module, self.lookups = enclosing
     
-        if not parse_operation(stream):
-            # Not an operator, so back out of the operation, but allow the
-            # expression. The operator function should have pushed tokens back
-            # on the stack.
-            break
+    def record_definition(self, code_start, globals_defined):
     
-    # Apply the deferred unary operator.
-    if unary_token == tokeniser.logical_not_token:
-        if current_size != 1:
-            raise SyntaxError, "Invalid size for logical not operation at line %i." % tokeniser.line
-        generator.generate_logical_not()
-        return True
+        # Record the code for the function just defined in the object module
+        # for the file being compiled.
+        code = self.generator.code[code_start:]
+        name, parameters, variables, address, rsize, return_array = self.functions[-1]
+        
+        self.module.add_function(code,
+            (name, parameters, variables, rsize, return_array), self.lookups,
+            (self.current_size, self.current_element_size, self.current_array))
+        
+        if len(self.global_variables) != globals_defined:
+            self.module.cacheable = False
+        
+        self.lookups = None
     
-    elif unary_token == tokeniser.minus_token:
-        generator.generate_minus(current_size)
-        return True
+    def link_module(self, module, stream):
     
-    elif unary_token == "~":
-        generator.generate_bitwise_not(current_size)
+        # Append the code for the functions in the module, checking that the
+        # names they refer to have the same definitions as when they were
+        # compiled. If not, undo any changes and return False.
+        code_length = len(self.generator.code)
+        functions_length = len(self.functions)
+        globals_length = len(self.global_variables)
+        
+        for item in module.items:
+        
+            if item[0] == "include":
+                self.include_file(item[1], stream)
+                continue
+            
+            code, definition, lookups, sizes = item[1:]
+            name, parameters, variables, rsize, return_array = definition
+            
+            # The code for each function begins with the label for its address.
+            self.functions.append([name, parameters, variables, code[0][1],
+                                   rsize, return_array])
+            
+            for (kind, token), value in lookups.items():
+            
+                if kind == "function":
+                    current = self.lookup_function(token)
+                else:
+                    current = self.global_variables.find(token)
+                
+                if current != value:
+                    self.generator.discard_code(code_length)
+                    self.functions.truncate(functions_length)
+                    self.global_variables.truncate(globals_length)
+                    self.packrat_cache.clear()
+                    return False
+            
+            self.generator.code += code
+            self.current_size, self.current_element_size, self.current_array = sizes
+        
+        self.packrat_cache.clear()
         return True
     
-    return True
-
-def parse_function_call(stream):
-
-    '<function call> = <name> "(" [<argument>+] ")"'
-    
-    global current_size, current_element_size, current_array
-    
-    top = len(used)
-    token = get_token(stream)
-    
-    index = find_function(token)
-    if index == -1:
-        put_tokens(top)
-        return False
+    # Parsing functions
     
-    token = get_token(stream)
-    if token != tokeniser.arguments_begin_token:
-        raise SyntaxError, "Function arguments must follow '(' at line %i.\n" % tokeniser.line
+    @memoize
+    def parse_array_index(self, stream):
     
-    function_name, parameters, variables, address, rsize, return_array = functions[index]
-    
-    # Generate code to record the address of the current frame in a frame base
-    # address register, pushing the previous frame base address onto the stack
-    # so that it can be recovered later.
-    #    <local vars>
-    # -> <local vars> <parent frame addr>
-    #   ^-------------/
-    
-    generator.generate_push_parent_frame()
-    
-    # Parse the arguments corresponding to the function parameters. The result
-    # at run-time will be a series of values stored on the stack.
-    #    <local vars> <parent frame addr>
-    # -> <local vars> <parent frame addr> <arguments>
-    
-    total_param_size = total_variable_size(parameters)
-    
-    i = 0
-    while i < len(parameters):
-    
-        name, size, element_size, array = parameters[i]
+        '<array index> = "[" <expression> "]"'
         
-        if not parse_expression(stream):
-            raise SyntaxError, "Invalid argument to function '%s' at line %i.\n" % (function_name, tokeniser.line)
+        top = self.mark()
+        token = self.get_token(stream)
         
-        if i < len(parameters) - 1:
-            token = get_token(stream)
-            if token != ",":
-                raise SyntaxError, "Expected a comma after function argument '%s' at line %i.\n" % (name, tokeniser.line)
+        if token != tokeniser.index_begin_token:
+            self.rewind(top)
+            return False
         
-        if current_size != size:
-            raise SyntaxError, "Incompatible types in argument to function '%s' at line %i.\n" % (function_name, tokeniser.line)
+        if not self.parse_expression(stream):
+            raise SyntaxError, "Invalid index value at line %i." % stream.line
         
-        i += 1
-    
-    token = get_token(stream)
-    if token != tokeniser.arguments_end_token:
-        raise SyntaxError, "Function arguments must be terminated with ')' at line %i.\n" % tokeniser.line
-    
-    # Use the previously stored information about the local variables to
-    # determine how much space should be allocated on the stack.
-    #    <local vars> <parent frame addr> <args>
-    # -> <local vars> <parent frame addr> <args> <local vars>
-    
-    total_var_size = total_variable_size(variables) - total_param_size
-    
-    debug_print("function call", function_name)
-    
-    # Call the function then restore the address of the frame for the calling
-    # scope. Pop the local variables and arguments from the stack, copying any
-    # return value down in memory to the new stack top.
-    #    <local vars> <parent frame addr> <args> <local vars> <return value>
-    # -> <local vars> <return value>
-    
-    generator.generate_function_call(address)
-    
-    # Record the size of the return value to ensure that it is assigned or
-    # discarded as necessary.
-    current_size = current_element_size = rsize
-    current_array = return_array
-    
-    return True
-
-def parse_include(stream):
-
-    # include <string>
-    
-    top = len(used)
-    token = get_token(stream)
-    
-    if token != "include":
-        put_tokens(top)
-        return False
-    
-    token = get_token(stream)
-    
-    if not is_string(token):
-        put_tokens(top)
-        return False
-    
-    if not parse_separator(stream):
-        put_tokens(top)
-        return False
-    
-    # Read and tokenise the contents of the file.
-    file_name = decode_string(token)
+        token = self.get_token(stream)
+        
+        if token != tokeniser.index_end_token:
+            raise SyntaxError, "Expected ']' at line %i." % stream.line
+        
+        self.debug_print("array index")
+        return True
     
-    if file_name.startswith("<") and file_name.endswith(">"):
-        file_name = os.path.join(include_dir, file_name[1:-1])
+    def parse_body(self, stream):
     
-    try:
-        f = open(file_name)
-    except IOError:
-        raise IOError("Failed to include file '%s' at line %i." % (
-            file_name, tokeniser.line))
+        '<body> = <indent> (<control> | <return> | <statement>)+ <dedent>'
+        
+        if not self.parse_indent(stream):
+            return False
+        
+        has_body = False
+        while True:
+        
+            if self.parse_control(stream):
+                self.debug_print("control")
+            elif self.in_function and self.parse_return(stream):
+                self.debug_print("return")
+            elif self.parse_statement(stream):
+                self.debug_print("statement")
+            elif self.parse_separator(stream):
+                # Handle blank lines.
+                self.debug_print("separator (blank)")
+            elif self.parse_dedent(stream):
+                break
+            else:
+                return False
+            
+            has_body = True
+        
+        if not has_body:
+            return False
+        
+        self.debug_print("body")
+        return True
     
-    state = tokeniser.save_state()
-    print "Including", file_name
-    parse_program_definitions(f)
-    tokeniser.restore_state(state)
+    # This function tries to parse tokens as a built-in call.
+    # Currently, it only supports the _addr, _load and _store functions.
     
-    return True    
-
-def parse_indent(stream):
-
-    top = len(used)
-    while True:
+    @memoize
+    def parse_builtin_call(self, stream):
     
-        token = get_token(stream)
-        if token == tokeniser.newline_token:
-            pass
-        elif token == tokeniser.indent_token:
-            break
+        if self.parse_builtin_call_addr(stream):
+            return True
+        elif self.parse_builtin_call_load(stream):
+            return True
+        elif self.parse_builtin_call_store(stream):
+            return True
         else:
-            put_tokens(top)
             return False
     
-    return True
-
-def parse_newline(stream):
-
-    top = len(used)
-    token = get_token(stream)
+    def parse_builtin_call_addr(self, stream):
     
-    if token == tokeniser.newline_token:
-        return True
-    else:
-        put_tokens(top)
-        return False
-
-def parse_operand_value(stream):
-
-    '<operand value> = <value> | <variable> | <function call> | <system call>'
-    
-    if parse_value(stream):
-        return True
-    elif parse_variable(stream):
-        return True
-    elif parse_function_call(stream):
-        return True
-    elif parse_system_call(stream):
-        return True
-    elif parse_builtin_call(stream):
+        '<built-in _addr> = "_addr" "(" <variable> ")"'
+        
+        top = self.mark()
+        token = self.get_token(stream)
+        
+        if token != "_addr":
+            self.rewind(top)
+            return False
+        
+        token = self.get_token(stream)
+        if token != tokeniser.arguments_begin_token:
+            raise SyntaxError, "Arguments must follow '(' at line %i.\n" % stream.line
+        
+        var_token = self.get_token(stream)
+        if not is_variable(var_token):
+            raise SyntaxError, "Argument must be a variable at line %i.\n" % stream.line
+        
+        variable = self.find_local_variable(var_token)
+        if variable:
+            offset, size, element_size, array = variable
+        
+        token = self.get_token(stream)
+        if token != tokeniser.arguments_end_token:
+            raise SyntaxError, "Arguments must be terminated with ')' at line %i.\n" % stream.line
+        
+        self.debug_print("addr call")
+        
+        self.generator.generate_get_variable_address(offset)
+        
+        # Set the size of the return value to ensure that it is assigned or
+        # discarded as necessary.
+        self.current_size = self.current_element_size = opcodes.address_size
+        self.current_array = False
+        
         return True
-    else:
-        return False
-
-operators = ("==", "!=", "<", ">", "+", "-", "*", "/", "and", "or", "&", "|", "^", "<<", ">>")
-asymmetric_operators = ("<<", ">>", "&")
-
-def parse_operation(stream):
-
-    '<operation> = "==" | "!=" | "<" | ">" | "+" | "-" | "*" | "/" | "and" | "or" | "&" | "|" | "^" | "<<" | ">>" <operand>'
-    
-    global current_size, current_element_size, current_array
-    
-    top = len(used)
-    token = get_token(stream)
-    
-    if token not in operators:
-        put_tokens(top)
-        return False
     
-    if current_size == 0:
-        raise SyntaxError, "Operand 1 has zero size at line %i." % tokeniser.line
+    def parse_builtin_call_load(self, stream):
     
-    size1 = current_size
-    
-    if not parse_expression(stream):
-        # Not an expression, but one was expected, so report an error.
-        raise SyntaxError, "Incomplete operation at line %i." % tokeniser.line
-    
-    if current_size == 0:
-        raise SyntaxError, "Operand 2 has zero size at line %i." % tokeniser.line
-    
-    if token not in asymmetric_operators and current_size != size1:
-        raise SyntaxError, "Sizes of operands do not match at line %i." % tokeniser.line
-    
-    if token == "==":
-        debug_print("equals", token, current_size)
-        generator.generate_equals(current_size)
-        current_size = current_element_size = 1
-        current_array = False
-    
-    elif token == "!=":
-        debug_print("not equals", token, current_size)
-        generator.generate_not_equals(current_size)
-        current_size = current_element_size = 1
-        current_array = False
-    
-    elif token == "<":
-        debug_print("less than", token, current_size)
-        generator.generate_less_than(current_size)
-        current_size = current_element_size = 1
-        current_array = False
-    
-    elif token == ">":
-        debug_print("greater than", token, current_size)
-        generator.generate_greater_than(current_size)
-        current_size = current_element_size = 1
-        current_array = False
-    
-    elif token == "+":
-        debug_print("add", token, current_size)
-        generator.generate_add(current_size)
-    
-    elif token == "-":
-        debug_print("subtract", token, current_size)
-        generator.generate_subtract(current_size)
-    
-    elif token == "*":
-        debug_print("multiply", token, current_size)
-        generator.generate_multiply(current_size)
-    
-    elif token == "/":
-        debug_print("divide", token, current_size)
-        generator.generate_divide(current_size)
+        '<built-in _store> = "_load" "(" <value expression>, <address expression> ")"'
+        
+        top = self.mark()
+        token = self.get_token(stream)
+        
+        if token != "_load":
+            self.rewind(top)
+            return False
+        
+        token = self.get_token(stream)
+        if token != tokeniser.arguments_begin_token:
+            raise SyntaxError, "Arguments must follow '(' at line %i.\n" % stream.line
+        
+        # Parse the size.
+        token = self.get_token(stream)
+        if not is_number(token):
+            raise SyntaxError, "Argument must be a constant integer at line %i.\n" % stream.line
+        
+        base = get_number_base(token)
+        size = int(token, base)
+        
+        token = self.get_token(stream)
+        if token != ",":
+            raise SyntaxError("Expected a comma before the address at line %i.\n" % stream.line)
+        
+        # Parse the address.
+        if not self.parse_expression(stream):
+            raise SyntaxError, "Argument must be a valid expression at line %i.\n" % stream.line
+        
+        if self.current_size != opcodes.address_size:
+            raise SyntaxError, "Address argument must have the size of an address at line %i.\n" % stream.line
+        
+        token = self.get_token(stream)
+        if token != tokeniser.arguments_end_token:
+            raise SyntaxError, "Arguments must be terminated with ')' at line %i.\n" % stream.line
+        
+        self.debug_print("load call")
+        
+        self.generator.generate_load_memory_value(size)
+        
+        # Set the size of the return value to ensure that it is assigned or
+        # discarded as necessary.
+        self.current_size = self.current_element_size = size
+        self.current_array = False
+        
+        return True
     
-    elif token == "and":
+    def parse_builtin_call_store(self, stream):
     
-        if current_size != 1:
-            raise SyntaxError, "Operands have an invalid size for logical and operation at line %i." % tokeniser.line
+        '<built-in _store> = "_store" "(" <value expression>, <address expression> ")"'
+        
+        top = self.mark()
+        token = self.get_token(stream)
+        
+        if token != "_store":
+            self.rewind(top)
+            return False
+        
+        token = self.get_token(stream)
+        if token != tokeniser.arguments_begin_token:
+            raise SyntaxError, "Arguments must follow '(' at line %i.\n" % stream.line
+        
+        # Parse the value.
+        if not self.parse_expression(stream):
+            raise SyntaxError, "Argument must be a valid expression at line %i.\n" % stream.line
+        
+        size = self.current_size
+        
+        token = self.get_token(stream)
+        if token != ",":
+            raise SyntaxError("Expected a comma before the address at line %i.\n" % stream.line)
+        
+        # Parse the address.
+        if not self.parse_expression(stream):
+            raise SyntaxError, "Argument must be a valid expression at line %i.\n" % stream.line
+        
+        if self.current_size != opcodes.address_size:
+            raise SyntaxError, "Address argument must have the size of an address at line %i.\n" % stream.line
+        
+        token = self.get_token(stream)
+        if token != tokeniser.arguments_end_token:
+            raise SyntaxError, "Arguments must be terminated with ')' at line %i.\n" % stream.line
+        
+        self.debug_print("store call")
+        
+        self.generator.generate_store_memory_value(size)
         
-        debug_print("and", token, current_size)
-        generator.generate_logical_and()
-        current_size = current_element_size = 1
-        current_array = False
+        # Set the size of the return value to ensure that it is assigned or
+        # discarded as necessary.
+        self.current_size = self.current_element_size = 0
+        self.current_array = False
+        
+        return True
     
-    elif token == "or":
+    @memoize_failures
+    def parse_control(self, stream):
     
-        if current_size != 1:
-            raise SyntaxError, "Operands have an invalid size for logical or operation at line %i." % tokeniser.line
+        '''<control> = ("if" <expression> <body> ("elif" <expression> <body>)* ["else" <body>]) |
+                      ("while" <expression> <body>) |
+                      ("for" <name> "in" "range" "(" [<expression> ","] <expression> ")" <body>) |
+                      ("switch" <expression> <indent> ("case" <number> <body>)+ ["else" <body>] <dedent>)'''
+        
+        top = self.mark()
+        token = self.get_token(stream)
+        
+        if token == "if":
+            if self.parse_expression(stream):
+                self.debug_print("expression")
+                
+                if self.current_size != 1:
+                    raise SyntaxError, "Invalid condition type at line %i." % stream.line
+                
+                # Insert a placeholder branch instruction.
+                if_address = self.generator.generate_if()
+                
+                if not self.parse_body(stream):
+                    raise SyntaxError, "Invalid if body at line %i." % stream.line
+                
+                self.debug_print("if")
+                
+                # Record the placeholder branches from the end of each body
+                # to the end of the structure.
+                exit_addresses = []
+                
+                while True:
+                
+                    top = self.mark()
+                    token = self.get_token(stream)
+                    
+                    if token == "elif":
+                    
+                        # Add a placeholder branch to the previous body.
+                        exit_addresses.append(self.generator.generate_else())
+                        
+                        # Fill in the branch offset for the previous condition.
+                        self.generator.generate_target(if_address)
+                        
+                        if not self.parse_expression(stream):
+                            raise SyntaxError, "Invalid elif structure at line %i." % stream.line
+                        
+                        if self.current_size != 1:
+                            raise SyntaxError, "Invalid condition type at line %i." % stream.line
+                        
+                        if_address = self.generator.generate_if()
+                        
+                        if not self.parse_body(stream):
+                            raise SyntaxError, "Invalid elif body at line %i." % stream.line
+                        
+                        self.debug_print("elif")
+                    
+                    elif token == "else":
+                    
+                        # Add a placeholder branch to the previous body.
+                        exit_addresses.append(self.generator.generate_else())
+                        
+                        # Fill in the branch offset for the previous condition.
+                        self.generator.generate_target(if_address)
+                        
+                        if not self.parse_body(stream):
+                            raise SyntaxError, "Invalid else body at line %i." % stream.line
+                        
+                        break
+                    
+                    else:
+                        # Put the token back in the queue.
+                        self.rewind(top)
+                        
+                        # Fill in the branch offset for the last condition.
+                        self.generator.generate_target(if_address)
+                        break
+                
+                # Fill in the branch offsets for the bodies.
+                for address in exit_addresses:
+                    self.generator.generate_target(address)
+                
+                return True
+            
+            raise SyntaxError, "Invalid if structure at line %i." % stream.line
+        
+        elif token == "while":
+        
+            loop_label = self.generator.generate_label()
+            
+            if self.parse_expression(stream):
+                self.debug_print("expression")
+                
+                if self.current_size != 1:
+                    raise SyntaxError, "Invalid condition type at line %i." % stream.line
+                
+                # Insert a placeholder branch instruction.
+                address = self.generator.generate_while()
+                
+                if self.parse_body(stream):
+                    self.debug_print("while")
+                    # Generate a branch to the condition code.
+                    self.generator.generate_branch(loop_label)
+                    # Fill in the branch offset.
+                    self.generator.generate_target(address)
+                    return True
+            
+            raise SyntaxError, "Invalid while structure at line %i." % stream.line
+        
+        elif token == "for":
+        
+            var_token = self.get_token(stream)
+            if not is_variable(var_token) or self.get_token(stream) != "in" or \
+               self.get_token(stream) != "range" or \
+               self.get_token(stream) != tokeniser.arguments_begin_token:
+                raise SyntaxError, "Invalid for structure at line %i." % stream.line
+            
+            if not self.parse_expression(stream):
+                raise SyntaxError, "Invalid range at line %i." % stream.line
+            
+            # If only one value is given, it is the limit and the loop starts
+            # from zero.
+            start_size = self.current_size
+            start_array = self.current_array
+            has_start = self.peek_token(stream) == ","
+            
+            if has_start:
+                self.get_token(stream)
+                if not self.parse_expression(stream):
+                    raise SyntaxError, "Invalid range at line %i." % stream.line
+            
+            if self.get_token(stream) != tokeniser.arguments_end_token:
+                raise SyntaxError, "Expected ')' after range at line %i." % stream.line
+            
+            size = self.current_size
+            if start_array or self.current_array or size == 0 or \
+               size != start_size:
+                raise SyntaxError, "Invalid range type at line %i." % stream.line
+            
+            # The counter is a local variable in functions and a global
+            # variable in the main program. The limit is held in a variable
+            # that cannot be referred to by name.
+            if self.in_function:
+                variables = self.local_variables
+            else:
+                variables = self.global_variables
+            
+            variable = variables.find(var_token)
+            if variable:
+                offset, var_size, element_size, array = variable
+                if array or var_size != size:
+                    raise SyntaxError, "Type mismatch in for loop at line %i." % stream.line
+            else:
+                variables.append((var_token, size, size, False))
+                offset = variables.find(var_token)[0]
+            
+            limit_token = "range %i" % len(variables)
+            variables.append((limit_token, size, size, False))
+            limit = variables.find(limit_token)[0]
+            self.packrat_cache.clear()
+            
+            if self.in_function:
+                self.generator.generate_assign_local(limit, size)
+                if not has_start:
+                    self.generator.generate_number("0", size, 10)
+                self.generator.generate_assign_local(offset, size)
+                
+                # Only enter the loop if the counter starts below the limit,
+                # incrementing it and comparing it with the limit in a single
+                # instruction after each iteration.
+                self.generator.generate_load_local(offset, size)
+                self.generator.generate_load_local(limit, size)
+                self.generator.generate_less_than(size)
+                address = self.generator.generate_while()
+                
+                loop_label = self.generator.generate_label()
+                if not self.parse_body(stream):
+                    raise SyntaxError, "Invalid for structure at line %i." % stream.line
+                
+                self.generator.generate_loop_local(offset, limit, size, loop_label)
+            
+            else:
+                self.generator.generate_assign_global(limit, size)
+                if not has_start:
+                    self.generator.generate_number("0", size, 10)
+                self.generator.generate_assign_global(offset, size)
+                
+                loop_label = self.generator.generate_label()
+                self.generator.generate_load_global(offset, size)
+                self.generator.generate_load_global(limit, size)
+                self.generator.generate_less_than(size)
+                address = self.generator.generate_while()
+                
+                if not self.parse_body(stream):
+                    raise SyntaxError, "Invalid for structure at line %i." % stream.line
+                
+                self.generator.generate_load_global(offset, size)
+                self.generator.generate_number("1", size, 10)
+                self.generator.generate_add(size)
+                self.generator.generate_assign_global(offset, size)
+                self.generator.generate_branch(loop_label)
+            
+            self.generator.generate_target(address)
+            self.debug_print("for")
+            return True
         
-        debug_print("or", token, current_size)
-        generator.generate_logical_or()
-        current_size = current_element_size = 1
-        current_array = False
+        elif token == "switch":
+        
+            if not self.parse_expression(stream):
+                raise SyntaxError, "Invalid switch structure at line %i." % stream.line
+            
+            self.debug_print("expression")
+            
+            if self.current_size != 1:
+                raise SyntaxError, "Invalid switch value type at line %i." % stream.line
+            
+            # Insert a placeholder instruction to test the value.
+            switch_address = self.generator.generate_switch()
+            
+            if not self.parse_indent(stream):
+                raise SyntaxError, "Invalid switch structure at line %i." % stream.line
+            
+            cases = []
+            default_label = None
+            exit_addresses = []
+            
+            while not self.parse_dedent(stream):
+            
+                if self.parse_newline(stream):
+                    # Handle blank lines.
+                    continue
+                
+                token = self.get_token(stream)
+                
+                if token == "case" and default_label is None:
+                
+                    token = self.get_token(stream)
+                    if not is_number(token) or number_size(token) != 1:
+                        raise SyntaxError, "Invalid case value at line %i." % stream.line
+                    
+                    value = int(token, get_number_base(token)) & 0xff
+                    if value in map(lambda (value, label): value, cases):
+                        raise SyntaxError, "Repeated case value at line %i." % stream.line
+                    
+                    cases.append((value, self.generator.generate_label()))
+                    
+                    if not self.parse_body(stream):
+                        raise SyntaxError, "Invalid case body at line %i." % stream.line
+                    
+                    # Add a placeholder branch to the end of the structure.
+                    exit_addresses.append(self.generator.generate_else())
+                    self.debug_print("case")
+                
+                elif token == "else" and cases and default_label is None:
+                
+                    default_label = self.generator.generate_label()
+                    
+                    if not self.parse_body(stream):
+                        raise SyntaxError, "Invalid else body at line %i." % stream.line
+                
+                else:
+                    raise SyntaxError, "Invalid switch structure at line %i." % stream.line
+            
+            if not cases:
+                raise SyntaxError, "Invalid switch structure at line %i." % stream.line
+            
+            # Fill in the branch offsets for the cases.
+            for address in exit_addresses:
+                self.generator.generate_target(address)
+            
+            if default_label is None:
+                default_label = self.generator.generate_label()
+            
+            self.generator.generate_switch_cases(switch_address, cases,
+                                                 default_label)
+            self.debug_print("switch")
+            return True
+        
+        self.rewind(top)
+        return False
     
-    # The bitwise AND operation truncates the result to the size of the second
-    # operand.
+    @memoize_failures
+    def parse_dedent(self, stream):
     
-    elif token == "&":
+        top = self.mark()
+        while True:
+        
+            token = self.get_token(stream)
+            if token == tokeniser.newline_token:
+                pass
+            elif token == tokeniser.dedent_token:
+                break
+            else:
+                self.rewind(top)
+                return False
+        
+        return True
     
-        debug_print("&", token, current_size)
-        generator.generate_bitwise_and(size1, current_size)
+    @memoize_failures
+    def parse_definition(self, stream):
     
-    elif token == "|":
+        '<definition> = "def" <name> (<var name> "(" <var type> ")")+ <body>'
+        
+        top = self.mark()
+        token = self.get_token(stream)
+        
+        # Record the start of the generated code.
+        code_start = len(self.generator.code)
+        
+        if token == "def":
+        
+            # Clear the list of local variables and any cached parsing results
+            # that depend on them.
+            self.local_variables.clear()
+            self.packrat_cache.clear()
+            
+            token = self.get_token(stream)
+            if not is_function_name(token):
+                raise SyntaxError, "Invalid function name '%s' at line %i." % (
+                    token, stream.line)
+            
+            function_name = token
+            parameters = []
+            
+            # Read the parameters, appending the names and types to the list of
+            # local variables.
+            while True:
+            
+                token = self.get_token(stream)
+                if token == tokeniser.newline_token:
+                    break
+                
+                elif not is_variable(token):
+                    raise SyntaxError, "Invalid parameter name '%s' at line %i." % (
+                        token, stream.line)
+                
+                name = token
+                token = self.get_token(stream)
+                if token != tokeniser.arguments_begin_token:
+                    raise SyntaxError, "Expected '(' after parameter name '%s' at line %i." % (
+                        name, stream.line)
+                
+                type_token = self.get_token(stream)
+                if not self.is_type(type_token):
+                    raise SyntaxError, "Expected type after parameter name '%s' at line %i." % (
+                        name, stream.line)
+                
+                token = self.get_token(stream)
+                if token != tokeniser.arguments_end_token:
+                    raise SyntaxError, "Expected ')' after type '%s' at line %i." % (
+                        type_token, stream.line)
+                
+                self.local_variables.append((name, self.types[type_token],
+                                        array_types.get(type_token, self.types[type_token]),
+                                        type_token in array_types))
+                parameters.append((name, self.types[type_token],
+                                   array_types.get(type_token, self.types[type_token]),
+                                   type_token in array_types))
+            
+            # Write code to handle entry into the function, passing a placeholder
+            # value for the space required for local variables.
+            total_param_size = total_variable_size(parameters)
+            function_label = self.generator.generate_label()
+            enter_address = len(self.generator.code)
+            self.generator.generate_enter_frame(total_param_size, 0)
+            
+            # Tentatively add the function to the list of definitions with the
+            # format:
+            # <name> <parameters> <local variables> <address> <return size> <return array>
+            self.functions.append([function_name, parameters, self.local_variables.entries[:],
+                              function_label, 0, False])
+            self.packrat_cache.clear()
+            
+            # Indicate that we are parsing a function and reset the default return
+            # size.
+            self.in_function = True
+            
+            if not self.parse_body(stream):
+                raise SyntaxError, "Invalid function definition at line %i." % stream.line
+            
+            self.in_function = False
+            
+            # The code to handle the exit from the function follows the function
+            # body. Return calls should be branches to here.
+            
+            self.generator.fix_returns(code_start)
+            
+            # Write code to handle exit from the function.
+            
+            # Note that the stack at this point will contain the following:
+            # <local vars> <return value> <parent frame addr> <args> <local vars> <value>
+            #                                                ^
+            #                                       frame base address
+            # We will recover the parent frame and copy the value from the top of the
+            # child frame to the top of the parent frame, leaving the following:
+            # <local vars> <return value>
+            
+            total_var_size = self.local_variables.size - total_param_size
+            
+            # The return details are filled in by the parse_return function.
+            return_size, return_array = self.functions[-1][-2:]
+            
+            self.generator.generate_function_tidy(total_var_size + total_param_size,
+                                             return_size)
+            
+            self.generator.generate_return()
+            
+            # Fill in the size of the local variables. We can only do this after
+            # the body has been generated because we don't know the sizes of the
+            # types beforehand.
+            self.generator.code[enter_address + 1][1] = total_var_size
+            
+            # Clear the list of local variables.
+            self.local_variables.clear()
+            self.packrat_cache.clear()
+            
+            return True
+        
+        else:
+            self.rewind(top)
+            self.generator.discard_code(code_start)
+            return False
     
-        debug_print("|", token, current_size)
-        generator.generate_bitwise_or(size1, current_size)
+    @memoize_failures
+    def parse_eof(self, stream):
     
-    elif token == "^":
+        top = self.mark()
+        token = self.get_token(stream)
+        
+        if token == tokeniser.eof_token:
+            return True
+        else:
+            self.rewind(top)
+            return False
     
-        debug_print("^", token, current_size)
-        generator.generate_bitwise_eor(size1, current_size)
+    @memoize
+    def parse_expression(self, stream):
     
-    # The shift operators are also asymmetric, with the second operand
-    # typically being only a single byte, but the result is the same size as
-    # the first operand.
+        '<expression> = ["not" | "-" | "~"] ["("] <operand> [<operator> <operand>]+ [")"]'
+        
+        top = self.mark()
+        token = self.get_token(stream)
+        
+        # Find an optional unary operator.
+        if token in unary_operators:
+            unary_token = token
+        else:
+            # No optional operator was found so we put the token back in the stream
+            # so that the caller can continue.
+            self.rewind(top)
+            unary_token = None
+        
+        # Get the following token if we encountered a unary operator, or the token
+        # pushed back into the stream if not.
+        top = self.mark()
+        token = self.get_token(stream)
+        
+        if token == "(":
+            if not self.parse_expression(stream):
+                raise SyntaxError, "Invalid expression at line %i." % stream.line
+            
+            token = self.get_token(stream)
+            if token != ")":
+                raise SyntaxError, "Expected closing ')' at line %i." % stream.line
+        
+        else:
+            # Just look for an operand.
+            self.rewind(top)
+            if not self.parse_operand_value(stream):
+                return False
+        
+        while True:
+        
+            if not self.parse_operation(stream):
+                # Not an operator, so back out of the operation, but allow the
+                # expression. The operator function should have pushed tokens back
+                # on the stack.
+                break
+        
+        # Apply the deferred unary operator.
+        if unary_token == tokeniser.logical_not_token:
+            if self.current_size != 1:
+                raise SyntaxError, "Invalid size for logical not operation at line %i." % stream.line
+            self.generator.generate_logical_not()
+            return True
+        
+        elif unary_token == tokeniser.minus_token:
+            self.generator.generate_minus(self.current_size)
+            return True
+        
+        elif unary_token == "~":
+            self.generator.generate_bitwise_not(self.current_size)
+            return True
+        
+        return True
     
-    elif token == "<<":
+    @memoize
+    def parse_function_call(self, stream):
     
-        if current_size != opcodes.shift_size:
-            raise SyntaxError, "Invalid size for shift at line %i." % tokeniser.line
+        '<function call> = <name> "(" [<argument>+] ")"'
+        
+        top = self.mark()
+        token = self.get_token(stream)
+        
+        function = self.find_function(token)
+        if not function:
+            self.rewind(top)
+            return False
+        
+        token = self.get_token(stream)
+        if token != tokeniser.arguments_begin_token:
+            raise SyntaxError, "Function arguments must follow '(' at line %i.\n" % stream.line
+        
+        function_name, parameters, variables, address, rsize, return_array = function
+        
+        # Generate code to record the address of the current frame in a frame base
+        # address register, pushing the previous frame base address onto the stack
+        # so that it can be recovered later.
+        #    <local vars>
+        # -> <local vars> <parent frame addr>
+        #   ^-------------/
+        
+        self.generator.generate_push_parent_frame()
+        
+        # Parse the arguments corresponding to the function parameters. The result
+        # at run-time will be a series of values stored on the stack.
+        #    <local vars> <parent frame addr>
+        # -> <local vars> <parent frame addr> <arguments>
+        
+        total_param_size = total_variable_size(parameters)
+        
+        i = 0
+        while i < len(parameters):
         
-        debug_print("<<", token, current_size)
-        current_size = current_element_size = size1
-        generator.generate_left_shift(current_size)
+            name, size, element_size, array = parameters[i]
+            
+            if not self.parse_expression(stream):
+                raise SyntaxError, "Invalid argument to function '%s' at line %i.\n" % (function_name, stream.line)
+            
+            if i < len(parameters) - 1:
+                token = self.get_token(stream)
+                if token != ",":
+                    raise SyntaxError, "Expected a comma after function argument '%s' at line %i.\n" % (name, stream.line)
+            
+            if self.current_size != size:
+                raise SyntaxError, "Incompatible types in argument to function '%s' at line %i.\n" % (function_name, stream.line)
+            
+            i += 1
+        
+        token = self.get_token(stream)
+        if token != tokeniser.arguments_end_token:
+            raise SyntaxError, "Function arguments must be terminated with ')' at line %i.\n" % stream.line
+        
+        # Use the previously stored information about the local variables to
+        # determine how much space should be allocated on the stack.
+        #    <local vars> <parent frame addr> <args>
+        # -> <local vars> <parent frame addr> <args> <local vars>
+        
+        total_var_size = total_variable_size(variables) - total_param_size
+        
+        self.debug_print("function call", function_name)
+        
+        # Call the function then restore the address of the frame for the calling
+        # scope. Pop the local variables and arguments from the stack, copying any
+        # return value down in memory to the new stack top.
+        #    <local vars> <parent frame addr> <args> <local vars> <return value>
+        # -> <local vars> <return value>
+        
+        self.generator.generate_function_call(function_name)
+        
+        # Record the size of the return value to ensure that it is assigned or
+        # discarded as necessary.
+        self.current_size = self.current_element_size = rsize
+        self.current_array = return_array
+        
+        return True
     
-    elif token == ">>":
+    @memoize_failures
+    def parse_include(self, stream):
     
-        if current_size != opcodes.shift_size:
-            raise SyntaxError, "Invalid size for shift at line %i." % tokeniser.line
+        # include <string>
         
-        debug_print(">>", token, current_size)
-        current_size = current_element_size = size1
-        generator.generate_right_shift(current_size)
-    
-    return True
-
-def parse_program(stream, base_address):
-
-    '<program> = [<definition> | <control> | <statement>]+'
+        top = self.mark()
+        token = self.get_token(stream)
+        
+        if token != "include":
+            self.rewind(top)
+            return False
+        
+        token = self.get_token(stream)
+        
+        if not self.is_string(token):
+            self.rewind(top)
+            return False
+        
+        if not self.parse_separator(stream):
+            self.rewind(top)
+            return False
+        
+        self.include_file(token, stream)
+        
+        return True    
     
-    generator.base_address = base_address
+    def include_file(self, token, stream):
     
-    top = len(used)
+        # Read and tokenise the contents of the file.
+        file_name = self.decode_string(token)
+        
+        if file_name.startswith("<") and file_name.endswith(">"):
+            file_name = os.path.join(self.include_dir, file_name[1:-1])
+        
+        try:
+            f = open(file_name)
+        except IOError:
+            raise IOError("Failed to include file '%s' at line %i." % (
+                file_name, stream.line))
+        
+        if self.module:
+            self.module.add_include(token)
+        
+        print "Including", file_name
+        
+        if self.cache_dir:
+            self.include_module(f, stream)
+            return
+        
+        # Read the included file with its own tokeniser, using the same kind of
+        # tokenisation as for the file that includes it.
+        self.source = tokeniser.Tokeniser(f, stream.buffered)
+        self.parse_program_definitions(self.source)
+        self.source = stream
     
-    parse_program_definitions(stream)
+    @memoize_failures
+    def parse_indent(self, stream):
     
-    # Insert code to reserve space for variables.
-    start_address = len(generator.code)
-    generator.generate_allocate_stack_space(0)
+        top = self.mark()
+        while True:
+        
+            token = self.get_token(stream)
+            if token == tokeniser.newline_token:
+                pass
+            elif token == tokeniser.indent_token:
+                break
+            else:
+                self.rewind(top)
+                return False
+        
+        return True
     
-    while tokeniser.at_eof == False:
+    @memoize_failures
+    def parse_newline(self, stream):
     
-        if parse_control(stream):
-            discard_tokens()
-            debug_print("control")
-        elif parse_definition(stream):
-            raise SyntaxError, "Cannot mix function definitions and code at line %i." % tokeniser.line
-        elif parse_statement(stream):
-            discard_tokens()
-            debug_print("statement")
-        elif parse_separator(stream):
-            # Handle blank lines.
-            discard_tokens()
-            debug_print("separator (blank)")
+        top = self.mark()
+        token = self.get_token(stream)
+        
+        if token == tokeniser.newline_token:
+            return True
         else:
-            raise SyntaxError, "Unexpected input at line %i." % tokeniser.line
-    
-    generator.generate_end()
+            self.rewind(top)
+            return False
     
-    # Fill in the size of the global variable space.
-    generator.code[start_address + 1] = total_variable_size(global_variables)
-    print "Global variable space size:", total_variable_size(global_variables)
+    @memoize
+    def parse_operand_value(self, stream):
     
-    return generator.base_address + start_address
-
-# This function is used by parse_program and parse_include.
-
-def parse_program_definitions(stream):
-
-    top = len(used)
-    
-    while tokeniser.at_eof == False:
-    
-        if parse_definition(stream):
-            discard_tokens()
-            debug_print("definition")
-        elif parse_separator(stream):
-            # Handle blank lines.
-            discard_tokens()
-            debug_print("separator (blank)")
-        elif parse_include(stream):
-            debug_print("include")
+        '<operand value> = <value> | <variable> | <function call> | <system call>'
+        
+        if self.parse_value(stream):
+            return True
+        elif self.parse_variable(stream):
+            return True
+        elif self.parse_function_call(stream):
+            return True
+        elif self.parse_system_call(stream):
+            return True
+        elif self.parse_builtin_call(stream):
+            return True
         else:
-            put_tokens(top)
-            break
-
-def parse_return(stream):
-
-    '<return> = "return" [<expression>]'
+            return False
     
-    ### Handle value-less returns and ensure that all returns in a function
-    ### body consistently use the same type.
+    def parse_operation(self, stream):
     
-    top = len(used)
-    token = get_token(stream)
+        '<operation> = "==" | "!=" | "<" | ">" | "+" | "-" | "*" | "/" | "and" | "or" | "&" | "|" | "^" | "<<" | ">>" <operand>'
+        
+        top = self.mark()
+        token = self.get_token(stream)
+        
+        if token not in operators:
+            self.rewind(top)
+            return False
+        
+        if self.current_size == 0:
+            raise SyntaxError, "Operand 1 has zero size at line %i." % stream.line
+        
+        size1 = self.current_size
+        
+        # The second operand of a logical operation is skipped if the first
+        # operand determines the result.
+        if token == "and":
+            label = self.generator.generate_logical_and_start()
+        elif token == "or":
+            label = self.generator.generate_logical_or_start()
+        
+        if not self.parse_expression(stream):
+            # Not an expression, but one was expected, so report an error.
+            raise SyntaxError, "Incomplete operation at line %i." % stream.line
+        
+        if self.current_size == 0:
+            raise SyntaxError, "Operand 2 has zero size at line %i." % stream.line
+        
+        if token not in asymmetric_operators and self.current_size != size1:
+            raise SyntaxError, "Sizes of operands do not match at line %i." % stream.line
+        
+        if token == "==":
+            self.debug_print("equals", token, self.current_size)
+            self.generator.generate_equals(self.current_size)
+            self.current_size = self.current_element_size = 1
+            self.current_array = False
+        
+        elif token == "!=":
+            self.debug_print("not equals", token, self.current_size)
+            self.generator.generate_not_equals(self.current_size)
+            self.current_size = self.current_element_size = 1
+            self.current_array = False
+        
+        elif token == "<":
+            self.debug_print("less than", token, self.current_size)
+            self.generator.generate_less_than(self.current_size)
+            self.current_size = self.current_element_size = 1
+            self.current_array = False
+        
+        elif token == ">":
+            self.debug_print("greater than", token, self.current_size)
+            self.generator.generate_greater_than(self.current_size)
+            self.current_size = self.current_element_size = 1
+            self.current_array = False
+        
+        elif token == "+":
+            self.debug_print("add", token, self.current_size)
+            self.generator.generate_add(self.current_size)
+        
+        elif token == "-":
+            self.debug_print("subtract", token, self.current_size)
+            self.generator.generate_subtract(self.current_size)
+        
+        elif token == "*":
+            self.debug_print("multiply", token, self.current_size)
+            self.generator.generate_multiply(self.current_size)
+        
+        elif token == "/":
+            self.debug_print("divide", token, self.current_size)
+            self.generator.generate_divide(self.current_size)
+        
+        elif token == "and":
+        
+            if self.current_size != 1:
+                raise SyntaxError, "Operands have an invalid size for logical and operation at line %i." % stream.line
+            
+            self.debug_print("and", token, self.current_size)
+            self.generator.generate_logical_and(label)
+            self.current_size = self.current_element_size = 1
+            self.current_array = False
+        
+        elif token == "or":
+        
+            if self.current_size != 1:
+                raise SyntaxError, "Operands have an invalid size for logical or operation at line %i." % stream.line
+            
+            self.debug_print("or", token, self.current_size)
+            self.generator.generate_logical_or(label)
+            self.current_size = self.current_element_size = 1
+            self.current_array = False
+        
+        # The bitwise AND operation truncates the result to the size of the second
+        # operand.
+        
+        elif token == "&":
+        
+            self.debug_print("&", token, self.current_size)
+            self.generator.generate_bitwise_and(size1, self.current_size)
+        
+        elif token == "|":
+        
+            self.debug_print("|", token, self.current_size)
+            self.generator.generate_bitwise_or(size1, self.current_size)
+        
+        elif token == "^":
+        
+            self.debug_print("^", token, self.current_size)
+            self.generator.generate_bitwise_eor(size1, self.current_size)
+        
+        # The shift operators are also asymmetric, with the second operand
+        # typically being only a single byte, but the result is the same size as
+        # the first operand.
+        
+        elif token == "<<":
+        
+            if self.current_size != opcodes.shift_size:
+                raise SyntaxError, "Invalid size for shift at line %i." % stream.line
+            
+            self.debug_print("<<", token, self.current_size)
+            self.current_size = self.current_element_size = size1
+            self.generator.generate_left_shift(self.current_size)
+        
+        elif token == ">>":
+        
+            if self.current_size != opcodes.shift_size:
+                raise SyntaxError, "Invalid size for shift at line %i." % stream.line
+            
+            self.debug_print(">>", token, self.current_size)
+            self.current_size = self.current_element_size = size1
+            self.generator.generate_right_shift(self.current_size)
+        
+        return True
     
-    if token != "return":
-        put_tokens(top)
-        return False
+    def parse_program(self, stream, base_address, buffered = False):
     
-    if not in_function:
-        raise SyntaxError, "Cannot use return from outside function at line %i." % tokeniser.line
+        '<program> = [<definition> | <control> | <statement>]+'
+        
+        # Create a tokeniser to read tokens from the stream. If requested, this
+        # reads the whole file into memory and tokenises it from there instead of
+        # reading it from the stream one character at a time.
+        self.source = stream = tokeniser.Tokeniser(stream, buffered)
+        
+        self.generator.base_address = base_address
+        
+        top = self.mark()
+        
+        self.parse_program_definitions(stream)
+        self.compile_definitions()
+        
+        # Insert code to reserve space for variables.
+        start = self.generator.generate_label()
+        start_address = len(self.generator.code)
+        self.generator.generate_allocate_stack_space(0)
+        
+        while stream.at_eof == False:
+        
+            if self.parse_control(stream):
+                self.discard_tokens()
+                self.debug_print("control")
+            elif self.parse_definition(stream):
+                raise SyntaxError, "Cannot mix function definitions and code at line %i." % stream.line
+            elif self.parse_statement(stream):
+                self.discard_tokens()
+                self.debug_print("statement")
+            elif self.parse_separator(stream):
+                # Handle blank lines.
+                self.discard_tokens()
+                self.debug_print("separator (blank)")
+            else:
+                raise SyntaxError, "Unexpected input at line %i." % stream.line
+        
+        self.generator.generate_end()
+        
+        # Fill in the size of the global variable space.
+        self.generator.code[start_address][1] = self.global_variables.size
+        print "Global variable space size:", self.global_variables.size
+        
+        return start
     
-    if parse_separator(stream):
-        # No return value supplied. Set the return value size to zero and the
-        # return array value to False.
-        functions[-1][-2:] = [0, False]
+    # This function is used by parse_program and parse_include.
     
-    elif parse_expression(stream):
-        functions[-1][-2:] = [current_size, current_array]
+    def parse_program_definitions(self, stream):
     
-    else:
-        raise SyntaxError, "Invalid return from function at line %i." % tokeniser.line
+        top = self.mark()
+        
+        while stream.at_eof == False:
+        
+            # Definitions in files being compiled to object modules are
+            # compiled in turn so that the code for each can be recorded.
+            if self.module:
+                code_start = len(self.generator.code)
+                globals_defined = len(self.global_variables)
+                self.lookups = {}
+            
+            if self.jobs and not self.module and self.scan_definition(stream):
+                self.discard_tokens()
+                self.debug_print("definition (deferred)")
+            elif self.parse_definition(stream):
+                self.discard_tokens()
+                self.debug_print("definition")
+                
+                if self.module:
+                    self.record_definition(code_start, globals_defined)
+            elif self.parse_separator(stream):
+                # Handle blank lines.
+                self.discard_tokens()
+                self.debug_print("separator (blank)")
+            elif self.parse_include(stream):
+                self.debug_print("include")
+            else:
+                self.rewind(top)
+                break
     
-    generator.generate_exit_function()
-    return True
-
-def parse_separator(stream):
-
-    "<separator> = <newline> | <eof>"
+    @memoize_failures
+    def parse_return(self, stream):
     
-    if parse_newline(stream):
-        debug_print("newline")
-        return True
-    elif parse_eof(stream):
-        debug_print("eof")
+        '<return> = "return" [<expression>]'
+        
+        ### Handle value-less returns and ensure that all returns in a function
+        ### body consistently use the same type.
+        
+        top = self.mark()
+        token = self.get_token(stream)
+        
+        if token != "return":
+            self.rewind(top)
+            return False
+        
+        if not self.in_function:
+            raise SyntaxError, "Cannot use return from outside function at line %i." % stream.line
+        
+        if self.parse_separator(stream):
+            # No return value supplied. Set the return value size to zero and the
+            # return array value to False.
+            self.functions[-1][-2:] = [0, False]
+            self.packrat_cache.clear()
+        
+        elif self.parse_expression(stream):
+            self.functions[-1][-2:] = [self.current_size, self.current_array]
+            self.packrat_cache.clear()
+        
+        else:
+            raise SyntaxError, "Invalid return from function at line %i." % stream.line
+        
+        self.generator.generate_exit_function()
         return True
-    else:
-        return False
-
-def parse_statement(stream):
-
-    '<statement> = [["global" <name> "="] <expression> <separator>'
-    
-    global current_size, current_element_size, current_array
-    
-    top = len(used)
-    address = len(generator.code)
-    
-    assignment = "undefined"
     
-    # The statement may be an assignment.
-    var_token = get_token(stream)
+    @memoize_failures
+    def parse_separator(self, stream):
     
-    if var_token == "global":
-        assignment = "global"
-        var_token = get_token(stream)
+        "<separator> = <newline> | <eof>"
+        
+        if self.parse_newline(stream):
+            self.debug_print("newline")
+            return True
+        elif self.parse_eof(stream):
+            self.debug_print("eof")
+            return True
+        else:
+            return False
     
-    if is_variable(var_token):
+    @memoize_failures
+    def parse_statement(self, stream):
     
-        if assignment != "global" and in_function:
+        '<statement> = [["global" <name> "="] <expression> <separator>'
+        
+        top = self.mark()
+        address = len(self.generator.code)
+        
+        assignment = "undefined"
+        
+        # The statement may be an assignment.
+        var_token = self.get_token(stream)
         
-            # If the variable is already defined and has an array type then check
-            # for an index.
-            index = find_local_variable(var_token)
+        if var_token == "global":
+            assignment = "global"
+            var_token = self.get_token(stream)
+        
+        if is_variable(var_token):
+        
+            if assignment != "global" and self.in_function:
             
-            if index != -1:
-                # Local variable
-                name, size, element_size, array = local_variables[index]
-                offset = local_variable_offset(index)
+                # If the variable is already defined and has an array type then check
+                # for an index.
+                variable = self.find_local_variable(var_token)
                 
-                if array and parse_array_index(stream):
-                    # Record the size of the array index.
-                    index_size = current_size
-                    assignment = "local array"
+                if variable:
+                    # Local variable
+                    offset, size, element_size, array = variable
+                    
+                    if array and self.parse_array_index(stream):
+                        # Record the size of the array index and where the
+                        # code for the value starts.
+                        index_size = self.current_size
+                        value_start = len(self.generator.code)
+                        assignment = "local array"
+                    else:
+                        assignment = "local"
                 else:
-                    assignment = "local"
-            else:
-                # Currently undefined variable
-                assignment = "undefined"
-        
-        if assignment in "global" or assignment == "undefined":
-        
-            # Global variable
-            index = find_global_variable(var_token)
+                    # Currently undefined variable
+                    assignment = "undefined"
             
-            if index != -1:
-                name, size, element_size, array = global_variables[index]
-                offset = global_variable_offset(index)
+            if assignment in "global" or assignment == "undefined":
+            
+                # Global variable
+                variable = self.find_global_variable(var_token)
+                
+                if variable:
+                    offset, size, element_size, array = variable
+                    
+                    if array and self.parse_array_index(stream):
+                        # Record the size of the array index and where the
+                        # code for the value starts.
+                        index_size = self.current_size
+                        value_start = len(self.generator.code)
+                        assignment = "global array"
+                    else:
+                        assignment = "global"
                 
-                if array and parse_array_index(stream):
-                    # Record the size of the array index.
-                    index_size = current_size
-                    assignment = "global array"
+                elif assignment == "global" or not self.in_function:
+                    # Only allow creation of new global variables outside functions
+                    # or when the "global" keyword is used within functions.
+                    assignment = "global undefined"
                 else:
-                    assignment = "global"
+                    assignment = "undefined"
             
-            elif assignment == "global" or not in_function:
-                # Only allow creation of new global variables outside functions
-                # or when the "global" keyword is used within functions.
-                assignment = "global undefined"
+            # Check for the assignment operator.
+            token = self.get_token(stream)
+            if token == tokeniser.assignment_token:
+                self.debug_print("assignment")
             else:
-                assignment = "undefined"
+                self.rewind(top)
+                assignment = None
+        else:
+            self.rewind(top)
+        
+        # The (rest of the) statement is an expression.
+        
+        if not self.parse_expression(stream):
+            self.rewind(top)
+            self.generator.discard_code(address)
+            return False
+        
+        if not self.parse_separator(stream):
+            self.rewind(top)
+            self.generator.discard_code(address)
+            return False
+        
+        if assignment == "local array":
+            if element_size != self.current_size:
+                raise SyntaxError, "Type mismatch in indexed assignment at line %i." % stream.line
+            self.generator.generate_store_array_value(offset, element_size,
+                                                      index_size, value_start)
+            self.current_size = self.current_element_size = element_size
+            self.current_array = True
+        
+        elif assignment == "local":
+            if size != self.current_size:
+                raise SyntaxError, "Type mismatch in assignment at line %i." % stream.line
+            self.generator.generate_assign_local(offset, size)
+            self.current_size = self.current_element_size = size
+            self.current_array = False
+        
+        elif assignment == "global array":
+            if element_size != self.current_size:
+                raise SyntaxError, "Type mismatch in indexed assignment at line %i." % stream.line
+            self.generator.generate_store_array_value(offset, element_size,
+                                                      index_size, value_start)
+            self.current_size = self.current_element_size = element_size
+            self.current_array = True
+        
+        elif assignment == "global":
+            if size != self.current_size:
+                raise SyntaxError, "Type mismatch in assignment at line %i." % stream.line
+            self.generator.generate_assign_global(offset, size)
+            self.current_size = self.current_element_size = size
+            self.current_array = False
+        
+        elif assignment == "undefined":
+            if self.current_size == 0:
+                raise SyntaxError, "No value to assign at line %i." % stream.line
+            
+            self.local_variables.append((var_token, self.current_size, self.current_element_size,
+                                    self.current_array))
+            self.packrat_cache.clear()
+            offset = self.find_local_variable(var_token)[0]
+            self.generator.generate_assign_local(offset, self.current_size)
+            self.debug_print("define local", var_token, offset, self.current_size)
+        
+        elif assignment == "global undefined":
+            if self.current_size == 0:
+                raise SyntaxError, "No value to assign at line %i." % stream.line
+            
+            self.global_variables.append((var_token, self.current_size, self.current_element_size,
+                                     self.current_array))
+            self.packrat_cache.clear()
+            offset = self.find_global_variable(var_token)[0]
+            self.generator.generate_assign_global(offset, self.current_size)
+            self.debug_print("define global", var_token, offset, self.current_size)
         
-        # Check for the assignment operator.
-        token = get_token(stream)
-        if token == tokeniser.assignment_token:
-            debug_print("assignment")
         else:
-            put_tokens(top)
-            assignment = None
-    else:
-        put_tokens(top)
-    
-    # The (rest of the) statement is an expression.
-    
-    if not parse_expression(stream):
-        put_tokens(top)
-        generator.discard_code(address)
-        return False
-    
-    if not parse_separator(stream):
-        put_tokens(top)
-        generator.discard_code(address)
-        return False
-    
-    if assignment == "local array":
-        if element_size != current_size:
-            raise SyntaxError, "Type mismatch in indexed assignment at line %i." % tokeniser.line
-        generator.generate_store_array_value(offset, element_size, index_size)
-        current_size = current_element_size = element_size
-        current_array = True
-    
-    elif assignment == "local":
-        if size != current_size:
-            raise SyntaxError, "Type mismatch in assignment at line %i." % tokeniser.line
-        generator.generate_assign_local(offset, size)
-        current_size = current_element_size = size
-        current_array = False
-    
-    elif assignment == "global array":
-        if element_size != current_size:
-            raise SyntaxError, "Type mismatch in indexed assignment at line %i." % tokeniser.line
-        generator.generate_store_array_value(offset, element_size, index_size)
-        current_size = current_element_size = element_size
-        current_array = True
-    
-    elif assignment == "global":
-        if size != current_size:
-            raise SyntaxError, "Type mismatch in assignment at line %i." % tokeniser.line
-        generator.generate_assign_global(offset, size)
-        current_size = current_element_size = size
-        current_array = False
-    
-    elif assignment == "undefined":
-        if current_size == 0:
-            raise SyntaxError, "No value to assign at line %i." % tokeniser.line
-        
-        local_variables.append((var_token, current_size, current_element_size,
-                                current_array))
-        index = find_local_variable(var_token)
-        offset = local_variable_offset(index)
-        generator.generate_assign_local(offset, current_size)
-        debug_print("define local", var_token, offset, current_size)
-    
-    elif assignment == "global undefined":
-        if current_size == 0:
-            raise SyntaxError, "No value to assign at line %i." % tokeniser.line
-        
-        global_variables.append((var_token, current_size, current_element_size,
-                                 current_array))
-        index = find_global_variable(var_token)
-        offset = global_variable_offset(index)
-        generator.generate_assign_global(offset, current_size)
-        debug_print("define global", var_token, offset, current_size)
-    
-    else:
-        # Discard the resulting value on the top of the stack.
-        generator.generate_discard_value(current_size)
-    
-    return True
-
-# This function delegates the task of parsing system calls to the architecture
-# specific parsing functions.
-
-def parse_system_call(stream):
-
-    return parsing.parse_system_call(stream)
-
-def parse_value(stream):
-
-    "<value> = <number> | <string>"
-    
-    top = len(used)
-    token = get_token(stream)
-    
-    if is_number(token):
-        size = get_size(token)
-        debug_print("constant", token, size)
-        base = get_number_base(token)
-        generator.generate_number(token, size, base)
-    
-    elif is_boolean(token):
-        debug_print("constant", token)
-        size = get_size(token)
-        generator.generate_boolean(boolean_value(token), size)
-    
-    elif is_string(token):
-        debug_print("constant", token)
-        size = get_size(token)
-        decoded_string = decode_string(token)
-        generator.generate_string(decoded_string, size)
+            # Discard the resulting value on the top of the stack.
+            self.generator.generate_discard_value(self.current_size)
+        
+        return True
     
-    else:
-        put_tokens(top)
-        return False
+    # This function delegates the task of parsing system calls to the architecture
+    # specific parsing functions.
     
-    return True
-
-def parse_variable(stream):
-
-    global current_size, current_element_size, current_array
+    @memoize
+    def parse_system_call(self, stream):
     
-    top = len(used)
-    token = get_token(stream)
+        return self.parsing.parse_system_call(self, stream)
     
-    if not is_variable(token):
-        put_tokens(top)
-        return False
+    @memoize
+    def parse_value(self, stream):
     
-    index = find_local_variable(token)
-    if index != -1:
-        name, size, element_size, array = local_variables[index]
-        offset = local_variable_offset(index)
-        
-        if array and parse_array_index(stream):
-            index_size = current_size
-            generator.generate_load_array_value(offset, element_size, index_size)
-            current_size = current_element_size = element_size
-            # The element of an array is not an array.
-            current_array = False
-        else:
-            generator.generate_load_local(offset, size)
-            current_size = current_element_size = size
-            current_array = array
+        "<value> = <number> | <string>"
+        
+        top = self.mark()
+        token = self.get_token(stream)
+        
+        if is_number(token):
+            size = self.get_size(token)
+            self.debug_print("constant", token, size)
+            base = get_number_base(token)
+            self.generator.generate_number(token, size, base)
+        
+        elif is_boolean(token):
+            self.debug_print("constant", token)
+            size = self.get_size(token)
+            self.generator.generate_boolean(boolean_value(token), size)
+        
+        elif self.is_string(token):
+            self.debug_print("constant", token)
+            size = self.get_size(token)
+            decoded_string = self.decode_string(token)
+            self.generator.generate_string(decoded_string, size)
         
-        return True
-    
-    index = find_global_variable(token)
-    if index != -1:
-        name, size, element_size, array = global_variables[index]
-        offset = global_variable_offset(index)
-        
-        if array and parse_array_index(stream):
-            index_size = current_size
-            generator.generate_load_array_value(offset, element_size, index_size)
-            current_size = current_element_size = element_size
-            # The element of an array is not an array.
-            current_array = False
         else:
-            generator.generate_load_global(offset, size)
-            current_size = current_element_size = size
-            current_array = array
+            self.rewind(top)
+            return False
         
-        current_array = False
         return True
     
-    put_tokens(top)
-    return False
-
-def save_opcodes(file_name):
-
-    f = open(file_name, "wb")
-    f.write("".join(map(chr, map(lambda x: x & 0xff, generator.code))))
-    f.close()
-
-def get_opcodes_used():
-
-    d = {}
-    
-    for v in generator.code:
-        if v > 255:
-            d[v] = d.get(v, 0) + 1
+    @memoize
+    def parse_variable(self, stream):
     
-    return d
+        top = self.mark()
+        token = self.get_token(stream)
+        
+        if not is_variable(token):
+            self.rewind(top)
+            return False
+        
+        variable = self.find_local_variable(token)
+        if variable:
+            offset, size, element_size, array = variable
+            
+            if array and self.parse_array_index(stream):
+                index_size = self.current_size
+                self.generator.generate_load_array_value(offset, element_size, index_size)
+                self.current_size = self.current_element_size = element_size
+                # The element of an array is not an array.
+                self.current_array = False
+            else:
+                self.generator.generate_load_local(offset, size)
+                self.current_size = self.current_element_size = size
+                self.current_array = array
+            
+            return True
+        
+        variable = self.find_global_variable(token)
+        if variable:
+            offset, size, element_size, array = variable
+            
+            if array and self.parse_array_index(stream):
+                index_size = self.current_size
+                self.generator.generate_load_array_value(offset, element_size, index_size)
+                self.current_size = self.current_element_size = element_size
+                # The element of an array is not an array.
+                self.current_array = False
+            else:
+                self.generator.generate_load_global(offset, size)
+                self.current_size = self.current_element_size = size
+                self.current_array = array
+            
+            self.current_array = False
+            return True
+        
+        self.rewind(top)
+        return False
@@ -0,0 +1,458 @@
+"""
+folding.py - Constant folding and algebraic simplification of generated code.
+
+Copyright (C) 2014 David Boddie <david@boddie.org.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# The pass works on code in the form described in the ir module. Since
+# operations take their operands from the top of the stack, an operation
+# that directly follows the instructions that load its operands can be
+# evaluated at compile time if those instructions load constants. Labels are
+# instructions in their own right, so operations are never combined with
+# instructions on the other side of a branch target.
+#
+# Constants are held as lists of bytes, least significant byte first, and
+# each operation is evaluated on the bytes in the same way as the simulator
+# evaluates it, wrapping around at the size of the operands.
+
+from opcodes import *
+
+true = 255
+false = 0
+
+def constant_data(instruction):
+
+    # Return the bytes loaded by the instruction or None if it does not load
+    # a constant.
+    if instruction[0] == load_byte:
+        return instruction[1:]
+    elif instruction[0] == load_number:
+        return instruction[2:]
+    else:
+        return None
+
+def load_constant(data):
+
+    if len(data) > 1:
+        return [load_number, len(data)] + data
+    else:
+        return [load_byte] + data
+
+def to_value(data):
+
+    value = 0
+    i = len(data) - 1
+    while i >= 0:
+        value = (value << 8) | data[i]
+        i -= 1
+    
+    return value
+
+def to_data(value, size):
+
+    # Return the bytes of the value, truncated to the size given.
+    data = []
+    i = 0
+    while i < size:
+        data.append(value & 0xff)
+        value = value >> 8
+        i += 1
+    
+    return data
+
+def boolean(value):
+
+    if value:
+        return [true]
+    else:
+        return [false]
+
+# Operations on two constants, each called with the operation and the bytes of
+# its operands, returning the bytes of the result or None if the operation
+# cannot be evaluated.
+
+def fold_arithmetic(instruction, a, b):
+
+    size = instruction[1]
+    if len(a) != size or len(b) != size:
+        return None
+    
+    x = to_value(a)
+    y = to_value(b)
+    
+    if instruction[0] == add:
+        return to_data(x + y, size)
+    elif instruction[0] == subtract:
+        return to_data(x - y, size)
+    else:
+        return to_data(x * y, size)
+
+def fold_byte_arithmetic(instruction, a, b):
+
+    if len(a) != 1 or len(b) != 1:
+        return None
+    
+    if instruction[0] == add_byte:
+        return to_data(a[0] + b[0], 1)
+    elif instruction[0] == subtract_byte:
+        return to_data(a[0] - b[0], 1)
+    elif instruction[0] == bitwise_and_byte:
+        return [a[0] & b[0]]
+    elif instruction[0] == bitwise_or_byte:
+        return [a[0] | b[0]]
+    else:
+        return [a[0] ^ b[0]]
+
+def fold_bitwise(instruction, a, b):
+
+    size1, size2 = instruction[1:3]
+    if len(a) != size1 or len(b) != size2:
+        return None
+    
+    # The result has the size of the second operand and is combined with the
+    # bytes at the start of the first, running into the second operand if the
+    # first is smaller, as in the simulator.
+    data = a + b
+    result = []
+    i = 0
+    while i < size2:
+        if instruction[0] == bitwise_and:
+            result.append(data[i] & data[size1 + i])
+        elif instruction[0] == bitwise_or:
+            result.append(data[i] | data[size1 + i])
+        else:
+            result.append(data[i] ^ data[size1 + i])
+        i += 1
+    
+    return result
+
+def fold_shift(instruction, a, b):
+
+    size = instruction[1]
+    if len(a) != size or len(b) != shift_size:
+        return None
+    
+    # Only shifts of up to a byte are handled in the same way by the simulator
+    # and the 6502 routines.
+    shift = b[0]
+    if shift > 8:
+        return None
+    
+    if instruction[0] == left_shift:
+        return to_data(to_value(a) << shift, size)
+    else:
+        return to_data(to_value(a) >> shift, size)
+
+def fold_compare(instruction, a, b):
+
+    if instruction[0] in (compare_equals_byte, compare_not_equals_byte,
+                          compare_less_than_byte, compare_greater_than_byte):
+        size = 1
+    else:
+        size = instruction[1]
+    
+    if len(a) != size or len(b) != size:
+        return None
+    
+    if instruction[0] in (compare_equals, compare_equals_byte):
+        return boolean(a == b)
+    elif instruction[0] in (compare_not_equals, compare_not_equals_byte):
+        return boolean(a != b)
+    
+    # Values are compared byte by byte from the most significant byte, with
+    # the result being true if any byte satisfies the comparison, as in the
+    # simulator.
+    i = size - 1
+    while i >= 0:
+        if instruction[0] in (compare_less_than, compare_less_than_byte):
+            if a[i] < b[i]:
+                return [true]
+        elif a[i] > b[i]:
+            return [true]
+        i -= 1
+    
+    return [false]
+
+def fold_logical(instruction, a, b):
+
+    if len(a) != 1 or len(b) != 1:
+        return None
+    
+    if instruction[0] == logical_and:
+        return boolean(a[0] and b[0])
+    else:
+        return boolean(a[0] or b[0])
+
+binary_operations = {
+    add: fold_arithmetic,
+    subtract: fold_arithmetic,
+    multiply: fold_arithmetic,
+    add_byte: fold_byte_arithmetic,
+    subtract_byte: fold_byte_arithmetic,
+    bitwise_and_byte: fold_byte_arithmetic,
+    bitwise_or_byte: fold_byte_arithmetic,
+    bitwise_eor_byte: fold_byte_arithmetic,
+    bitwise_and: fold_bitwise,
+    bitwise_or: fold_bitwise,
+    bitwise_eor: fold_bitwise,
+    left_shift: fold_shift,
+    right_shift: fold_shift,
+    compare_equals: fold_compare,
+    compare_equals_byte: fold_compare,
+    compare_not_equals: fold_compare,
+    compare_not_equals_byte: fold_compare,
+    compare_less_than: fold_compare,
+    compare_less_than_byte: fold_compare,
+    compare_greater_than: fold_compare,
+    compare_greater_than_byte: fold_compare,
+    logical_and: fold_logical,
+    logical_or: fold_logical
+    }
+
+# Operations on a single constant, including those with a constant operand.
+
+def fold_unary(instruction, a):
+
+    opcode = instruction[0]
+    
+    if opcode == minus:
+        size = instruction[1]
+        if len(a) != size:
+            return None
+        return to_data(-to_value(a), size)
+    
+    if opcode in constant_operand_forms:
+        # The constant operand is the last operand of the instruction.
+        operation = [constant_operand_forms[opcode]] + instruction[1:-1]
+        return binary_operations[operation[0]](operation, a, [instruction[-1]])
+    
+    if len(a) != 1:
+        return None
+    
+    if opcode == logical_not:
+        return boolean(not a[0])
+    elif opcode == add_byte_constant:
+        return to_data(a[0] + instruction[1], 1)
+    elif opcode == subtract_byte_constant:
+        return to_data(a[0] - instruction[1], 1)
+    elif opcode == bitwise_and_byte_constant:
+        return [a[0] & instruction[1]]
+    elif opcode == bitwise_or_byte_constant:
+        return [a[0] | instruction[1]]
+    else:
+        return [a[0] ^ instruction[1]]
+
+# Operations with a constant operand that are evaluated as the operations
+# that take the operand from the stack
+
+constant_operand_forms = {
+    compare_equals_byte_constant: compare_equals_byte,
+    compare_not_equals_byte_constant: compare_not_equals_byte,
+    compare_less_than_byte_constant: compare_less_than_byte,
+    compare_greater_than_byte_constant: compare_greater_than_byte,
+    left_shift_constant: left_shift,
+    right_shift_constant: right_shift
+    }
+
+unary_operations = (
+    minus, logical_not, add_byte_constant, subtract_byte_constant,
+    bitwise_and_byte_constant, bitwise_or_byte_constant,
+    bitwise_eor_byte_constant
+    ) + tuple(constant_operand_forms.keys())
+
+# Conditional jumps that perform comparisons and the comparisons they perform,
+# each jump being taken if the result of its comparison is false. Jumps that
+# compare constants are replaced by unconditional jumps or removed.
+
+comparison_jumps = {
+    jump_if_not_equals: compare_equals,
+    jump_if_not_equals_byte: compare_equals_byte,
+    jump_if_not_equals_byte_constant: compare_equals_byte_constant,
+    jump_if_equals: compare_not_equals,
+    jump_if_equals_byte: compare_not_equals_byte,
+    jump_if_equals_byte_constant: compare_not_equals_byte_constant,
+    jump_if_not_less_than: compare_less_than,
+    jump_if_not_less_than_byte: compare_less_than_byte,
+    jump_if_not_less_than_byte_constant: compare_less_than_byte_constant,
+    jump_if_not_greater_than: compare_greater_than,
+    jump_if_not_greater_than_byte: compare_greater_than_byte,
+    jump_if_not_greater_than_byte_constant: compare_greater_than_byte_constant
+    }
+
+def fold_comparison_jump(code):
+
+    # Replace the conditional jump at the end of the code if it compares
+    # constants, returning True if it was replaced.
+    instruction = code[-1]
+    comparison = [comparison_jumps[instruction[0]]] + instruction[1:-1]
+    
+    if comparison[0] in binary_operations and len(code) >= 3:
+        length = 3
+        a = constant_data(code[-3])
+        b = constant_data(code[-2])
+        if a is None or b is None:
+            return False
+        result = fold_compare(comparison, a, b)
+    
+    elif comparison[0] in unary_operations and len(code) >= 2:
+        length = 2
+        a = constant_data(code[-2])
+        if a is None:
+            return False
+        result = fold_unary(comparison, a)
+    
+    else:
+        return False
+    
+    if result is None:
+        return False
+    elif result == [false]:
+        code[-length:] = [[jump, instruction[-1]]]
+    else:
+        del code[-length:]
+    
+    return True
+
+# Byte operations with forms that take a constant operand, as used by the
+# generator when the second operand is a constant.
+
+constant_operations = {
+    add_byte: add_byte_constant,
+    subtract_byte: subtract_byte_constant,
+    bitwise_and_byte: bitwise_and_byte_constant,
+    bitwise_or_byte: bitwise_or_byte_constant,
+    bitwise_eor_byte: bitwise_eor_byte_constant
+    }
+
+# Operations whose operands can be exchanged, and the instructions that only
+# load a value, which can be moved past a constant to place it second.
+
+commutative_operations = (
+    add, multiply, add_byte, bitwise_and_byte, bitwise_or_byte,
+    bitwise_eor_byte, bitwise_and, bitwise_or, bitwise_eor
+    )
+
+value_loads = (load_local, load_local_byte, load_global, load_global_byte)
+
+def is_identity_operation(instruction):
+
+    # Return whether the instruction, which has a constant operand, leaves the
+    # value on the stack unchanged.
+    opcode = instruction[0]
+    
+    if opcode in (add_byte_constant, subtract_byte_constant,
+                  bitwise_or_byte_constant, bitwise_eor_byte_constant):
+        return instruction[1] == 0
+    elif opcode == bitwise_and_byte_constant:
+        return instruction[1] == 0xff
+    elif opcode in (left_shift_constant, right_shift_constant):
+        return instruction[2] == 0
+    else:
+        return False
+
+def is_identity(instruction, data):
+
+    # Return whether the operation leaves its first operand unchanged when its
+    # second operand is the constant given.
+    opcode = instruction[0]
+    
+    if opcode in (add, subtract, multiply):
+        size = instruction[1]
+    elif opcode in (bitwise_and, bitwise_or, bitwise_eor):
+        # Operands of different sizes change the size of the result.
+        size = instruction[1]
+        if instruction[2] != size:
+            return False
+    elif opcode in (left_shift, right_shift):
+        return len(data) == shift_size and to_value(data) == 0
+    else:
+        return False
+    
+    if len(data) != size:
+        return False
+    
+    if opcode == multiply:
+        return to_value(data) == 1
+    elif opcode == bitwise_and:
+        return data == [0xff] * size
+    else:
+        return to_value(data) == 0
+
+def simplify(code):
+
+    # Simplify the instructions at the end of the code, returning True if any
+    # were changed.
+    if code and code[-1][0] in comparison_jumps and fold_comparison_jump(code):
+        return True
+    
+    if len(code) >= 3 and code[-1][0] in binary_operations:
+    
+        a = constant_data(code[-3])
+        b = constant_data(code[-2])
+        if a is not None and b is not None:
+            result = binary_operations[code[-1][0]](code[-1], a, b)
+            if result is not None:
+                code[-3:] = [load_constant(result)]
+                return True
+        
+        # Place a constant first operand second where it can be folded into
+        # the operation or removed.
+        elif a is not None and code[-2][0] in value_loads and \
+             code[-1][0] in commutative_operations and \
+             (code[-1][0] in constant_operations or is_identity(code[-1], a)):
+            
+            code[-3:] = [code[-2], code[-3], code[-1]]
+            return True
+    
+    if len(code) >= 2:
+    
+        a = constant_data(code[-2])
+        if a is not None:
+            if code[-1][0] in unary_operations:
+                result = fold_unary(code[-1], a)
+                if result is not None:
+                    code[-2:] = [load_constant(result)]
+                    return True
+            
+            elif code[-1][0] in constant_operations and len(a) == 1:
+                code[-2:] = [[constant_operations[code[-1][0]], a[0]]]
+                return True
+            
+            elif is_identity(code[-1], a):
+                del code[-2:]
+                return True
+    
+    if code and is_identity_operation(code[-1]):
+        del code[-1]
+        return True
+    
+    return False
+
+def fold_constants(code):
+
+    """Evaluates operations on constants in the code given, replacing them
+    with the values they produce, and removes operations that leave their
+    operands unchanged. Returns the number of instructions removed."""
+    
+    folded = []
+    for instruction in code:
+        folded.append(instruction)
+        while simplify(folded):
+            pass
+    
+    removed = len(code) - len(folded)
+    code[:] = folded
+    return removed
@@ -17,408 +17,629 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import ir, strength
 from opcodes import *
-from tokeniser import eof_token, read_token
 
-# Generated code
-
-code = []
-base_address = 0
-
-# Code maintenance functions
-
-def discard_code(address):
-
-    code[:] = code[:address]
-
-def fix_returns(code_start):
-
-    target = len(code)
-    i = code_start
-    while i < target:
-        instruction = code[i]
-        if instruction == "exit_function":
-            code[i] = jump
-            address = base_address + target
-            j = 0
-            while j < address_size:
-                code[i + j + 1] = address & 0xff
-                address = address >> 8
-                j += 1
-            i += j
-        i += 1
-
-# Generation functions
-
-def generate_number(token, size, base):
-
-    global code
-    value = int(token, base)
-    if size > 1:
-        code += [load_number, size]
-    else:
-        code += [load_byte]
-    
-    i = 0
-    while i < size:
-        code += [value & 0xff]
-        value = value >> 8
-        i += 1
-
-def generate_boolean(value, size):
-
-    global code
-    if size > 1:
-        code += [load_number, size]
-    else:
-        code += [load_byte]
-    
-    i = 0
-    while i < size:
-        code += [value & 0xff]
-        value = value >> 8
-        i += 1
-
-def generate_string(token, size):
-
-    global code
-    code += [load_number, size]
-    i = 0
-    while i < size:
-        code += [ord(token[i])]
-        i += 1
-
-def generate_equals(size):
-
-    global code
-    if size > 1:
-        code += [compare_equals, size]
-    else:
-        code += [compare_equals_byte]
-
-def generate_not_equals(size):
-
-    global code
-    if size > 1:
-        code += [compare_not_equals, size]
-    else:
-        code += [compare_not_equals_byte]
-
-def generate_less_than(size):
-
-    global code
-    if size > 1:
-        code += [compare_less_than, size]
-    else:
-        code += [compare_less_than_byte]
-
-def generate_greater_than(size):
-
-    global code
-    if size > 1:
-        code += [compare_greater_than, size]
-    else:
-        code += [compare_greater_than_byte]
-
-def generate_add(size):
-
-    global code
-    if size > 1:
-        code += [add, size]
-    elif code[-2] == load_byte:
-        code[-2] = add_byte_constant
-    else:
-        code += [add_byte]
-
-def generate_subtract(size):
-
-    global code
-    if size > 1:
-        code += [subtract, size]
-    elif code[-2] == load_byte:
-        code[-2] = subtract_byte_constant
-    else:
-        code += [subtract_byte]
-
-def generate_multiply(size):
-
-    global code
-    code += [multiply, size]
-
-def generate_divide(size):
-
-    global code
-    code += [divide, size]
-
-def generate_logical_and():
-
-    global code
-    code += [logical_and]
-
-def generate_logical_or():
-
-    global code
-    code += [logical_or]
-
-def generate_logical_not():
-
-    global code
-    code += [logical_not]
-
-def generate_minus(size):
-
-    global code
-    code += [minus, size]
-
-def generate_bitwise_and(size1, size2):
-
-    global code
-    if size1 > 1 or size2 > 1:
-        code += [bitwise_and, size1, size2]
-    elif code[-2] == load_byte:
-        code[-2] = bitwise_and_byte_constant
-    else:
-        code += [bitwise_and_byte]
-
-def generate_bitwise_or(size1, size2):
-
-    global code
-    if size1 > 1 or size2 > 1:
-        code += [bitwise_or, size1, size2]
-    elif code[-2] == load_byte:
-        code[-2] = bitwise_or_byte_constant
-    else:
-        code += [bitwise_or_byte]
-
-def generate_bitwise_eor(size1, size2):
-
-    global code
-    if size1 > 1 or size2 > 1:
-        code += [bitwise_eor, size1, size2]
-    elif code[-2] == load_byte:
-        code[-2] = bitwise_eor_byte_constant
-    else:
-        code += [bitwise_eor_byte]
-
-def generate_bitwise_not(size):
-
-    global code
-    if size > 1:
-        code += [load_number, size]
+true = 255
+false = 0
+
+# Operations that always produce a boolean value
+boolean_opcodes = (
+    compare_equals, compare_equals_byte, compare_not_equals,
+    compare_not_equals_byte, compare_less_than, compare_less_than_byte,
+    compare_greater_than, compare_greater_than_byte,
+    compare_equals_byte_constant, compare_not_equals_byte_constant,
+    compare_less_than_byte_constant, compare_greater_than_byte_constant,
+    logical_and, logical_or, logical_not
+    )
+
+# Comparisons and the conditional jumps that perform them, jumping if the
+# result of the comparison would be false
+false_jumps = {
+    compare_equals: jump_if_not_equals,
+    compare_equals_byte: jump_if_not_equals_byte,
+    compare_not_equals: jump_if_equals,
+    compare_not_equals_byte: jump_if_equals_byte,
+    compare_less_than: jump_if_not_less_than,
+    compare_less_than_byte: jump_if_not_less_than_byte,
+    compare_greater_than: jump_if_not_greater_than,
+    compare_greater_than_byte: jump_if_not_greater_than_byte,
+    compare_equals_byte_constant: jump_if_not_equals_byte_constant,
+    compare_not_equals_byte_constant: jump_if_equals_byte_constant,
+    compare_less_than_byte_constant: jump_if_not_less_than_byte_constant,
+    compare_greater_than_byte_constant: jump_if_not_greater_than_byte_constant
+    }
+
+# Switch statements with at least this number of cases are dispatched through
+# a table of addresses if their values cover at least half of the range from
+# the lowest value to the highest.
+jump_table_min_cases = 3
+
+class Generator:
+
+    """Generates code for a program as a list of instructions in the form
+    described in the ir module. The code is lowered to bytes for the base
+    address given when it is complete."""
+    
+    def __init__(self, base_address = 0):
+    
+        self.code = []
+        self.base_address = base_address
+    
+    # Code maintenance functions
+    
+    def discard_code(self, address):
+    
+        self.code[:] = self.code[:address]
+    
+    def fix_returns(self, code_start):
+    
+        # Replace the returns in the code for a function with jumps to the end
+        # of the function.
+        label = ir.Label()
+        
+        i = code_start
+        while i < len(self.code):
+            if self.code[i][0] == "exit_function":
+                self.code[i] = [jump, label]
+            i += 1
+        
+        self.code.append(["label", label])
+    
+    def lower(self, function_label):
+    
+        return ir.lower(self.code, self.base_address, function_label)
+    
+    # Generation functions
+    
+    def generate_number(self, token, size, base):
+    
+        value = int(token, base)
+        if size > 1:
+            instruction = [load_number, size]
+        else:
+            instruction = [load_byte]
+        
         i = 0
         while i < size:
-            code += [0xff]
+            instruction.append(value & 0xff)
+            value = value >> 8
             i += 1
-        code += [bitwise_eor, size, size]
-    else:
-        code += [load_byte, 0xff, bitwise_eor_byte]
-
-def generate_left_shift(size):
-
-    global code
-    code += [left_shift, size]
-
-def generate_right_shift(size):
-
-    global code
-    code += [right_shift, size]
-
-def generate_if():
-
-    global code
-    offset = len(code)
-    code += [jump_if_false, None, None]
-    return offset
-
-def generate_else():
-
-    global code
-    offset = len(code)
-    code += [jump, None, None]
-    return offset
-
-def generate_while():
-
-    global code
-    offset = len(code)
-    code += [jump_if_false, None, None]
-    return offset
-
-def generate_target(address):
-
-    global code
-    target = base_address + len(code)
-    i = 0
-    while i < address_size:
-        code[address + i + 1] = target & 0xff
-        target = target >> 8
-        i += 1
-
-def generate_branch(address):
-
-    global code
-    offset = address - len(code)
-    if offset < 0:
-        if offset > -255:
-            code += [branch_backward, -offset]
-            return
-    else:
-        if offset <= 255:
-            code += [branch_forward, offset]
-            return
-    
-    code += [jump]
-    address += base_address
-    i = 0
-    while i < address_size:
-        code += [address & 0xff]
-        address = address >> 8
-        i += 1
-
-def generate_load_local(offset, size):
-
-    global code
-    if size > 1:
-        code += [load_local, offset, size]
-    else:
-        code += [load_local_byte, offset]
-
-def generate_load_global(offset, size):
-
-    global code
-    if size > 1:
-        code += [load_global, offset, size]
-    else:
-        code += [load_global_byte, offset]
-
-def generate_assign_local(offset, size):
-
-    global code
-    if size > 1:
-        code += [assign_local, offset, size]
-    else:
-        code += [assign_local_byte, offset]
-
-def generate_assign_global(offset, size):
-
-    global code
-    if size > 1:
-        code += [assign_global, offset, size]
-    else:
-        code += [assign_global_byte, offset]
-
-def generate_discard_value(size):
-
-    global code
-    if size > 0:
-        code += [free_stack_space, size]
-
-def generate_return():
-
-    global code
-    code += [function_return]
-
-def generate_allocate_stack_space(size):
-
-    global code
-    code += [allocate_stack_space, size]
-
-def generate_push_parent_frame():
-
-    global code
+        
+        self.code.append(instruction)
     
-    # Push the current frame register onto the value stack.
-    code += [load_current_frame_address]
-
-def generate_enter_frame(param_size, var_size):
-
-    global code
+    def generate_boolean(self, value, size):
     
-    # Put the stack top address, minus the number of bytes for the parameters
-    # in the current frame register.
-    code += [store_stack_top_in_current_frame, param_size]
+        if size > 1:
+            instruction = [load_number, size]
+        else:
+            instruction = [load_byte]
+        
+        i = 0
+        while i < size:
+            instruction.append(value & 0xff)
+            value = value >> 8
+            i += 1
+        
+        self.code.append(instruction)
     
-    # Allocate enough space for the local variables.
-    code += [allocate_stack_space, var_size]
-
-def generate_function_call(address):
-
-    global code
-    code += [function_call]
-    i = 0
-    while i < address_size:
-        code += [address & 0xff]
-        address = address >> 8
-        i += 1
-
-def generate_function_tidy(total_size, return_size):
-
-    global code
+    def generate_string(self, token, size):
     
-    # Pop bytes from the value stack that correspond to the parameters, local
-    # variables and return value.
-    code += [free_stack_space, total_size + return_size]
+        instruction = [load_number, size]
+        i = 0
+        while i < size:
+            instruction.append(ord(token[i]))
+            i += 1
+        
+        self.code.append(instruction)
     
-    # Restore the previous frame address from the stack.
-    code += [pop_current_frame_address]
+    def generate_equals(self, size):
     
-    # Copy the return value from the top of the stack to the top of the
-    # parent frame. This will automatically include the size of the frame
-    # address that was on the stack.
-    if return_size > 0:
-        code += [copy_value, total_size, return_size]
-
-def generate_exit_function():
-
-    global code
-    code += ["exit_function", None, None]
-
-def generate_system_call(total_args_size):
-
-    global code
+        if size > 1:
+            self.code.append([compare_equals, size])
+        elif self.code[-1][0] == load_byte:
+            self.code[-1] = [compare_equals_byte_constant, self.code[-1][1]]
+        else:
+            self.code.append([compare_equals_byte])
     
-    # The arguments themselves should have already been pushed onto the stack.
-    # The total size allows us to generate code to extract them.
-    code += [sys_call, total_args_size]
-
-def generate_get_variable_address(offset):
-
-    global code
-    code += [get_variable_address, offset]
-
-def generate_load_array_value(offset, size, index_size):
-
-    global code
-    if index_size > 1 or size > 1:
-        code += [load_array_value, offset, index_size, size]
-    else:
-        code += [load_array_byte_value, offset]
-
-def generate_store_array_value(offset, size, index_size):
-
-    global code
-    if index_size > 1 or size > 1:
-        code += [store_array_value, offset, index_size, size]
-    else:
-        code += [store_array_byte_value, offset]
-
-def generate_load_memory_value(size):
-
-    global code
-    if size > 1:
-        code += [load_memory_value, size]
-    else:
-        code += [load_memory_byte_value]
-
-def generate_store_memory_value(size):
-
-    global code
-    if size > 1:
-        code += [store_memory_value, size]
-    else:
-        code += [store_memory_byte_value]
-
-def generate_end():
-
-    global code
-    code += [end]
+    def generate_not_equals(self, size):
+    
+        if size > 1:
+            self.code.append([compare_not_equals, size])
+        elif self.code[-1][0] == load_byte:
+            self.code[-1] = [compare_not_equals_byte_constant,
+                             self.code[-1][1]]
+        else:
+            self.code.append([compare_not_equals_byte])
+    
+    def generate_less_than(self, size):
+    
+        if size > 1:
+            self.code.append([compare_less_than, size])
+        elif self.code[-1][0] == load_byte:
+            self.code[-1] = [compare_less_than_byte_constant, self.code[-1][1]]
+        else:
+            self.code.append([compare_less_than_byte])
+    
+    def generate_greater_than(self, size):
+    
+        if size > 1:
+            self.code.append([compare_greater_than, size])
+        elif self.code[-1][0] == load_byte:
+            self.code[-1] = [compare_greater_than_byte_constant,
+                             self.code[-1][1]]
+        else:
+            self.code.append([compare_greater_than_byte])
+    
+    def generate_add(self, size):
+    
+        if size > 1:
+            self.code.append([add, size])
+        elif self.code[-1][0] == load_byte:
+            self.code[-1] = [add_byte_constant, self.code[-1][1]]
+        else:
+            self.code.append([add_byte])
+    
+    def generate_subtract(self, size):
+    
+        if size > 1:
+            self.code.append([subtract, size])
+        elif self.code[-1][0] == load_byte:
+            self.code[-1] = [subtract_byte_constant, self.code[-1][1]]
+        else:
+            self.code.append([subtract_byte])
+    
+    def generate_multiply(self, size):
+    
+        self.code.append([multiply, size])
+    
+    def generate_divide(self, size):
+    
+        self.code.append([divide, size])
+    
+    # Logical operations only evaluate their second operand if the first does
+    # not determine the result. The code for an and operation has the form
+    #
+    #   <first operand>
+    #   jump_if_false <false>
+    #   <second operand>
+    #   branch <end>
+    #   label <false>
+    #   load_byte 0
+    #   label <end>
+    #
+    # and the code for an or operation has the form
+    #
+    #   <first operand>
+    #   jump_if_false <second>
+    #   load_byte 255
+    #   branch <end>
+    #   label <second>
+    #   <second operand>
+    #   label <end>
+    #
+    # where the second operand is followed by code to convert its value to a
+    # boolean value if it does not already produce one. Jumps that test the
+    # results of comparisons perform the comparisons themselves.
+    
+    def produces_boolean(self):
+    
+        # Return whether the code at the end produces a boolean value.
+        i = len(self.code) - 1
+        while i >= 0 and self.code[i][0] == "label":
+            i -= 1
+        
+        instruction = self.code[i]
+        return instruction[0] in boolean_opcodes or \
+               instruction in ([load_byte, true], [load_byte, false])
+    
+    def generate_jump_if_false(self, label):
+    
+        # Append a jump to the label that is taken if the value produced by
+        # the code at the end is false. A comparison that produces the value
+        # is replaced by a conditional jump that performs it.
+        instruction = self.code[-1]
+        if instruction[0] in false_jumps:
+            self.code[-1] = [false_jumps[instruction[0]]] + instruction[1:] + \
+                            [label]
+        else:
+            self.code.append([jump_if_false, label])
+    
+    def generate_logical_and_start(self):
+    
+        label = ir.Label()
+        self.generate_jump_if_false(label)
+        return label
+    
+    def generate_logical_and(self, false_label):
+    
+        if not self.produces_boolean():
+            self.code.append([jump_if_false, false_label])
+            self.code.append([load_byte, true])
+        
+        end = ir.Label()
+        self.code.append(["branch", end])
+        self.code.append(["label", false_label])
+        self.code.append([load_byte, false])
+        self.code.append(["label", end])
+    
+    def generate_logical_or_start(self):
+    
+        second = ir.Label()
+        end = ir.Label()
+        self.generate_jump_if_false(second)
+        self.code.append([load_byte, true])
+        self.code.append(["branch", end])
+        self.code.append(["label", second])
+        return end
+    
+    def generate_logical_or(self, end):
+    
+        if not self.produces_boolean():
+            false_label = ir.Label()
+            self.code.append([jump_if_false, false_label])
+            self.code.append([load_byte, true])
+            self.code.append(["branch", end])
+            self.code.append(["label", false_label])
+            self.code.append([load_byte, false])
+        
+        self.code.append(["label", end])
+    
+    def generate_logical_not(self):
+    
+        self.code.append([logical_not])
+    
+    def generate_minus(self, size):
+    
+        self.code.append([minus, size])
+    
+    def generate_bitwise_and(self, size1, size2):
+    
+        if size1 > 1 or size2 > 1:
+            self.code.append([bitwise_and, size1, size2])
+        elif self.code[-1][0] == load_byte:
+            self.code[-1] = [bitwise_and_byte_constant, self.code[-1][1]]
+        else:
+            self.code.append([bitwise_and_byte])
+    
+    def generate_bitwise_or(self, size1, size2):
+    
+        if size1 > 1 or size2 > 1:
+            self.code.append([bitwise_or, size1, size2])
+        elif self.code[-1][0] == load_byte:
+            self.code[-1] = [bitwise_or_byte_constant, self.code[-1][1]]
+        else:
+            self.code.append([bitwise_or_byte])
+    
+    def generate_bitwise_eor(self, size1, size2):
+    
+        if size1 > 1 or size2 > 1:
+            self.code.append([bitwise_eor, size1, size2])
+        elif self.code[-1][0] == load_byte:
+            self.code[-1] = [bitwise_eor_byte_constant, self.code[-1][1]]
+        else:
+            self.code.append([bitwise_eor_byte])
+    
+    def generate_bitwise_not(self, size):
+    
+        if size > 1:
+            self.code.append([load_number, size] + [0xff] * size)
+            self.code.append([bitwise_eor, size, size])
+        else:
+            self.code.append([load_byte, 0xff])
+            self.code.append([bitwise_eor_byte])
+    
+    def generate_left_shift(self, size):
+    
+        if self.code[-1][0] == load_byte:
+            self.code[-1] = [left_shift_constant, size, self.code[-1][1]]
+        else:
+            self.code.append([left_shift, size])
+    
+    def generate_right_shift(self, size):
+    
+        if self.code[-1][0] == load_byte:
+            self.code[-1] = [right_shift_constant, size, self.code[-1][1]]
+        else:
+            self.code.append([right_shift, size])
+    
+    def generate_condition_branch(self):
+    
+        # Append a branch to be taken if the condition before it is false,
+        # returning its offset. If the condition is a logical operation, its
+        # operands branch to the target of the branch instead of producing a
+        # value for it to test, so its second operand branches to the target
+        # itself and the first operand of an or operation branches past it.
+        code = self.code
+        
+        if not code or code[-1][0] != "label":
+            self.generate_jump_if_false(None)
+            return len(code) - 1
+        
+        end = code[-1][1]
+        branches = []
+        i = 0
+        while i < len(code) - 4:
+            if code[i] == ["branch", end]:
+                branches.append(i)
+            i += 1
+        
+        if len(code) >= 4 and code[-4] == ["branch", end] and \
+           code[-3][0] == "label" and code[-2] == [load_byte, false]:
+           
+            false_label = code[-3][1]
+            if code[-6:-4] == [[jump_if_false, false_label], [load_byte, true]]:
+                del code[-5:]
+            else:
+                del code[-4:]
+                self.generate_jump_if_false(false_label)
+        
+        elif branches:
+            false_label = ir.Label()
+            del code[-1]
+            self.generate_jump_if_false(false_label)
+        
+        else:
+            self.generate_jump_if_false(None)
+            return len(code) - 1
+        
+        offset = len(code) - 1
+        
+        # Make the first operand of an or operation branch past the test.
+        if branches and code[branches[0] - 1] == [load_byte, true]:
+            del code[branches[0] - 1]
+            code.append(["label", end])
+            offset -= 1
+        
+        return offset
+    
+    def generate_if(self):
+    
+        return self.generate_condition_branch()
+    
+    def generate_else(self):
+    
+        offset = len(self.code)
+        self.code.append([jump, None])
+        return offset
+    
+    def generate_while(self):
+    
+        return self.generate_condition_branch()
+    
+    # The value of a switch statement is tested by an instruction that is
+    # replaced when all the cases have been read. Cases with values that are
+    # close together are dispatched with a jump table, which jumps to the
+    # address for the value in constant time. Otherwise, each value is
+    # compared with the value in turn, which is reloaded from above the top of
+    # the stack after each comparison that removes it, as in
+    #
+    #   jump_if_equals_byte_constant <value 1> <case 1>
+    #   allocate_stack_space 1
+    #   jump_if_equals_byte_constant <value 2> <case 2>
+    #   ...
+    #   branch <default>
+    
+    def generate_switch(self):
+    
+        offset = len(self.code)
+        self.code.append([jump_table])
+        return offset
+    
+    def generate_switch_cases(self, address, cases, default):
+    
+        # Replace the test at the address given with code that jumps to the
+        # label for each value in the list of cases or to the default label.
+        values = map(lambda (value, label): value, cases)
+        low = min(values)
+        count = max(values) - low + 1
+        
+        if len(cases) >= jump_table_min_cases and count <= len(cases) * 2 and \
+           count < 256:
+           
+            table = [default] * count
+            for value, label in cases:
+                table[value - low] = label
+            
+            self.code[address] = [jump_table, low, count, default] + table
+        
+        else:
+            code = []
+            for value, label in cases:
+                if code:
+                    code.append([allocate_stack_space, 1])
+                code.append([jump_if_equals_byte_constant, value, label])
+            
+            code.append(["branch", default])
+            self.code[address:address + 1] = code
+    
+    def generate_loop_local(self, offset, limit, size, label):
+    
+        # Increment the local variable at the offset given and branch to the
+        # label if it is below the local variable at the limit offset.
+        if size > 1:
+            self.code.append([loop_local, offset, limit, size, label])
+        else:
+            self.code.append([loop_local_byte, offset, limit, label])
+    
+    def generate_label(self):
+    
+        label = ir.Label()
+        self.code.append(["label", label])
+        return label
+    
+    def generate_target(self, address):
+    
+        # Make the jump at the address given jump to the current position,
+        # placing the label it already refers to if it has one. The label is
+        # the last operand of the jump.
+        label = self.code[address][-1]
+        if label is None:
+            self.code[address][-1] = self.generate_label()
+        else:
+            self.code.append(["label", label])
+    
+    def generate_branch(self, label):
+    
+        self.code.append(["branch", label])
+    
+    def generate_load_local(self, offset, size):
+    
+        if size > 1:
+            self.code.append([load_local, offset, size])
+        else:
+            self.code.append([load_local_byte, offset])
+    
+    def generate_load_global(self, offset, size):
+    
+        if size > 1:
+            self.code.append([load_global, offset, size])
+        else:
+            self.code.append([load_global_byte, offset])
+    
+    def generate_assign_local(self, offset, size):
+    
+        instruction = self.code[-1]
+        if size > 1 and instruction[:2] == [load_number, size]:
+            self.code[-1] = [assign_local_constant, offset] + instruction[1:]
+        elif size > 1:
+            self.code.append([assign_local, offset, size])
+        elif instruction[0] == load_byte:
+            self.code[-1] = [assign_local_byte_constant, offset,
+                             instruction[1]]
+        else:
+            self.code.append([assign_local_byte, offset])
+    
+    def generate_assign_global(self, offset, size):
+    
+        instruction = self.code[-1]
+        if size > 1 and instruction[:2] == [load_number, size]:
+            self.code[-1] = [assign_global_constant, offset] + instruction[1:]
+        elif size > 1:
+            self.code.append([assign_global, offset, size])
+        elif instruction[0] == load_byte:
+            self.code[-1] = [assign_global_byte_constant, offset,
+                             instruction[1]]
+        else:
+            self.code.append([assign_global_byte, offset])
+    
+    def generate_discard_value(self, size):
+    
+        if size > 0:
+            self.code.append([free_stack_space, size])
+    
+    def generate_return(self):
+    
+        self.code.append([function_return])
+    
+    def generate_allocate_stack_space(self, size):
+    
+        self.code.append([allocate_stack_space, size])
+    
+    def generate_push_parent_frame(self):
+    
+    
+        # Push the current frame register onto the value stack.
+        self.code.append([load_current_frame_address])
+    
+    def generate_enter_frame(self, param_size, var_size):
+    
+    
+        # Put the stack top address, minus the number of bytes for the parameters
+        # in the current frame register.
+        self.code.append([store_stack_top_in_current_frame, param_size])
+        
+        # Allocate enough space for the local variables.
+        self.code.append([allocate_stack_space, var_size])
+    
+    def generate_function_call(self, name):
+    
+        self.code.append([function_call, name])
+    
+    def generate_function_tidy(self, total_size, return_size):
+    
+    
+        # Pop bytes from the value stack that correspond to the parameters, local
+        # variables and return value.
+        self.code.append([free_stack_space, total_size + return_size])
+        
+        # Restore the previous frame address from the stack.
+        self.code.append([pop_current_frame_address])
+        
+        # Copy the return value from the top of the stack to the top of the
+        # parent frame. This will automatically include the size of the frame
+        # address that was on the stack.
+        if return_size > 0:
+            self.code.append([copy_value, total_size, return_size])
+    
+    def generate_exit_function(self):
+    
+        self.code.append(["exit_function"])
+    
+    def generate_system_call(self, total_args_size):
+    
+    
+        # The arguments themselves should have already been pushed onto the stack.
+        # The total size allows us to generate code to extract them.
+        self.code.append([sys_call, total_args_size])
+    
+    def generate_get_variable_address(self, offset):
+    
+        self.code.append([get_variable_address, offset])
+    
+    def constant_element(self, index, offset, size, index_size):
+    
+        # Return the offset of the array element whose index is loaded by the
+        # instruction at the index given if it is a constant, or None if it
+        # is not. Arrays are held in the current frame in the same way as
+        # local variables, so the element is a variable with a known offset.
+        value = strength.constant_value(self.code[index], index_size)
+        if value is None or offset + (value * size) > 255:
+            return None
+        
+        return offset + (value * size)
+    
+    def generate_load_array_value(self, offset, size, index_size):
+    
+        element = self.constant_element(len(self.code) - 1, offset, size,
+                                        index_size)
+        if element is not None:
+            del self.code[-1]
+            self.generate_load_local(element, size)
+        elif index_size > 1 or size > 1:
+            self.code.append([load_array_value, offset, index_size, size])
+        else:
+            self.code.append([load_array_byte_value, offset])
+    
+    def generate_store_array_value(self, offset, size, index_size,
+                                   value_start):
+    
+        # The index is loaded before the value, which is loaded by the code
+        # from the value start given.
+        element = self.constant_element(value_start - 1, offset, size,
+                                        index_size)
+        if element is not None:
+            del self.code[value_start - 1]
+            self.generate_assign_local(element, size)
+        elif index_size > 1 or size > 1:
+            self.code.append([store_array_value, offset, index_size, size])
+        else:
+            self.code.append([store_array_byte_value, offset])
+    
+    def generate_load_memory_value(self, size):
+    
+        if size > 1:
+            self.code.append([load_memory_value, size])
+        else:
+            self.code.append([load_memory_byte_value])
+    
+    def generate_store_memory_value(self, size):
+    
+        if size > 1:
+            self.code.append([store_memory_value, size])
+        else:
+            self.code.append([store_memory_byte_value])
+    
+    def generate_end(self):
+    
+        self.code.append([end])
@@ -0,0 +1,221 @@
+"""
+inlining.py - Substitution of small function bodies at their call sites.
+
+Copyright (C) 2014 David Boddie <david@boddie.org.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# The pass works on code in the form described in the ir module. A caller
+# pushes its frame address and the arguments for a call before calling the
+# function, which makes a frame over the arguments on entry and restores the
+# caller's frame before returning.
+#
+# When a function that makes no calls of its own is inlined in another
+# function, its parameters and local variables are held in new variables in
+# the frame of the caller instead. The arguments are assigned to the new
+# variables that hold the parameters, and the code of the function is copied
+# with the offsets of its variables changed to those of the new variables, so
+# the caller's frame is not pushed and the function's frame is not made. The
+# new variables are shared by all the functions inlined in a caller, since
+# each inlined function finishes using them before the next one starts.
+#
+# Other functions, and functions called from the main program, where the
+# frame holds the global variables, are inlined with the code that makes
+# their frames, so the parameters are read from where the caller stored the
+# arguments and only the call, the return and the return address are removed.
+#
+# Each call site is inlined if the number of bytes that this adds to the code
+# is no more than the threshold multiplied by the number of instructions that
+# no longer need to be dispatched when the function is called.
+
+import callgraph, ir, loops, tailcalls
+from opcodes import *
+
+# The operands of instructions that are offsets in the current frame
+frame_offsets = {
+    load_local: (1,), load_local_byte: (1,), assign_local: (1,),
+    assign_local_byte: (1,), assign_local_constant: (1,),
+    assign_local_byte_constant: (1,), get_variable_address: (1,),
+    load_array_value: (1,), load_array_byte_value: (1,),
+    store_array_value: (1,), store_array_byte_value: (1,),
+    loop_local: (1, 2), loop_local_byte: (1, 2)
+    }
+
+# Instructions that call functions or change the current frame
+frame_changes = (load_current_frame_address, store_stack_top_in_current_frame,
+                 pop_current_frame_address, function_call)
+
+def function_bodies(code, extents):
+
+    # Return a dictionary mapping the label of each function in the extents
+    # that can be inlined to its code without the label and final return.
+    # Returns from the body of a function are jumps to its end, so functions
+    # with any other returns are not inlined.
+    bodies = {}
+    for label, (start, end) in extents.items():
+        body = code[start + 1:end]
+        returns = filter(lambda instruction: instruction[0] == function_return,
+                         body)
+        if len(returns) == 1 and body and body[-1][0] == function_return:
+            bodies[label] = body[:-1]
+    
+    return bodies
+
+def leaf_body(code, start, end):
+
+    """Returns the code of the function with code between the start and end
+    given without the instructions that make and remove its frame, and the
+    size of its parameters and local variables, or None if the function calls
+    other functions or its frame cannot be removed."""
+    
+    frame = loops.frame_instructions(code, start, end)
+    if frame is None:
+        return None
+    
+    allocate, free, copy = frame
+    if copy is None:
+        last = free + 1
+    else:
+        last = copy
+    
+    if last != end - 2:
+        return None
+    
+    body = code[allocate + 1:free]
+    for instruction in body:
+        if instruction[0] in frame_changes:
+            return None
+    
+    return body, code[allocate - 1][1] + code[allocate][1]
+
+def moved(code, base):
+
+    # Return a copy of the code with the offsets of the variables it uses
+    # moved by the base offset given.
+    new_code = ir.copy_code(code)
+    for instruction in new_code:
+        for i in frame_offsets.get(instruction[0], ()):
+            instruction[i] += base
+    
+    return new_code
+
+def dispatches(code):
+
+    return len(filter(lambda instruction: instruction[0] != "label", code))
+
+def inline_functions(code, functions, start_label, function_label, threshold):
+
+    """Replaces calls to functions with copies of their code where the bytes
+    added by each copy are no more than the threshold multiplied by the number
+    of instructions that are no longer dispatched, leaving recursive functions
+    in place. Returns a list of the call sites inlined, each given as the
+    names of the calling and called functions, with None used for the main
+    program, the number of bytes in the code inlined and the number of
+    instructions no longer dispatched."""
+    
+    names = {start_label: None}
+    parameters = {}
+    for function in functions:
+        names[function[3]] = function[0]
+        parameters[function[3]] = function[1]
+    
+    extents = callgraph.function_extents(code, set(names.keys()))
+    del extents[start_label]
+    
+    recursive = callgraph.recursive(
+        callgraph.calls(code, extents, function_label))
+    
+    candidates = {}
+    for label, body in function_bodies(code, extents).items():
+        if label not in recursive:
+            start, end = extents[label]
+            candidates[label] = (body, leaf_body(code, start, end))
+    
+    # Find the offset after the variables in the frame of each function,
+    # where new variables for inlined functions are placed.
+    bases = {}
+    for label, (start, end) in extents.items():
+        frame = loops.frame_instructions(code, start, end)
+        if frame is not None:
+            bases[label] = code[frame[0] - 1][1] + code[frame[0]][1]
+    
+    inlined = []
+    new_code = []
+    caller = None
+    
+    # The indices in the new code of the instructions that push the caller's
+    # frame for the calls being prepared. Calls inlined with their frames
+    # leave these in place, so they are recorded before the calls are made.
+    pushes = []
+    
+    # The size of the new variables needed in each function
+    sizes = {}
+    
+    for instruction in code:
+    
+        if instruction[0] == "label" and instruction[1] in names:
+            caller = instruction[1]
+        
+        elif instruction[0] == load_current_frame_address:
+            pushes.append(len(new_code))
+        
+        elif instruction[0] == function_call:
+        
+            first = pushes.pop()
+            label = function_label(instruction[1])
+            if label not in candidates:
+                new_code.append(instruction)
+                continue
+            
+            body, leaf = candidates[label]
+            base = bases.get(caller)
+            
+            if leaf is not None and base is not None and base + leaf[1] <= 256:
+                # Assign the arguments to the new variables for the parameters
+                # instead of pushing the caller's frame.
+                removed = [new_code[first], instruction]
+                new_body = moved(tailcalls.assign_parameters(
+                    parameters[label]) + leaf[0], base)
+            else:
+                first = None
+                removed = [instruction]
+                new_body = ir.copy_code(body)
+            
+            saved = len(removed) + dispatches(body) + 1 - dispatches(new_body)
+            size = ir.code_size(new_body)
+            
+            if size - ir.code_size(removed) > threshold * saved:
+                new_code.append(instruction)
+                continue
+            
+            if first is not None:
+                del new_code[first]
+                sizes[caller] = max(sizes.get(caller, 0), leaf[1])
+            
+            new_code += new_body
+            inlined.append((names[caller], instruction[1], size, saved))
+            continue
+        
+        new_code.append(instruction)
+    
+    # Add the new variables to the frames of the functions that need them.
+    extents = callgraph.function_extents(new_code, set(names.keys()))
+    for label, size in sizes.items():
+        start, end = extents[label]
+        loops.add_variable(new_code, loops.frame_instructions(new_code, start, end),
+                           size)
+    
+    code[:] = new_code
+    return inlined
@@ -0,0 +1,234 @@
+"""
+ir.py - Intermediate representation of generated code and its lowering.
+
+Copyright (C) 2014 David Boddie <david@boddie.org.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Code is held as a list of instructions, each of which is a list containing
+# an opcode followed by its operands. Operands are either byte values, labels,
+# which are lowered to the address of the instruction after the label, or
+# strings, which are lowered to the address of the function with that name.
+#
+# The following pseudo-instructions do not correspond to opcodes:
+#
+#   ["label", <label>]          marks the position of the label
+#   ["branch", <label>]         a short branch or a jump to the label
+#   ["exit_function"]           a return from a function, replaced with a
+#                               jump to the end of the function
+#
+# Jumps to labels, whether conditional or not, are encoded as short branches
+# when their targets are near enough.
+
+from opcodes import *
+
+class Label:
+
+    """Marks a position in the code. Labels are compared by identity, so each
+    label is only defined once in a program."""
+    
+    def __repr__(self):
+    
+        return "<label %x>" % id(self)
+
+def is_label(operand):
+
+    return isinstance(operand, Label)
+
+def copy_code(code):
+
+    # Return a copy of the instructions given, with new labels in place of
+    # those defined in them so that the copy can be used alongside the
+    # original.
+    labels = {}
+    for instruction in code:
+        if instruction[0] == "label":
+            labels[instruction[1]] = Label()
+    
+    new_code = []
+    for instruction in code:
+        new_instruction = []
+        for operand in instruction:
+            if is_label(operand):
+                operand = labels.get(operand, operand)
+            new_instruction.append(operand)
+        new_code.append(new_instruction)
+    
+    return new_code
+
+def operand_size(operand):
+
+    if is_label(operand) or isinstance(operand, str):
+        return address_size
+    else:
+        return 1
+
+# The short branches for each kind of jump, going forwards and backwards
+short_branch_opcodes = {
+    "branch": (branch_forward, branch_backward),
+    jump: (branch_forward, branch_backward),
+    jump_if_false: (branch_forward_if_false, branch_backward_if_false)
+    }
+
+def is_branch(instruction):
+
+    # Return whether the instruction can be encoded as a short branch.
+    return instruction[0] in short_branch_opcodes and is_label(instruction[1])
+
+def instruction_size(instruction, short):
+
+    opcode = instruction[0]
+    
+    if opcode == "label":
+        return 0
+    elif short:
+        return 1 + branch_size
+    elif opcode == "branch":
+        return 1 + address_size
+    
+    size = 1
+    for operand in instruction[1:]:
+        size += operand_size(operand)
+    
+    return size
+
+def in_branch_range(offset):
+
+    # Return whether a branch over the given offset can be encoded in a short
+    # branch instruction. The 6502 routines add the size of the branch to the
+    # offset of a backward branch in a single byte.
+    if offset < 0:
+        return -offset + 1 + branch_size <= 255
+    else:
+        return offset <= 255
+
+def find_labels(code, short_branches):
+
+    # Return a dictionary mapping the labels in the code to their positions
+    # and a list of the positions of the instructions.
+    labels = {}
+    positions = []
+    position = 0
+    
+    i = 0
+    for instruction in code:
+        positions.append(position)
+        if instruction[0] == "label":
+            labels[instruction[1]] = position
+        position += instruction_size(instruction, i in short_branches)
+        i += 1
+    
+    return labels, positions
+
+def relax_branches(code):
+
+    # Return the set of indices of branches that can be encoded as short
+    # branches, the positions of the labels and the positions of the
+    # instructions. Start with all branches short and lengthen those whose
+    # targets are out of range until all of them are encoded correctly.
+    short_branches = set()
+    i = 0
+    for instruction in code:
+        if is_branch(instruction):
+            short_branches.add(i)
+        i += 1
+    
+    while True:
+        labels, positions = find_labels(code, short_branches)
+        
+        changed = False
+        for i in list(short_branches):
+            offset = labels[code[i][1]] - positions[i]
+            if not in_branch_range(offset):
+                short_branches.remove(i)
+                changed = True
+        
+        if not changed:
+            break
+    
+    return short_branches, labels, positions
+
+def code_size(code):
+
+    """Returns the number of bytes that the code given is lowered to. Any
+    branches in the code must be to labels in it."""
+    
+    if not code:
+        return 0
+    
+    short_branches, labels, positions = relax_branches(code)
+    last = len(code) - 1
+    return positions[last] + instruction_size(code[last], last in short_branches)
+
+def lower(code, base_address, function_label):
+
+    """Returns the bytes for the code given, located at the base address, and
+    a dictionary mapping each label in the code to its address. The function
+    label given is called to obtain the label for each function called.
+    
+    Branches and jumps are encoded as short branches where their targets are
+    near enough, otherwise as jumps."""
+    
+    short_branches, labels, positions = relax_branches(code)
+    
+    addresses = {}
+    for label, position in labels.items():
+        addresses[label] = base_address + position
+    
+    data = []
+    i = 0
+    for instruction in code:
+    
+        opcode = instruction[0]
+        
+        if opcode == "label":
+            pass
+        
+        elif i in short_branches:
+            forward, backward = short_branch_opcodes[opcode]
+            offset = labels[instruction[1]] - positions[i]
+            if offset < 0:
+                data += [backward, -offset]
+            else:
+                data += [forward, offset]
+        
+        elif opcode == "branch":
+            data.append(jump)
+            data += address_bytes(addresses[instruction[1]])
+        
+        else:
+            data.append(opcode)
+            for operand in instruction[1:]:
+                if is_label(operand):
+                    data += address_bytes(addresses[operand])
+                elif isinstance(operand, str):
+                    data += address_bytes(addresses[function_label(operand)])
+                else:
+                    data.append(operand)
+        
+        i += 1
+    
+    return data, addresses
+
+def address_bytes(address):
+
+    data = []
+    i = 0
+    while i < address_size:
+        data.append(address & 0xff)
+        address = address >> 8
+        i += 1
+    
+    return data
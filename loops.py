@@ -0,0 +1,429 @@
+"""
+loops.py - Hoisting of loop-invariant expressions out of loops.
+
+Copyright (C) 2014 David Boddie <david@boddie.org.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# The pass works on code in the form described in the ir module. A loop runs
+# from a label to the last instruction that jumps back to it, where nothing
+# before the label jumps to it and nothing outside the loop jumps to the
+# labels inside it, so the loop can only be entered through its first label.
+# The code for while and for loops has this form.
+#
+# Since operations take their operands from the stack, an expression is a run
+# of instructions, not broken by labels, that pushes a single value and has
+# no other effect. An expression containing at least one operation, whose
+# operands are constants, addresses of local variables or variables that are
+# not changed in the loop, produces the same value on every iteration. It is
+# computed once before the first label of the loop and stored in a new
+# variable, and the expression in the loop is replaced by a load of it.
+#
+# New variables are added to the frame of the function containing the loop
+# by increasing the space allocated and freed by the function. Loops in the
+# main program and in the code of inlined functions are left unchanged.
+
+import callgraph, ir
+from opcodes import *
+
+# Operations without side effects, each with the number of values it takes
+# from the stack
+operations = {
+    compare_equals: 2, compare_equals_byte: 2,
+    compare_not_equals: 2, compare_not_equals_byte: 2,
+    compare_less_than: 2, compare_less_than_byte: 2,
+    compare_greater_than: 2, compare_greater_than_byte: 2,
+    compare_equals_byte_constant: 1, compare_not_equals_byte_constant: 1,
+    compare_less_than_byte_constant: 1, compare_greater_than_byte_constant: 1,
+    add: 2, add_byte: 2, add_byte_constant: 1,
+    subtract: 2, subtract_byte: 2, subtract_byte_constant: 1,
+    logical_and: 2, logical_or: 2, logical_not: 1, minus: 1,
+    bitwise_and: 2, bitwise_and_byte: 2, bitwise_and_byte_constant: 1,
+    bitwise_or: 2, bitwise_or_byte: 2, bitwise_or_byte_constant: 1,
+    bitwise_eor: 2, bitwise_eor_byte: 2, bitwise_eor_byte_constant: 1,
+    left_shift: 2, right_shift: 2,
+    left_shift_constant: 1, right_shift_constant: 1
+    }
+
+# Instructions that can change any variable
+memory_writes = (
+    store_array_value, store_array_byte_value, store_memory_value,
+    store_memory_byte_value, sys_call
+    )
+
+def value_size(instruction):
+
+    # Return the size of the value pushed by the instruction if it is an
+    # operation or an instruction that loads a value without using the stack,
+    # or None if it is not.
+    opcode = instruction[0]
+    
+    if opcode in (load_byte, load_local_byte, load_global_byte):
+        return 1
+    elif opcode == load_number:
+        return instruction[1]
+    elif opcode in (load_local, load_global):
+        return instruction[2]
+    elif opcode == get_variable_address:
+        return address_size
+    elif opcode in (add, subtract, minus, left_shift, right_shift,
+                    left_shift_constant, right_shift_constant):
+        return instruction[1]
+    elif opcode in (bitwise_and, bitwise_or, bitwise_eor):
+        return instruction[2]
+    elif opcode in operations:
+        return 1
+    else:
+        return None
+
+def overlaps(offset, size, ranges):
+
+    for start, length in ranges:
+        if offset < start + length and start < offset + size:
+            return True
+    
+    return False
+
+def assigned_variables(loop, addresses_taken):
+
+    # Return lists of the offsets and sizes of the local and global variables
+    # assigned in the loop, with None in place of a list if any variable of
+    # that kind may be changed.
+    local_ranges = []
+    global_ranges = []
+    any_local = any_global = False
+    
+    for instruction in loop:
+    
+        opcode = instruction[0]
+        
+        if opcode in memory_writes:
+            any_local = any_global = True
+        elif opcode == function_call:
+            # Called functions can assign global variables, and local
+            # variables if their addresses are passed to them.
+            any_global = True
+            any_local = any_local or addresses_taken
+        elif opcode in (assign_local, assign_local_constant):
+            local_ranges.append((instruction[1], instruction[2]))
+        elif opcode == loop_local:
+            local_ranges.append((instruction[1], instruction[3]))
+        elif opcode in (assign_local_byte, assign_local_byte_constant,
+                        loop_local_byte):
+            local_ranges.append((instruction[1], 1))
+        elif opcode in (assign_global, assign_global_constant):
+            global_ranges.append((instruction[1], instruction[2]))
+        elif opcode in (assign_global_byte, assign_global_byte_constant):
+            global_ranges.append((instruction[1], 1))
+    
+    if any_local:
+        local_ranges = None
+    if any_global:
+        global_ranges = None
+    
+    return local_ranges, global_ranges
+
+def is_invariant(instruction, local_ranges, global_ranges):
+
+    # Return whether the instruction, which loads a value without using the
+    # stack, loads the same value on every iteration of the loop.
+    opcode = instruction[0]
+    
+    if opcode in (load_local, load_local_byte):
+        return local_ranges is not None and \
+               not overlaps(instruction[1], value_size(instruction), local_ranges)
+    elif opcode in (load_global, load_global_byte):
+        return global_ranges is not None and \
+               not overlaps(instruction[1], value_size(instruction), global_ranges)
+    else:
+        return True
+
+def invariant_expressions(code, start, end, local_ranges, global_ranges):
+
+    """Returns a list of the invariant expressions in the code between the
+    start and end given that are not part of larger invariant expressions,
+    each given as the indices of its first instruction and the instruction
+    after its last, and the size of its value."""
+    
+    found = []
+    
+    # Each entry on the stack holds the indices of the instructions that
+    # produce a value, whether the value is invariant and whether it is
+    # produced by an operation.
+    stack = []
+    
+    i = start
+    while i < end:
+    
+        instruction = code[i]
+        opcode = instruction[0]
+        size = value_size(instruction)
+        
+        if size is not None and opcode not in operations:
+            stack.append((i, i + 1, size,
+                          is_invariant(instruction, local_ranges, global_ranges),
+                          False))
+        
+        elif size is not None and len(stack) >= operations[opcode]:
+            operands = stack[len(stack) - operations[opcode]:]
+            del stack[len(stack) - operations[opcode]:]
+            
+            invariant = True
+            for first, last, value_bytes, operand_invariant, operation in operands:
+                invariant = invariant and operand_invariant
+            
+            if not invariant:
+                found += hoistable(operands)
+            
+            stack.append((operands[0][0], i + 1, size, invariant, True))
+        
+        else:
+            # The instruction uses the values on the stack in some other way
+            # or the code after it can be reached from elsewhere.
+            found += hoistable(stack)
+            stack = []
+        
+        i += 1
+    
+    found += hoistable(stack)
+    return found
+
+def hoistable(entries):
+
+    expressions = []
+    for first, last, size, invariant, operation in entries:
+        if invariant and operation:
+            expressions.append((first, last, size))
+    
+    return expressions
+
+def find_loops(code):
+
+    """Returns a list of the loops in the code, each given as the indices of
+    the label at its start and the last instruction that jumps back to it."""
+    
+    positions = {}
+    references = {}
+    
+    i = 0
+    for instruction in code:
+        if instruction[0] == "label":
+            positions[instruction[1]] = i
+        else:
+            for operand in instruction[1:]:
+                if ir.is_label(operand):
+                    references.setdefault(operand, []).append(i)
+        i += 1
+    
+    loops = []
+    for label, indices in references.items():
+    
+        start = positions.get(label)
+        if start is None or min(indices) < start:
+            continue
+        
+        end = max(indices)
+        
+        # Check that the labels in the loop are only used inside it.
+        closed = True
+        i = start + 1
+        while i <= end and closed:
+            if code[i][0] == "label":
+                for j in references.get(code[i][1], []):
+                    if j < start or j > end:
+                        closed = False
+            i += 1
+        
+        if closed:
+            loops.append((start, end))
+    
+    return loops
+
+def frame_instructions(code, start, end):
+
+    """Returns the indices of the instruction that allocates the space for
+    the variables of the function with code between the start and end given,
+    the instruction that frees it and the instruction that copies the return
+    value past it, or None if the code does not have the expected form. The
+    last index is None if the function does not return a value."""
+    
+    if code[start + 1][0] != store_stack_top_in_current_frame or \
+       code[start + 2][0] != allocate_stack_space:
+        return None
+    
+    i = end - 1
+    while i > start + 2 and code[i][0] != pop_current_frame_address:
+        i -= 1
+    
+    if code[i - 1][0] != free_stack_space:
+        return None
+    
+    if code[i + 1][0] == copy_value:
+        return start + 2, i - 1, i + 1
+    else:
+        return start + 2, i - 1, None
+
+def add_variable(code, frame, size):
+
+    """Adds a variable of the size given to the frame of a function, given
+    as the indices returned by frame_instructions, returning its offset. The
+    new variable follows the parameters and other variables."""
+    
+    allocate, free, copy = frame
+    offset = code[allocate - 1][1] + code[allocate][1]
+    
+    code[allocate][1] += size
+    code[free][1] += size
+    if copy is not None:
+        code[copy][1] += size
+    
+    return offset
+
+def in_own_frame(code, first, start, end):
+
+    # Return whether the loop between the start and end given uses the frame
+    # of the function whose body, after the instructions that make its frame,
+    # starts at the first index given, rather than the frames made by the
+    # code of inlined functions.
+    depth = 0
+    i = first
+    while i <= end:
+        if code[i][0] == store_stack_top_in_current_frame:
+            depth += 1
+        elif code[i][0] == pop_current_frame_address:
+            depth -= 1
+        if depth != 0 and i >= start:
+            return False
+        i += 1
+    
+    return True
+
+def hoist_loop(code, start, end, frame, addresses_taken):
+
+    # Move the invariant expressions in the loop between the start and end
+    # given to new variables assigned before it, returning the expressions
+    # moved.
+    local_ranges, global_ranges = assigned_variables(code[start:end + 1],
+                                                     addresses_taken)
+    expressions = invariant_expressions(code, start, end + 1, local_ranges,
+                                        global_ranges)
+    if not expressions:
+        return []
+    
+    # The expressions are not found in the order in which they occur, so sort
+    # them by their first instructions, skipping any that overlap others, and
+    # record the code of each before any of it is replaced.
+    expressions.sort()
+    replacements = []
+    end_of_previous = start
+    
+    for first, last, size in expressions:
+        if first >= end_of_previous:
+            replacements.append((first, last, repr(code[first:last]), size))
+            end_of_previous = last
+    
+    # Identical expressions share a variable.
+    variables = {}
+    hoisted = []
+    preheader = []
+    
+    for first, last, key, size in replacements:
+    
+        if key in variables:
+            continue
+        
+        offset = add_variable(code, frame, size)
+        if size > 1:
+            load = [load_local, offset, size]
+            assign = [assign_local, offset, size]
+        else:
+            load = [load_local_byte, offset]
+            assign = [assign_local_byte, offset]
+        
+        expression = map(list, code[first:last])
+        variables[key] = load
+        hoisted.append(expression)
+        preheader += expression + [assign]
+    
+    # Replace the expressions from the last to the first so that the indices
+    # of those still to be replaced are not affected.
+    replacements.reverse()
+    for first, last, key, size in replacements:
+        code[first:last] = [list(variables[key])]
+    
+    code[start:start] = preheader
+    return hoisted
+
+def hoist_invariants(code, functions, start_label):
+
+    """Moves expressions that produce the same value on every iteration of
+    the loops in functions out of the loops, storing their values in new
+    local variables. Loops are changed from the innermost outwards. Returns
+    a list of the loops changed, each given as the name of the function
+    containing it, the number of the loop in the function counting from the
+    first, and the list of the expressions moved out of it. The main program
+    starts at the start label given."""
+    
+    names = {start_label: None}
+    for function in functions:
+        names[function[3]] = function[0]
+    
+    changed = []
+    done = set()
+    
+    while True:
+    
+        pending = []
+        for start, end in find_loops(code):
+            if code[start][1] not in done:
+                pending.append((end - start, start, end))
+        
+        if not pending:
+            break
+        
+        pending.sort()
+        length, start, end = pending[0]
+        done.add(code[start][1])
+        
+        # Find the function containing the loop.
+        extents = callgraph.function_extents(code, set(names.keys()))
+        for label, (first, last) in extents.items():
+            if first < start <= end < last:
+                break
+        else:
+            continue
+        
+        if label is start_label:
+            continue
+        
+        frame = frame_instructions(code, first, last)
+        if frame is None or not in_own_frame(code, frame[0] + 1, start, end):
+            continue
+        
+        addresses_taken = False
+        for instruction in code[first:last]:
+            if instruction[0] == get_variable_address:
+                addresses_taken = True
+        
+        number = 1
+        for loop_start, loop_end in find_loops(code):
+            if first < loop_start < start:
+                number += 1
+        
+        hoisted = hoist_loop(code, start, end, frame, addresses_taken)
+        if hoisted:
+            changed.append((names[label], number, hoisted))
+    
+    return changed
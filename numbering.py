@@ -0,0 +1,372 @@
+"""
+numbering.py - Reuse of values computed earlier in the same basic block.
+
+Copyright (C) 2014 David Boddie <david@boddie.org.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# The pass works on code in the form described in the ir module, following
+# the values pushed onto the stack by the code of each function in the same
+# way as the loops module. Each value is given a number, with values loaded
+# from the same place or produced by the same operation on values with the
+# same numbers given the same number. When a value with a number that has
+# been seen before in the same basic block is produced again, the first value
+# is stored in a new variable when it is produced and the instructions that
+# produce it again are replaced by a load of the variable.
+#
+# A value is no longer reused after an assignment to one of the variables it
+# was loaded from. Arrays are held in the frame, so values loaded from them
+# depend on the variables from the start of the array to the end of the
+# frame. Stores to arrays and memory, function calls and system calls can
+# change any variable, so no values are reused across them. Since there is no
+# instruction that duplicates a value on the stack, storing and loading a
+# value takes two instructions, so only values produced by at least three
+# instructions are reused.
+#
+# The new variables are only used within a basic block, so those used in
+# different blocks share the same space in the frame of the function. Code in
+# the main program and in inlined functions is left unchanged.
+
+import callgraph, loops
+from opcodes import *
+
+# The minimum number of instructions that a reused value must be produced by
+minimum_weight = 3
+
+# Instructions that load values from arrays or memory, each with the number
+# of values they take from the stack
+memory_loads = {
+    load_array_value: 1, load_array_byte_value: 1,
+    load_memory_value: 1, load_memory_byte_value: 1
+    }
+
+# Instructions that can change any variable
+memory_writes = loops.memory_writes + (function_call,)
+
+# Instructions that start a new basic block or a new frame
+boundaries = ("label", store_stack_top_in_current_frame,
+              pop_current_frame_address)
+
+class Temporary:
+
+    """Represents a new variable holding a reused value until its offset in
+    the frame is known."""
+    
+    def __init__(self, size, block):
+    
+        self.size = size
+        self.block = block
+        self.offset = None
+
+def load_temporary(temporary):
+
+    if temporary.size > 1:
+        return [load_local, temporary, temporary.size]
+    else:
+        return [load_local_byte, temporary]
+
+def assign_temporary(temporary):
+
+    if temporary.size > 1:
+        return [assign_local, temporary, temporary.size]
+    else:
+        return [assign_local_byte, temporary]
+
+def value_size(instruction):
+
+    # Return the size of the value pushed by the instruction, or None if the
+    # instruction is not one that only produces a value.
+    opcode = instruction[0]
+    
+    if opcode == load_array_value:
+        return instruction[3]
+    elif opcode == load_memory_value:
+        return instruction[1]
+    elif opcode in memory_loads:
+        return 1
+    else:
+        return loops.value_size(instruction)
+
+def operand_count(opcode):
+
+    if opcode in loops.operations:
+        return loops.operations[opcode]
+    else:
+        return memory_loads.get(opcode, 0)
+
+def dependencies(instruction):
+
+    # Return the offsets and sizes of the local and global variables that the
+    # value loaded by the instruction depends on, and whether it depends on
+    # the contents of arrays or memory.
+    opcode = instruction[0]
+    
+    if opcode in (load_local, load_local_byte):
+        return [(instruction[1], value_size(instruction))], [], False
+    elif opcode in (load_global, load_global_byte):
+        return [], [(instruction[1], value_size(instruction))], False
+    elif opcode in (load_array_value, load_array_byte_value):
+        # Arrays are held in the frame, so the element loaded can be at any
+        # offset from the start of the array to the end of the frame.
+        return [(instruction[1], 256 - instruction[1])], [], True
+    elif opcode in memory_loads:
+        return [], [], True
+    else:
+        return [], [], False
+
+class Numbering:
+
+    """Records the numbers given to the values produced in a basic block and
+    the places where they were first produced."""
+    
+    def __init__(self):
+    
+        self.clear()
+    
+    def clear(self):
+    
+        # The number for each operation applied to numbered values and the
+        # variables each number depends on
+        self.numbers = {}
+        self.depends = {}
+        
+        # The index in the code after the first instruction that produced each
+        # value that can be reused, its size and the temporary variable used
+        # to hold it if it has been reused
+        self.available = {}
+    
+    def number(self, key, depends):
+    
+        if key not in self.numbers:
+            self.numbers[key] = len(self.depends)
+            self.depends[len(self.depends)] = depends
+        
+        return self.numbers[key]
+    
+    def remove(self, changed):
+    
+        # Remove the numbers for values that depend on the variables or memory
+        # changed by an instruction, given as a function of the dependencies
+        # of a value.
+        for key, number in self.numbers.items():
+            if changed(self.depends[number]):
+                del self.numbers[key]
+                if number in self.available:
+                    del self.available[number]
+
+def assigned(instruction):
+
+    # Return a function that returns whether the value with the dependencies
+    # passed to it is changed by the instruction, or None if the instruction
+    # does not change any variables.
+    opcode = instruction[0]
+    
+    if opcode in memory_writes:
+        return lambda depends: True
+    elif opcode in (assign_local, assign_local_constant):
+        return lambda depends: loops.overlaps(instruction[1], instruction[2], depends[0])
+    elif opcode in (assign_local_byte, assign_local_byte_constant,
+                    loop_local_byte):
+        return lambda depends: loops.overlaps(instruction[1], 1, depends[0])
+    elif opcode == loop_local:
+        return lambda depends: loops.overlaps(instruction[1], instruction[3], depends[0])
+    elif opcode in (assign_global, assign_global_constant):
+        return lambda depends: loops.overlaps(instruction[1], instruction[2], depends[1])
+    elif opcode in (assign_global_byte, assign_global_byte_constant):
+        return lambda depends: loops.overlaps(instruction[1], 1, depends[1])
+    else:
+        return None
+
+def reuse_in_body(body):
+
+    """Returns a copy of the body of a function with values reused, the
+    temporary variables used to hold them and the number of values reused."""
+    
+    code = []
+    numbering = Numbering()
+    temporaries = []
+    
+    # Each entry on the stack holds the index in the code of the first
+    # instruction that produces a value, the number of the value, the number
+    # of instructions in the body that produce it, and its size.
+    stack = []
+    
+    block = 0
+    depth = 0
+    
+    for instruction in body:
+    
+        opcode = instruction[0]
+        size = value_size(instruction)
+        
+        if size is None:
+            # The instruction uses the values on the stack in some other way,
+            # changes variables or starts a new block.
+            stack = []
+            if opcode in boundaries:
+                numbering.clear()
+                block += 1
+                if opcode == store_stack_top_in_current_frame:
+                    depth += 1
+                elif opcode == pop_current_frame_address:
+                    depth -= 1
+            else:
+                changed = assigned(instruction)
+                if changed is not None:
+                    numbering.remove(changed)
+            
+            code.append(instruction)
+            continue
+        
+        count = operand_count(opcode)
+        if len(stack) >= count:
+            operands = stack[len(stack) - count:]
+            del stack[len(stack) - count:]
+            key = (repr(instruction),) + tuple(map(lambda entry: entry[1], operands))
+        else:
+            # Values produced by other instructions, such as function calls,
+            # are not numbered, so the value produced is given a new number.
+            operands = []
+            stack = []
+            key = (block, len(code))
+        
+        if operands:
+            first = operands[0][0]
+        else:
+            first = len(code)
+        
+        local_ranges, global_ranges, memory = dependencies(instruction)
+        weight = 1
+        for operand in operands:
+            operand_depends = numbering.depends[operand[1]]
+            local_ranges = local_ranges + operand_depends[0]
+            global_ranges = global_ranges + operand_depends[1]
+            memory = memory or operand_depends[2]
+            weight += operand[2]
+        
+        number = numbering.number(key, (local_ranges, global_ranges, memory))
+        code.append(instruction)
+        
+        if depth != 0 or weight < minimum_weight:
+            pass
+        
+        elif number not in numbering.available:
+            numbering.available[number] = [len(code), size, None]
+        
+        else:
+            position, size, temporary = numbering.available[number]
+            
+            if temporary is None:
+                # Store the value where it was first produced.
+                temporary = Temporary(size, block)
+                temporaries.append(temporary)
+                numbering.available[number][2] = temporary
+                code[position:position] = [assign_temporary(temporary),
+                                           load_temporary(temporary)]
+                
+                # Update the indices after the value.
+                for values in numbering.available.values():
+                    if values[0] > position:
+                        values[0] += 2
+                
+                new_stack = []
+                for entry in stack:
+                    if entry[0] >= position:
+                        entry = (entry[0] + 2,) + entry[1:]
+                    new_stack.append(entry)
+                
+                stack = new_stack
+                first += 2
+            
+            code[first:] = [load_temporary(temporary)]
+        
+        stack.append((first, number, weight, size))
+    
+    # Remove temporary variables that were only loaded where they were stored
+    # because later reuses were replaced by reuses of larger values.
+    loads = {}
+    for instruction in code:
+        if instruction[0] in (load_local, load_local_byte) and \
+           isinstance(instruction[1], Temporary):
+            loads[instruction[1]] = loads.get(instruction[1], 0) + 1
+    
+    reused = 0
+    used = []
+    for temporary in temporaries:
+        if loads[temporary] > 1:
+            used.append(temporary)
+            reused += loads[temporary] - 1
+    
+    new_code = []
+    for instruction in code:
+        if len(instruction) > 1 and isinstance(instruction[1], Temporary) and \
+           instruction[1] not in used:
+            continue
+        new_code.append(instruction)
+    
+    return new_code, used, reused
+
+def reuse_values(code, functions, start_label):
+
+    """Replaces instructions in the functions in the code that produce values
+    already produced earlier in the same basic block with loads of new local
+    variables holding the earlier values. Returns a list of the names of the
+    functions changed, each with the number of values reused. The main
+    program starts at the start label given."""
+    
+    names = {start_label: None}
+    for function in functions:
+        names[function[3]] = function[0]
+    
+    extents = callgraph.function_extents(code, set(names.keys()))
+    del extents[start_label]
+    
+    # Change the functions from the last to the first so that the extents of
+    # those still to be changed are not affected.
+    order = map(lambda (label, (start, end)): (start, end, label),
+                extents.items())
+    order.sort(reverse = True)
+    
+    changed = []
+    
+    for start, end, label in order:
+    
+        frame = loops.frame_instructions(code, start, end)
+        if frame is None:
+            continue
+        
+        allocate, free, copy = frame
+        body, temporaries, reused = reuse_in_body(code[allocate + 1:free])
+        if not reused:
+            continue
+        
+        # Temporary variables used in different blocks share the same space.
+        sizes = {}
+        for temporary in temporaries:
+            temporary.offset = sizes.get(temporary.block, 0)
+            sizes[temporary.block] = temporary.offset + temporary.size
+        
+        offset = loops.add_variable(code, frame, max(sizes.values()))
+        for temporary in temporaries:
+            temporary.offset += offset
+        
+        for instruction in body:
+            if len(instruction) > 1 and isinstance(instruction[1], Temporary):
+                instruction[1] = instruction[1].offset
+        
+        code[allocate + 1:free] = body
+        changed.insert(0, (names[label], reused))
+    
+    return changed
@@ -0,0 +1,107 @@
+"""
+objects.py - Object modules for separately compiled include files.
+
+Copyright (C) 2014 David Boddie <david@boddie.org.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib, os, pickle
+
+# The format of object module files, increased when it changes
+
+format_version = 2
+
+class ObjectModule:
+
+    """Holds the compiled form of an included file as a list of items in the
+    order in which they occurred in the file. Each item is either
+    
+      ("include", <file name token>)
+    
+    for a file included by the file or
+    
+      ("function", <code>, <definition>, <lookups>, <sizes>)
+    
+    for a function definition. The code of each function is a list of
+    instructions in the form described in the ir module, beginning with the
+    label for the function. The definition contains the name, parameters,
+    local variables, return size and return array flag of the function.
+    
+    The lookups record the results of looking up the names of functions and
+    global variables when the function was compiled. The code can only be
+    reused if the same lookups give the same results where it is linked."""
+    
+    def __init__(self, items = None):
+    
+        if items is None:
+            items = []
+        
+        self.items = items
+        
+        # Modules that define global variables cannot be reused because the
+        # variables are placed after those already defined.
+        self.cacheable = True
+    
+    def add_include(self, token):
+    
+        self.items.append(("include", token))
+    
+    def add_function(self, code, definition, lookups, sizes):
+    
+        self.items.append(("function", code, definition, lookups, sizes))
+    
+    def save(self, file_name):
+    
+        # Write the module to a temporary file and rename it so that other
+        # compilers never read a partly written module.
+        directory = os.path.split(file_name)[0]
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        
+        temp_name = file_name + ".%i" % os.getpid()
+        f = open(temp_name, "wb")
+        pickle.dump((format_version, self.items), f, 2)
+        f.close()
+        os.rename(temp_name, file_name)
+
+def load(file_name):
+
+    # Return the module stored in the named file or None if there is no
+    # module or it cannot be read.
+    try:
+        f = open(file_name, "rb")
+    except IOError:
+        return None
+    
+    try:
+        version, items = pickle.load(f)
+    except Exception:
+        return None
+    finally:
+        f.close()
+    
+    if version != format_version:
+        return None
+    
+    return ObjectModule(items)
+
+def module_key(text, version, types):
+
+    # Return a key for the compiled form of the text, taking into account the
+    # compiler version and the sizes of types, which affect the code produced.
+    digest = hashlib.sha1()
+    digest.update("%s\n%s\n" % (version, repr(sorted(types.items()))))
+    digest.update(text)
+    return digest.hexdigest()
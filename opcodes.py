@@ -82,7 +82,32 @@ load_memory_value, \
 load_memory_byte_value, \
 store_memory_value, \
 store_memory_byte_value, \
-end = range(256, 256 + 66)
+jump_if_not_equals, \
+jump_if_not_equals_byte, \
+jump_if_not_equals_byte_constant, \
+jump_if_equals, \
+jump_if_equals_byte, \
+jump_if_equals_byte_constant, \
+jump_if_not_less_than, \
+jump_if_not_less_than_byte, \
+jump_if_not_less_than_byte_constant, \
+jump_if_not_greater_than, \
+jump_if_not_greater_than_byte, \
+jump_if_not_greater_than_byte_constant, \
+jump_table, \
+loop_local, \
+loop_local_byte, \
+compare_equals_byte_constant, \
+compare_not_equals_byte_constant, \
+compare_less_than_byte_constant, \
+compare_greater_than_byte_constant, \
+assign_local_constant, \
+assign_local_byte_constant, \
+assign_global_constant, \
+assign_global_byte_constant, \
+left_shift_constant, \
+right_shift_constant, \
+end = range(256, 256 + 91)
 
 address_size = 2
 branch_size = 1
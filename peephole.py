@@ -0,0 +1,416 @@
+"""
+peephole.py - Peephole optimisation of generated code.
+
+Copyright (C) 2014 David Boddie <david@boddie.org.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# The pass works on code in the form described in the ir module, before it is
+# lowered to bytes, so branch offsets and addresses are calculated for the
+# optimised code when it is lowered.
+#
+# Most rules are patterns written as a sequence of instructions separated by
+# semicolons, followed by "->" and the sequence to replace them with. Each
+# instruction is the name of an opcode, or one of the "label" and "branch"
+# pseudo-instructions, followed by its operands. Operands are either numbers,
+# which only match operands with that value, or names, which match any
+# operand but must match the same value wherever they occur in the pattern.
+#
+#   "assign_local_byte a; load_local_byte a -> ..."
+#
+# matches an assignment to a local variable followed by a load of the same
+# variable. Rules that cannot be written as patterns are functions that
+# change the code in place and return the number of changes made.
+
+import loops, opcodes, strength
+from opcodes import *
+
+class Pattern:
+
+    def __init__(self, text):
+    
+        match, replacement = text.split("->")
+        self.match = self.parse(match)
+        self.replacement = self.parse(replacement)
+    
+    def parse(self, text):
+    
+        instructions = []
+        for item in text.split(";"):
+            words = item.split()
+            if not words:
+                continue
+            
+            if words[0] in ("label", "branch"):
+                instruction = [words[0]]
+            else:
+                instruction = [getattr(opcodes, words[0])]
+            
+            for word in words[1:]:
+                if word.isdigit():
+                    instruction.append(int(word))
+                else:
+                    instruction.append(word)
+            
+            instructions.append(instruction)
+        
+        return instructions
+    
+    def apply(self, code):
+    
+        # Replace the instructions at the end of the code if they match the
+        # pattern, returning True if they were replaced.
+        length = len(self.match)
+        if len(code) < length:
+            return False
+        
+        names = {}
+        for template, instruction in zip(self.match, code[-length:]):
+        
+            if template[0] != instruction[0] or len(template) != len(instruction):
+                return False
+            
+            for expected, operand in zip(template[1:], instruction[1:]):
+                if isinstance(expected, str):
+                    if names.setdefault(expected, operand) != operand:
+                        return False
+                elif isinstance(operand, int) and expected == operand:
+                    pass
+                else:
+                    return False
+        
+        replacement = []
+        for template in self.replacement:
+            instruction = [template[0]]
+            for operand in template[1:]:
+                if isinstance(operand, str):
+                    operand = names[operand]
+                instruction.append(operand)
+            replacement.append(instruction)
+        
+        code[-length:] = replacement
+        return True
+
+def first_instructions(code):
+
+    # Return a dictionary mapping each label in the code to the first
+    # instruction after it that is not a label.
+    instructions = {}
+    labels = []
+    for instruction in code:
+        if instruction[0] == "label":
+            labels.append(instruction[1])
+        else:
+            for label in labels:
+                instructions[label] = instruction
+            labels = []
+    
+    return instructions
+
+def thread_jumps(code):
+
+    # Make jumps and branches to unconditional jumps or branches go directly
+    # to their final destinations.
+    targets = first_instructions(code)
+    changed = 0
+    
+    i = 0
+    while i < len(code):
+    
+        instruction = code[i]
+        if instruction[0] in (jump, jump_if_false, "branch"):
+        
+            label = instruction[1]
+            seen = set()
+            while label not in seen:
+                seen.add(label)
+                target = targets.get(label)
+                if target is None or target[0] not in (jump, "branch"):
+                    break
+                label = target[1]
+            
+            if label is not instruction[1]:
+                code[i] = [instruction[0], label]
+                changed += 1
+        
+        i += 1
+    
+    return changed
+
+def remove_unreachable_code(code):
+
+    # Remove instructions between an unconditional transfer of control and
+    # the next label.
+    removed = 0
+    reachable = True
+    new_code = []
+    
+    for instruction in code:
+    
+        if instruction[0] == "label":
+            reachable = True
+        elif not reachable:
+            removed += 1
+            continue
+        
+        new_code.append(instruction)
+        
+        if instruction[0] in (jump, "branch", jump_table, function_return,
+                              end):
+            reachable = False
+    
+    code[:] = new_code
+    return removed
+
+def expression_start(code, end):
+
+    # Return the index of the first instruction of the run of instructions
+    # ending before the end index given that pushes a single value and has no
+    # other effect, or None if there is no such run.
+    needed = 1
+    i = end
+    while needed > 0:
+        i -= 1
+        if i < 0 or loops.value_size(code[i]) is None:
+            return None
+        needed += loops.operations.get(code[i][0], 0) - 1
+    
+    return i
+
+def constant_array_index(code):
+
+    # Replace loads and stores of array elements at constant indices with
+    # loads and assignments of the elements as local variables. Arrays are
+    # held in the current frame in the same way as local variables, so the
+    # element at a constant index is a variable with a known offset.
+    changed = 0
+    
+    i = 1
+    while i < len(code):
+    
+        instruction = code[i]
+        opcode = instruction[0]
+        
+        if opcode in (load_array_byte_value, store_array_byte_value):
+            index_size, size = 1, 1
+        elif opcode in (load_array_value, store_array_value):
+            index_size, size = instruction[2], instruction[3]
+        else:
+            i += 1
+            continue
+        
+        # Find the instruction that loads the index, which is followed by the
+        # value to store for stores.
+        if opcode in (load_array_value, load_array_byte_value):
+            start = index = i - 1
+        else:
+            start = expression_start(code, i)
+            if start is None or start == 0:
+                i += 1
+                continue
+            index = start - 1
+        
+        value = strength.constant_value(code[index], index_size)
+        if value is None or instruction[1] + (value * size) > 255:
+            i += 1
+            continue
+        
+        offset = instruction[1] + (value * size)
+        
+        if opcode in (load_array_value, load_array_byte_value):
+            if size > 1:
+                new_code = [[load_local, offset, size]]
+            else:
+                new_code = [[load_local_byte, offset]]
+        elif size > 1:
+            new_code = code[start:i] + [[assign_local, offset, size]]
+        else:
+            new_code = code[start:i] + [[assign_local_byte, offset]]
+        
+        code[index:i + 1] = new_code
+        changed += 1
+        i = index + len(new_code)
+    
+    return changed
+
+# The rules in the order in which they are applied, each with the name used to
+# enable or disable it.
+
+rules = [
+    ("thread_jumps", thread_jumps),
+    ("unreachable_code", remove_unreachable_code),
+    ("constant_array_index", constant_array_index),
+    ("jump_to_next", Pattern("jump l; label l -> label l")),
+    ("branch_to_next", Pattern("branch l; label l -> label l")),
+    ("jump_if_false_to_next",
+        Pattern("jump_if_false l; label l -> free_stack_space 1; label l")),
+    ("constant_false_condition",
+        Pattern("load_byte 0; jump_if_false l -> jump l")),
+    ("constant_true_condition", Pattern("load_byte 255; jump_if_false l ->")),
+    
+    # The generator fuses comparisons with the conditional jumps that test
+    # them, but other passes can leave comparisons tested by jump_if_false,
+    # so these are fused here. Byte comparisons with constants then take the
+    # constants as operands.
+    ("fuse_compare_equals",
+        Pattern("compare_equals s; jump_if_false l -> "
+                "jump_if_not_equals s l")),
+    ("fuse_compare_equals_byte",
+        Pattern("compare_equals_byte; jump_if_false l -> "
+                "jump_if_not_equals_byte l")),
+    ("fuse_compare_equals_byte_constant",
+        Pattern("load_byte c; jump_if_not_equals_byte l -> "
+                "jump_if_not_equals_byte_constant c l")),
+    ("fuse_compare_not_equals",
+        Pattern("compare_not_equals s; jump_if_false l -> "
+                "jump_if_equals s l")),
+    ("fuse_compare_not_equals_byte",
+        Pattern("compare_not_equals_byte; jump_if_false l -> "
+                "jump_if_equals_byte l")),
+    ("fuse_compare_not_equals_byte_constant",
+        Pattern("load_byte c; jump_if_equals_byte l -> "
+                "jump_if_equals_byte_constant c l")),
+    ("fuse_compare_less_than",
+        Pattern("compare_less_than s; jump_if_false l -> "
+                "jump_if_not_less_than s l")),
+    ("fuse_compare_less_than_byte",
+        Pattern("compare_less_than_byte; jump_if_false l -> "
+                "jump_if_not_less_than_byte l")),
+    ("fuse_compare_less_than_byte_constant",
+        Pattern("load_byte c; jump_if_not_less_than_byte l -> "
+                "jump_if_not_less_than_byte_constant c l")),
+    ("fuse_compare_greater_than",
+        Pattern("compare_greater_than s; jump_if_false l -> "
+                "jump_if_not_greater_than s l")),
+    ("fuse_compare_greater_than_byte",
+        Pattern("compare_greater_than_byte; jump_if_false l -> "
+                "jump_if_not_greater_than_byte l")),
+    ("fuse_compare_greater_than_byte_constant",
+        Pattern("load_byte c; jump_if_not_greater_than_byte l -> "
+                "jump_if_not_greater_than_byte_constant c l")),
+    
+    # Other instructions that take constants from the stack take them as
+    # operands instead. The generator already does this for the constants it
+    # loads, so these rules handle constants produced by other passes. Byte
+    # comparisons with constants whose results are tested by conditional
+    # jumps are fused with the jumps as above.
+    ("compare_equals_byte_constant",
+        Pattern("load_byte c; compare_equals_byte -> "
+                "compare_equals_byte_constant c")),
+    ("fuse_compare_equals_byte_constant_result",
+        Pattern("compare_equals_byte_constant c; jump_if_false l -> "
+                "jump_if_not_equals_byte_constant c l")),
+    ("compare_not_equals_byte_constant",
+        Pattern("load_byte c; compare_not_equals_byte -> "
+                "compare_not_equals_byte_constant c")),
+    ("fuse_compare_not_equals_byte_constant_result",
+        Pattern("compare_not_equals_byte_constant c; jump_if_false l -> "
+                "jump_if_equals_byte_constant c l")),
+    ("compare_less_than_byte_constant",
+        Pattern("load_byte c; compare_less_than_byte -> "
+                "compare_less_than_byte_constant c")),
+    ("fuse_compare_less_than_byte_constant_result",
+        Pattern("compare_less_than_byte_constant c; jump_if_false l -> "
+                "jump_if_not_less_than_byte_constant c l")),
+    ("compare_greater_than_byte_constant",
+        Pattern("load_byte c; compare_greater_than_byte -> "
+                "compare_greater_than_byte_constant c")),
+    ("fuse_compare_greater_than_byte_constant_result",
+        Pattern("compare_greater_than_byte_constant c; jump_if_false l -> "
+                "jump_if_not_greater_than_byte_constant c l")),
+    ("left_shift_constant",
+        Pattern("load_byte n; left_shift s -> left_shift_constant s n")),
+    ("right_shift_constant",
+        Pattern("load_byte n; right_shift s -> right_shift_constant s n")),
+    ("assign_local_constant",
+        Pattern("load_number 2 l h; assign_local a 2 -> "
+                "assign_local_constant a 2 l h")),
+    ("assign_local_byte_constant",
+        Pattern("load_byte c; assign_local_byte a -> "
+                "assign_local_byte_constant a c")),
+    ("assign_global_constant",
+        Pattern("load_number 2 l h; assign_global a 2 -> "
+                "assign_global_constant a 2 l h")),
+    ("assign_global_byte_constant",
+        Pattern("load_byte c; assign_global_byte a -> "
+                "assign_global_byte_constant a c")),
+    
+    ("allocate_nothing", Pattern("allocate_stack_space 0 ->")),
+    ("free_nothing", Pattern("free_stack_space 0 ->")),
+    ("assign_local_to_itself",
+        Pattern("load_local a s; assign_local a s ->")),
+    ("assign_local_byte_to_itself",
+        Pattern("load_local_byte a; assign_local_byte a ->")),
+    
+    # A value assigned to a local variable is still held above the top of the
+    # stack, so it can be reloaded by moving the stack pointer back over it.
+    ("reload_local",
+        Pattern("assign_local a s; load_local a s -> "
+                "assign_local a s; allocate_stack_space s")),
+    ("reload_local_byte",
+        Pattern("assign_local_byte a; load_local_byte a -> "
+                "assign_local_byte a; allocate_stack_space 1")),
+    
+    # A constant assigned to a local variable is loaded again as a constant.
+    ("reload_local_constant",
+        Pattern("assign_local_constant a 2 l h; load_local a 2 -> "
+                "assign_local_constant a 2 l h; load_number 2 l h")),
+    ("reload_local_byte_constant",
+        Pattern("assign_local_byte_constant a c; load_local_byte a -> "
+                "assign_local_byte_constant a c; load_byte c"))
+    ]
+
+def rule_names():
+
+    return map(lambda (name, rule): name, rules)
+
+def optimise(code, disabled = ()):
+
+    """Applies the rules that are not disabled to the code given, returning a
+    dictionary mapping the name of each rule applied to the number of times
+    it was applied."""
+    
+    counts = {}
+    patterns = []
+    
+    for name, rule in rules:
+    
+        if name in disabled:
+            continue
+        
+        counts[name] = 0
+        if isinstance(rule, Pattern):
+            patterns.append((name, rule))
+        else:
+            counts[name] = rule(code)
+    
+    # Apply the patterns to the end of the code as each instruction is added
+    # to it so that the results of each change can be matched.
+    optimised = []
+    for instruction in code:
+    
+        optimised.append(instruction)
+        
+        changed = True
+        while changed:
+            changed = False
+            for name, pattern in patterns:
+                if pattern.apply(optimised):
+                    counts[name] += 1
+                    changed = True
+                    break
+    
+    code[:] = optimised
+    return counts
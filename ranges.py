@@ -0,0 +1,442 @@
+"""
+ranges.py - Narrowing of multi-byte comparisons using the ranges of values.
+
+Copyright (C) 2014 David Boddie <david@boddie.org.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# The pass works on code in the form described in the ir module, following
+# the values pushed onto the stack by the code of each function in the same
+# way as the loops module. Each value is given the range of unsigned numbers
+# it can hold, starting from the ranges of constants and of the values
+# assigned to each local variable anywhere in the function. Parameters can
+# hold any value, and so can variables whose ranges keep growing, such as
+# those incremented in loops.
+#
+# Sizes are taken from the declared types of variables, so multi-byte values
+# are often compared when both of them fit in a byte. In that case the upper
+# bytes of both values are zero and the comparison gives the same result for
+# the lowest bytes of the values. The lowest byte of the result of an
+# addition, subtraction, bitwise operation or left shift only depends on the
+# lowest bytes of its operands, and the lowest byte of a value loaded from a
+# variable or a constant can be loaded by itself, so the code for each of the
+# values compared can be replaced by code that only produces their lowest
+# bytes. Values with a range that fits in a byte, produced from operands that
+# also fit, are produced in the same way.
+#
+# Functions whose local variables can be changed through their addresses or
+# by the code of inlined functions are left unchanged, as is the main program.
+
+import callgraph, loops
+from opcodes import *
+
+# The number of times the range of a variable can grow before it is assumed
+# to hold any value
+maximum_passes = 4
+
+# Wide comparisons and their byte forms
+comparisons = {
+    compare_equals: compare_equals_byte,
+    compare_not_equals: compare_not_equals_byte,
+    compare_less_than: compare_less_than_byte,
+    compare_greater_than: compare_greater_than_byte
+    }
+
+# Conditional jumps that perform wide comparisons and their byte forms
+comparison_jumps = {
+    jump_if_not_equals: jump_if_not_equals_byte,
+    jump_if_equals: jump_if_equals_byte,
+    jump_if_not_less_than: jump_if_not_less_than_byte,
+    jump_if_not_greater_than: jump_if_not_greater_than_byte
+    }
+
+# Wide operations whose lowest result bytes only depend on the lowest bytes
+# of their operands, and their byte forms
+low_byte_operations = {
+    add: [add_byte],
+    subtract: [subtract_byte],
+    bitwise_and: [bitwise_and_byte],
+    bitwise_or: [bitwise_or_byte],
+    bitwise_eor: [bitwise_eor_byte],
+    left_shift: [left_shift, 1]
+    }
+
+# Ranges are given as tuples containing the lowest and highest values, or
+# None for values that have not been found to hold anything yet.
+
+def full_range(size):
+
+    return (0, (1 << (size * 8)) - 1)
+
+def fits(value_range, size):
+
+    return value_range is not None and value_range[1] <= full_range(size)[1]
+
+def union(first, second):
+
+    if first is None:
+        return second
+    elif second is None:
+        return first
+    else:
+        return (min(first[0], second[0]), max(first[1], second[1]))
+
+def constant(data):
+
+    value = 0
+    for byte in reversed(data):
+        value = (value << 8) | byte
+    
+    return value
+
+def operation_range(instruction, ranges, size):
+
+    # Return the range of the value of the size given produced by the
+    # operation applied to values with the ranges given.
+    opcode = instruction[0]
+    
+    if None in ranges:
+        return None
+    
+    if opcode in (add_byte_constant, subtract_byte_constant,
+                  bitwise_and_byte_constant, bitwise_or_byte_constant,
+                  bitwise_eor_byte_constant):
+        ranges = ranges + [(instruction[1], instruction[1])]
+    elif opcode in (left_shift_constant, right_shift_constant):
+        ranges = ranges + [(instruction[2], instruction[2])]
+    
+    if opcode in (add, add_byte, add_byte_constant):
+        low, high = ranges[0][0] + ranges[1][0], ranges[0][1] + ranges[1][1]
+    elif opcode in (subtract, subtract_byte, subtract_byte_constant):
+        low, high = ranges[0][0] - ranges[1][1], ranges[0][1] - ranges[1][0]
+    elif opcode in (bitwise_and, bitwise_and_byte, bitwise_and_byte_constant):
+        low, high = 0, min(ranges[0][1], ranges[1][1])
+    elif opcode in (bitwise_or, bitwise_or_byte, bitwise_or_byte_constant,
+                    bitwise_eor, bitwise_eor_byte, bitwise_eor_byte_constant):
+        low, high = 0, (1 << max(ranges[0][1], ranges[1][1]).bit_length()) - 1
+    elif opcode in (left_shift, left_shift_constant):
+        low, high = ranges[0][0] << ranges[1][0], ranges[0][1] << ranges[1][1]
+    elif opcode in (right_shift, right_shift_constant):
+        low, high = ranges[0][0] >> ranges[1][1], ranges[0][1] >> ranges[1][0]
+    else:
+        return full_range(size)
+    
+    if low < 0 or high > full_range(size)[1]:
+        return full_range(size)
+    else:
+        return (low, high)
+
+class Value:
+
+    """Describes a value on the stack with the index of the first instruction
+    that produces it, the instruction that finally produces it, the values
+    that instruction uses, its size and its range."""
+    
+    def __init__(self, first, instruction, operands, size, value_range):
+    
+        self.first = first
+        self.instruction = instruction
+        self.operands = operands
+        self.size = size
+        self.range = value_range
+
+def lowest_byte(value):
+
+    """Returns code that produces the lowest byte of the multi-byte value
+    given, or None if the code that produces the value cannot be changed to
+    do that."""
+    
+    instruction = value.instruction
+    opcode = instruction[0]
+    
+    if value.size == 1:
+        return None
+    elif opcode == load_number:
+        return [[load_byte, instruction[2]]]
+    elif opcode == load_local:
+        return [[load_local_byte, instruction[1]]]
+    elif opcode == load_global:
+        return [[load_global_byte, instruction[1]]]
+    elif opcode in (bitwise_and, bitwise_or, bitwise_eor) and \
+         instruction[1] != instruction[2]:
+        return None
+    
+    elif opcode in low_byte_operations or (
+        opcode == right_shift and fits(value.operands[0].range, 1)):
+        
+        first = lowest_byte(value.operands[0])
+        if first is None:
+            return None
+        
+        if opcode in (left_shift, right_shift):
+            # The number of bits to shift by is already a byte.
+            if value.operands[1].operands:
+                return None
+            second = [value.operands[1].instruction]
+        else:
+            second = lowest_byte(value.operands[1])
+            if second is None:
+                return None
+        
+        if opcode == right_shift:
+            return first + second + [[right_shift, 1]]
+        else:
+            return first + second + [low_byte_operations[opcode]]
+    
+    elif opcode == left_shift_constant or (
+        opcode == right_shift_constant and fits(value.operands[0].range, 1)):
+        
+        first = lowest_byte(value.operands[0])
+        if first is None:
+            return None
+        
+        return first + [[opcode, 1, instruction[2]]]
+    
+    else:
+        return None
+
+def wide_operations(value):
+
+    # Return the number of multi-byte operations used to produce the value,
+    # which is a comparison changed by the narrow_body function.
+    opcode = value.instruction[0]
+    if opcode in comparisons or opcode in comparison_jumps or \
+       opcode in low_byte_operations or \
+       opcode in (right_shift, left_shift_constant, right_shift_constant):
+        total = 1
+    else:
+        total = 0
+    
+    for operand in value.operands:
+        total += wide_operations(operand)
+    
+    return total
+
+def scan(body, variables):
+
+    """Returns the values compared by wide comparisons, including those made
+    by conditional jumps, in the body of a function, together with the ranges
+    of the values assigned to its local variables, given a dictionary mapping
+    the offset and size of each local variable to the range of values it
+    holds. Variables not in the dictionary can hold any value."""
+    
+    compared = []
+    assigned = {}
+    stack = []
+    
+    i = 0
+    for instruction in body:
+    
+        opcode = instruction[0]
+        size = loops.value_size(instruction)
+        count = loops.operations.get(opcode, 0)
+        
+        if opcode in comparison_jumps and len(stack) >= 2:
+            # The jump uses the values compared without producing a value.
+            operands = stack[-2:]
+            compared.append(Value(operands[0].first, instruction, operands,
+                                  None, None))
+            stack = []
+            i += 1
+            continue
+        
+        if size is None or len(stack) < count:
+        
+            if opcode in (assign_local, assign_local_byte, loop_local,
+                          loop_local_byte, assign_local_constant,
+                          assign_local_byte_constant):
+                
+                if opcode in (assign_local, assign_local_constant):
+                    key = (instruction[1], instruction[2])
+                elif opcode == loop_local:
+                    key = (instruction[1], instruction[3])
+                else:
+                    key = (instruction[1], 1)
+                
+                if opcode == assign_local_constant:
+                    value = constant(instruction[3:])
+                    value_range = (value, value)
+                elif opcode == assign_local_byte_constant:
+                    value_range = (instruction[2], instruction[2])
+                elif stack and opcode in (assign_local, assign_local_byte):
+                    value_range = stack[-1].range
+                else:
+                    value_range = full_range(key[1])
+                
+                # Assignments to parts of variables make them hold any value.
+                for offset, size in variables.keys() + assigned.keys():
+                    if (offset, size) != key and \
+                       loops.overlaps(offset, size, [key]):
+                        assigned[(offset, size)] = full_range(size)
+                
+                assigned[key] = union(assigned.get(key), value_range)
+            
+            stack = []
+            i += 1
+            continue
+        
+        operands = stack[len(stack) - count:]
+        del stack[len(stack) - count:]
+        
+        if operands:
+            first = operands[0].first
+        else:
+            first = i
+        
+        if opcode == load_byte:
+            value_range = (instruction[1], instruction[1])
+        elif opcode == load_number:
+            value = constant(instruction[2:])
+            value_range = (value, value)
+        elif opcode in (load_local, load_local_byte):
+            value_range = variables.get((instruction[1], size), full_range(size))
+        elif count:
+            value_range = operation_range(instruction,
+                map(lambda value: value.range, operands), size)
+        else:
+            value_range = full_range(size)
+        
+        value = Value(first, instruction, operands, size, value_range)
+        stack.append(value)
+        
+        if opcode in comparisons:
+            compared.append(value)
+        
+        i += 1
+    
+    return compared, assigned
+
+def variable_ranges(body, parameter_size):
+
+    """Returns a dictionary mapping the offset and size of each variable in
+    the body of a function to the range of values it can hold, or None if
+    its variables can be changed in ways that are not followed."""
+    
+    for instruction in body:
+        if instruction[0] in (get_variable_address,
+                              store_stack_top_in_current_frame):
+            return None
+    
+    # Start with variables that are assigned in the body holding nothing and
+    # parameters holding any value, then widen the ranges of the variables to
+    # include the values assigned to them until they no longer change.
+    variables = {}
+    for offset, size in scan(body, {})[1].keys():
+        if offset >= parameter_size:
+            variables[(offset, size)] = None
+    
+    passes = {}
+    changed = True
+    
+    while changed:
+    
+        changed = False
+        for key, value_range in scan(body, variables)[1].items():
+        
+            if key not in variables:
+                continue
+            
+            new_range = union(variables[key], value_range)
+            if new_range == variables[key]:
+                continue
+            
+            passes[key] = passes.get(key, 0) + 1
+            if passes[key] >= maximum_passes:
+                new_range = full_range(key[1])
+            
+            variables[key] = new_range
+            changed = True
+    
+    return variables
+
+def narrow_body(body, variables):
+
+    # Replace the code for the wide comparisons in the body whose operands fit
+    # in a byte, returning the number of wide operations replaced.
+    replacements = []
+    
+    for value in scan(body, variables)[0]:
+    
+        first, second = value.operands
+        if not fits(first.range, 1) or not fits(second.range, 1):
+            continue
+        
+        first_code = lowest_byte(first)
+        second_code = lowest_byte(second)
+        if first_code is None or second_code is None:
+            continue
+        
+        opcode = value.instruction[0]
+        if opcode in comparison_jumps:
+            comparison = [comparison_jumps[opcode], value.instruction[-1]]
+        else:
+            comparison = [comparisons[opcode]]
+        
+        new_code = first_code + second_code + [comparison]
+        replacements.append((value, new_code))
+    
+    # Replace the code from the last comparison to the first so that the
+    # indices of those still to be replaced are not affected.
+    replacements.reverse()
+    total = 0
+    for value, new_code in replacements:
+        last = value.first
+        while body[last] is not value.instruction:
+            last += 1
+        body[value.first:last + 1] = new_code
+        total += wide_operations(value)
+    
+    return total
+
+def narrow_comparisons(code, functions, start_label):
+
+    """Replaces multi-byte comparisons in the functions in the code with
+    single byte comparisons where the values compared always fit in a byte,
+    changing the code that produces the values to only produce their lowest
+    bytes. Returns the number of multi-byte operations replaced. The main
+    program starts at the start label given."""
+    
+    entry_labels = set(map(lambda function: function[3], functions))
+    entry_labels.add(start_label)
+    
+    extents = callgraph.function_extents(code, entry_labels)
+    del extents[start_label]
+    
+    # Change the functions from the last to the first so that the extents of
+    # those still to be changed are not affected.
+    order = extents.values()
+    order.sort(reverse = True)
+    
+    total = 0
+    
+    for start, end in order:
+    
+        frame = loops.frame_instructions(code, start, end)
+        if frame is None:
+            continue
+        
+        allocate, free, copy = frame
+        body = code[allocate + 1:free]
+        
+        variables = variable_ranges(body, code[allocate - 1][1])
+        if variables is None:
+            continue
+        
+        narrowed = narrow_body(body, variables)
+        if narrowed:
+            code[allocate + 1:free] = body
+            total += narrowed
+    
+    return total
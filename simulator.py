@@ -17,7 +17,7 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import opcodes
+import opcodes, superinstructions
 from opcodes import address_size, branch_size, memory_size, shift_size
 
 memory = [0] * memory_size
@@ -179,6 +179,38 @@ def compare_greater_than_byte():
     else:
         push_byte(false)
 
+def compare_equals_byte_constant():
+
+    value = get_operand()
+    if pop_byte() == value:
+        push_byte(true)
+    else:
+        push_byte(false)
+
+def compare_not_equals_byte_constant():
+
+    value = get_operand()
+    if pop_byte() != value:
+        push_byte(true)
+    else:
+        push_byte(false)
+
+def compare_less_than_byte_constant():
+
+    value = get_operand()
+    if pop_byte() < value:
+        push_byte(true)
+    else:
+        push_byte(false)
+
+def compare_greater_than_byte_constant():
+
+    value = get_operand()
+    if pop_byte() > value:
+        push_byte(true)
+    else:
+        push_byte(false)
+
 def add():
 
     size = get_operand()
@@ -377,7 +409,16 @@ def bitwise_eor_byte_constant():
 
 def left_shift():
 
+    _left_shift(get_operand())
+
+def left_shift_constant():
+
     size = get_operand()
+    push_byte(get_operand())
+    _left_shift(size)
+
+def _left_shift(size):
+
     ptr2 = stack_pointer - shift_size
     ptr1 = ptr2 - size
     
@@ -396,7 +437,16 @@ def left_shift():
 
 def right_shift():
 
+    _right_shift(get_operand())
+
+def right_shift_constant():
+
     size = get_operand()
+    push_byte(get_operand())
+    _right_shift(size)
+
+def _right_shift(size):
+
     ptr2 = stack_pointer - shift_size
     ptr1 = ptr2 - size
     
@@ -472,6 +522,151 @@ def jump_if_false():
     if pop_byte() == false:
         program_counter = address
 
+# Comparisons fused with the conditional jumps that test their results, reading
+# their operands from the code in the same order as the separate instructions.
+# Comparisons with constants leave the value compared above the top of the
+# stack, as the 6502 routines do, so that it can be reloaded.
+
+def jump_if_not_equals():
+
+    compare_equals()
+    jump_if_false()
+
+def jump_if_not_equals_byte():
+
+    compare_equals_byte()
+    jump_if_false()
+
+def jump_if_not_equals_byte_constant():
+
+    global program_counter
+    value = get_operand()
+    
+    if pop_byte() == value:
+        program_counter += address_size
+    else:
+        jump()
+
+def jump_if_equals():
+
+    compare_not_equals()
+    jump_if_false()
+
+def jump_if_equals_byte():
+
+    compare_not_equals_byte()
+    jump_if_false()
+
+def jump_if_equals_byte_constant():
+
+    global program_counter
+    value = get_operand()
+    
+    if pop_byte() != value:
+        program_counter += address_size
+    else:
+        jump()
+
+def jump_if_not_less_than():
+
+    compare_less_than()
+    jump_if_false()
+
+def jump_if_not_less_than_byte():
+
+    compare_less_than_byte()
+    jump_if_false()
+
+def jump_if_not_less_than_byte_constant():
+
+    global program_counter
+    value = get_operand()
+    
+    if pop_byte() < value:
+        program_counter += address_size
+    else:
+        jump()
+
+def jump_if_not_greater_than():
+
+    compare_greater_than()
+    jump_if_false()
+
+def jump_if_not_greater_than_byte():
+
+    compare_greater_than_byte()
+    jump_if_false()
+
+def jump_if_not_greater_than_byte_constant():
+
+    global program_counter
+    value = get_operand()
+    
+    if pop_byte() > value:
+        program_counter += address_size
+    else:
+        jump()
+
+def jump_table():
+
+    global program_counter
+    low = get_operand()
+    count = get_operand()
+    
+    # The default address is followed by the addresses for each value from
+    # the lowest value upwards.
+    index = (pop_byte() - low) & 0xff
+    if index < count:
+        program_counter += (index + 1) * address_size
+    
+    jump()
+
+def loop_local():
+
+    global program_counter
+    offset = get_operand()
+    limit = get_operand()
+    size = get_operand()
+    
+    # Increment the counter and continue the loop if it is below the limit.
+    ptr1 = current_frame + offset
+    ptr2 = current_frame + limit
+    
+    c = 1
+    i = 0
+    while i < size:
+        v = memory[ptr1 + i] + c
+        memory[ptr1 + i] = v & 0xff
+        c = v >> 8
+        i += 1
+    
+    counter = 0
+    stop = 0
+    i = size
+    while i > 0:
+        i -= 1
+        counter = (counter << 8) | memory[ptr1 + i]
+        stop = (stop << 8) | memory[ptr2 + i]
+    
+    if counter < stop:
+        jump()
+    else:
+        program_counter += address_size
+
+def loop_local_byte():
+
+    global program_counter
+    offset = get_operand()
+    limit = get_operand()
+    
+    v = (memory[current_frame + offset] + 1) & 0xff
+    memory[current_frame + offset] = v
+    
+    if v < memory[current_frame + limit]:
+        jump()
+    else:
+        program_counter += address_size
+
 def load_local():
 
     global stack_pointer
@@ -547,6 +742,36 @@ def assign_global_byte():
     
     stack_pointer -= 1
 
+def assign_local_constant():
+
+    offset = get_operand()
+    size = get_operand()
+    
+    i = 0
+    while i < size:
+        memory[current_frame + offset + i] = get_operand()
+        i += 1
+
+def assign_local_byte_constant():
+
+    offset = get_operand()
+    memory[current_frame + offset] = get_operand()
+
+def assign_global_constant():
+
+    offset = get_operand()
+    size = get_operand()
+    
+    i = 0
+    while i < size:
+        memory[stack_base + offset + i] = get_operand()
+        i += 1
+
+def assign_global_byte_constant():
+
+    offset = get_operand()
+    memory[stack_base + offset] = get_operand()
+
 def function_return():
 
     global program_counter
@@ -829,9 +1054,52 @@ lookup = {
     opcodes.load_memory_byte_value: load_memory_byte_value,
     opcodes.store_memory_value: store_memory_value,
     opcodes.store_memory_byte_value: store_memory_byte_value,
+    opcodes.jump_if_not_equals: jump_if_not_equals,
+    opcodes.jump_if_not_equals_byte: jump_if_not_equals_byte,
+    opcodes.jump_if_not_equals_byte_constant: jump_if_not_equals_byte_constant,
+    opcodes.jump_if_equals: jump_if_equals,
+    opcodes.jump_if_equals_byte: jump_if_equals_byte,
+    opcodes.jump_if_equals_byte_constant: jump_if_equals_byte_constant,
+    opcodes.jump_if_not_less_than: jump_if_not_less_than,
+    opcodes.jump_if_not_less_than_byte: jump_if_not_less_than_byte,
+    opcodes.jump_if_not_less_than_byte_constant: jump_if_not_less_than_byte_constant,
+    opcodes.jump_if_not_greater_than: jump_if_not_greater_than,
+    opcodes.jump_if_not_greater_than_byte: jump_if_not_greater_than_byte,
+    opcodes.jump_if_not_greater_than_byte_constant: jump_if_not_greater_than_byte_constant,
+    opcodes.jump_table: jump_table,
+    opcodes.loop_local: loop_local,
+    opcodes.loop_local_byte: loop_local_byte,
+    opcodes.compare_equals_byte_constant: compare_equals_byte_constant,
+    opcodes.compare_not_equals_byte_constant: compare_not_equals_byte_constant,
+    opcodes.compare_less_than_byte_constant: compare_less_than_byte_constant,
+    opcodes.compare_greater_than_byte_constant: compare_greater_than_byte_constant,
+    opcodes.assign_local_constant: assign_local_constant,
+    opcodes.assign_local_byte_constant: assign_local_byte_constant,
+    opcodes.assign_global_constant: assign_global_constant,
+    opcodes.assign_global_byte_constant: assign_global_byte_constant,
+    opcodes.left_shift_constant: left_shift_constant,
+    opcodes.right_shift_constant: right_shift_constant,
     opcodes.end: end
     }
 
+def superinstruction(sequence):
+
+    # Return a handler that performs the instructions in the sequence of
+    # opcodes given in turn.
+    handlers = map(lambda opcode: lookup[opcode], sequence)
+    
+    def fused():
+        for handler in handlers:
+            handler()
+    
+    fused.__name__ = superinstructions.routine_name(sequence)
+    return fused
+
+def add_superinstructions(table):
+
+    for opcode, sequence in table.items():
+        lookup[opcode] = superinstruction(sequence)
+
 # Simulator initialisation
 
 def load(code, address):
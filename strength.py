@@ -0,0 +1,223 @@
+"""
+strength.py - Replacement of multiplications and divisions by constants.
+
+Copyright (C) 2014 David Boddie <david@boddie.org.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# The pass works on code in the form described in the ir module, in the same
+# way as the folding module, looking for operations that directly follow the
+# instructions that load their operands.
+#
+# Values are unsigned and arithmetic wraps around at the size of the values,
+# so multiplying and dividing by a power of two are the same as shifting left
+# and right by the number of bits given by the power. Multiplying a value that
+# can be loaded again by any other constant is the same as adding copies of
+# the value shifted by the positions of the bits set in the constant. Shifts
+# are only made by up to a byte at a time, since only those are handled in the
+# same way by the simulator and the 6502 routines.
+
+from opcodes import *
+
+# Approximate costs of opcodes in cycles of the 6502 routines, including the
+# dispatch of each instruction, given as a fixed cost and a cost for each byte
+# of the values they operate on. The costs per byte of shifts are for each
+# bit shifted, and those of multiplications and divisions are for each pair
+# of bytes.
+
+costs = {
+    load_byte: (40, 0),
+    load_number: (50, 20),
+    load_local: (70, 25),
+    load_local_byte: (70, 0),
+    load_global: (70, 25),
+    load_global_byte: (70, 0),
+    add: (80, 30),
+    add_byte: (60, 0),
+    left_shift: (110, 35),
+    right_shift: (110, 35),
+    multiply: (120, 400),
+    divide: (120, 800)
+    }
+
+def instruction_cost(instruction, previous = None):
+
+    # Return the cost of the instruction, which operates on the value loaded
+    # by the previous instruction if it is a shift.
+    opcode = instruction[0]
+    fixed, per_byte = costs[opcode]
+    
+    if opcode in (load_byte, load_local_byte, load_global_byte, add_byte):
+        return fixed
+    elif opcode == load_local or opcode == load_global:
+        return fixed + per_byte * instruction[2]
+    elif opcode in (left_shift, right_shift):
+        return fixed + per_byte * instruction[1] * previous[1]
+    elif opcode in (multiply, divide):
+        return fixed + per_byte * instruction[1] * instruction[1]
+    else:
+        return fixed + per_byte * instruction[1]
+
+def code_cost(code):
+
+    """Returns the approximate cost of performing the code given, which can
+    only contain instructions in the table of costs."""
+    
+    total = 0
+    previous = None
+    for instruction in code:
+        total += instruction_cost(instruction, previous)
+        previous = instruction
+    
+    return total
+
+value_loads = (load_local, load_local_byte, load_global, load_global_byte)
+
+def constant_value(instruction, size):
+
+    # Return the value loaded by the instruction if it loads a constant of the
+    # size given, or None if it does not.
+    if instruction[0] == load_byte and size == 1:
+        return instruction[1]
+    elif instruction[0] == load_number and instruction[1] == size:
+        value = 0
+        for byte in reversed(instruction[2:]):
+            value = (value << 8) | byte
+        return value
+    else:
+        return None
+
+def power_of_two(value):
+
+    # Return the power of two equal to the value or None if it is not one.
+    shift = 0
+    while value > 1 and value & 1 == 0:
+        value = value >> 1
+        shift += 1
+    
+    if value == 1:
+        return shift
+    else:
+        return None
+
+def shifts(opcode, shift, size):
+
+    # Return instructions that shift the value on the stack by the number of
+    # bits given, a byte at a time.
+    instructions = []
+    while shift > 0:
+        amount = min(shift, 8)
+        instructions += [[load_byte, amount], [opcode, size]]
+        shift -= amount
+    
+    return instructions
+
+def shift_and_add(load, value, size):
+
+    # Return instructions that multiply the value loaded by the instruction
+    # given by the constant value, adding copies of the loaded value shifted
+    # by the positions of the bits set in the constant.
+    if size > 1:
+        addition = [add, size]
+    else:
+        addition = [add_byte]
+    
+    instructions = []
+    bit = size * 8 - 1
+    while bit >= 0:
+        if value & (1 << bit):
+            term = [load] + shifts(left_shift, bit, size)
+            if instructions:
+                instructions += term + [addition]
+            else:
+                instructions = term
+        bit -= 1
+    
+    return instructions
+
+def replacement(code):
+
+    # Return the number of instructions at the end of the code to replace and
+    # the instructions to replace them with, or None if the operation at the
+    # end cannot be replaced.
+    if len(code) < 2 or code[-1][0] not in (multiply, divide):
+        return None
+    
+    opcode, size = code[-1]
+    
+    # Find the constant operand and the instruction that loads the other
+    # operand. A constant first operand of a multiplication is used as the
+    # second if the other operand is loaded by a single instruction.
+    value = constant_value(code[-2], size)
+    if value is not None:
+        length = 2
+        if len(code) >= 3:
+            load = code[-3]
+        else:
+            load = None
+    elif opcode == multiply and len(code) >= 3 and code[-2][0] in value_loads:
+        value = constant_value(code[-3], size)
+        length = 3
+        load = code[-2]
+    
+    if value is None or value == 0:
+        return None
+    
+    shift = power_of_two(value)
+    
+    if shift is not None:
+        if opcode == multiply:
+            new_code = shifts(left_shift, shift, size)
+        else:
+            new_code = shifts(right_shift, shift, size)
+        if length == 3:
+            new_code.insert(0, load)
+        return length, new_code
+    
+    elif opcode == multiply and load is not None and load[0] in value_loads:
+        return 3, shift_and_add(load, value, size)
+    
+    else:
+        return None
+
+def reduce_strength(code):
+
+    """Replaces multiplications and divisions by constants in the code given
+    with shifts and additions where these are cheaper. Returns the number of
+    operations replaced and the estimated number of cycles saved."""
+    
+    reduced = []
+    replaced = 0
+    saved = 0
+    
+    for instruction in code:
+    
+        reduced.append(instruction)
+        
+        found = replacement(reduced)
+        if found is None:
+            continue
+        
+        length, new_code = found
+        old_cost = code_cost(reduced[-length:])
+        new_cost = code_cost(new_code)
+        
+        if new_cost < old_cost:
+            reduced[-length:] = new_code
+            replaced += 1
+            saved += old_cost - new_cost
+    
+    code[:] = reduced
+    return replaced, saved
@@ -0,0 +1,144 @@
+"""
+superinstructions.py - Fusion of frequent opcode sequences into single opcodes.
+
+Copyright (C) 2014 David Boddie <david@boddie.org.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# A superinstruction performs the instructions in a sequence of adjacent
+# instructions with a single dispatch. It is encoded as a new opcode followed
+# by the operands of each instruction in the sequence in turn, so each part of
+# the superinstruction reads its operands from the code as it would if the
+# instructions were separate.
+#
+# Sequences are found in code in the form described in the ir module. Since
+# labels are instructions in their own right, sequences never span branch
+# targets. Instructions that transfer control can only end a sequence.
+
+import opcodes
+from opcodes import *
+
+# Opcodes are numbered after the last opcode in the instruction set.
+first_opcode = end + 1
+
+opcode_names = {}
+for name, value in vars(opcodes).items():
+    if isinstance(value, int) and load_number <= value <= end:
+        opcode_names[value] = name
+
+control_opcodes = (
+    branch_forward_if_false, branch_forward, branch_backward_if_false,
+    branch_backward, jump_if_false, jump, function_return, function_call,
+    jump_if_not_equals, jump_if_not_equals_byte,
+    jump_if_not_equals_byte_constant, jump_if_equals, jump_if_equals_byte,
+    jump_if_equals_byte_constant, jump_if_not_less_than,
+    jump_if_not_less_than_byte, jump_if_not_less_than_byte_constant,
+    jump_if_not_greater_than, jump_if_not_greater_than_byte,
+    jump_if_not_greater_than_byte_constant, jump_table, loop_local,
+    loop_local_byte
+    )
+
+def routine_name(sequence):
+
+    return "__".join(map(lambda opcode: opcode_names[opcode], sequence))
+
+def count_sequences(code, counts, fusible = None, max_length = 3):
+
+    """Adds the number of times each sequence of opcodes that can be fused
+    occurs in the code to the dictionary of counts given. If a collection of
+    fusible opcodes is given, only sequences of those opcodes are counted."""
+    
+    i = 0
+    while i < len(code):
+    
+        sequence = ()
+        j = i
+        while j < len(code) and len(sequence) < max_length:
+        
+            opcode = code[j][0]
+            if isinstance(opcode, str) or opcode == end:
+                break
+            elif fusible is not None and opcode not in fusible:
+                break
+            
+            sequence += (opcode,)
+            if len(sequence) > 1:
+                counts[sequence] = counts.get(sequence, 0) + 1
+            
+            if opcode in control_opcodes:
+                break
+            
+            j += 1
+        
+        i += 1
+
+def choose_sequences(counts, number):
+
+    """Returns up to the number of sequences given from the dictionary of
+    counts, choosing those that save the most dispatches. Sequences that only
+    occur once are not chosen."""
+    
+    scores = []
+    for sequence, count in counts.items():
+        if count > 1:
+            scores.append((count * (len(sequence) - 1), sequence))
+    
+    scores.sort(reverse = True)
+    return map(lambda (score, sequence): sequence, scores[:number])
+
+def fuse(code, sequences):
+
+    """Replaces the sequences given in the code with superinstructions,
+    returning a dictionary mapping the opcode of each superinstruction used to
+    its sequence of opcodes and a dictionary mapping each of these opcodes to
+    the number of times it was used."""
+    
+    # Assign opcodes to the sequences and try the longest sequences first,
+    # keeping the order given for sequences of the same length.
+    numbered = []
+    i = 0
+    for sequence in sequences:
+        numbered.append((len(sequence), first_opcode + i, sequence))
+        i += 1
+    
+    numbered.sort(key = lambda (length, opcode, sequence): (-length, opcode))
+    
+    table = {}
+    uses = {}
+    new_code = []
+    
+    i = 0
+    while i < len(code):
+    
+        for length, opcode, sequence in numbered:
+            found = code[i:i + length]
+            if tuple(map(lambda instruction: instruction[0], found)) == sequence:
+                break
+        else:
+            new_code.append(code[i])
+            i += 1
+            continue
+        
+        instruction = [opcode]
+        for part in found:
+            instruction += part[1:]
+        
+        new_code.append(instruction)
+        table[opcode] = sequence
+        uses[opcode] = uses.get(opcode, 0) + 1
+        i += length
+    
+    code[:] = new_code
+    return table, uses
@@ -0,0 +1,177 @@
+"""
+tailcalls.py - Replacement of self-recursive tail calls with jumps.
+
+Copyright (C) 2014 David Boddie <david@boddie.org.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# The pass works on code in the form described in the ir module. The code for
+# a function starts with its label and the instructions that make its frame,
+# and ends with a label that its returns jump to, followed by the instructions
+# that remove the frame and return:
+#
+#   label <function>
+#   store_stack_top_in_current_frame <parameter size>
+#   allocate_stack_space <variable size>
+#   ...
+#   label <exit>
+#   free_stack_space <size>
+#   pop_current_frame_address
+#   copy_value <size> <return size>     (only if a value is returned)
+#   function_return
+#
+# A call to the function from its own code that is followed by a jump to the
+# exit label, or by the exit label itself, is a tail call. When it is made,
+# the stack holds nothing above the function's frame, so the arguments for
+# the call can be assigned to the parameters in the frame and the body of
+# the function started again with the same frame.
+
+import callgraph, ir
+from opcodes import *
+
+def exit_label(code, start, end):
+
+    # Return the exit label for the function with code between the start and
+    # end given, or None if the code does not have the expected form.
+    if code[start + 1][0] != store_stack_top_in_current_frame or \
+       code[start + 2][0] != allocate_stack_space:
+        return None
+    
+    i = end - 1
+    while i > start + 2 and code[i][0] != pop_current_frame_address:
+        i -= 1
+    
+    if code[i - 1][0] == free_stack_space and code[i - 2][0] == "label":
+        return code[i - 2][1]
+    else:
+        return None
+
+def is_tail_call(code, i, end, label):
+
+    # Return whether the instruction at the index given is followed by the
+    # exit label or a jump to it.
+    i += 1
+    while i < end and code[i][0] == "label":
+        if code[i][1] is label:
+            return True
+        i += 1
+    
+    return i < end and code[i] == [jump, label]
+
+def call_start(code, i):
+
+    # Return the index of the instruction that pushes the caller's frame
+    # address for the call at the index given. Calls made when evaluating the
+    # arguments are skipped over.
+    depth = 0
+    i -= 1
+    while i >= 0:
+        if code[i][0] == function_call:
+            depth += 1
+        elif code[i][0] == load_current_frame_address:
+            if depth == 0:
+                return i
+            depth -= 1
+        i -= 1
+    
+    return None
+
+def assign_parameters(parameters):
+
+    # Return the instructions that assign the arguments on the stack to the
+    # parameters, starting with the last argument.
+    instructions = []
+    offset = 0
+    for name, size, element_size, array in parameters:
+        if size > 1:
+            instructions.insert(0, [assign_local, offset, size])
+        else:
+            instructions.insert(0, [assign_local_byte, offset])
+        offset += size
+    
+    return instructions
+
+def eliminate_tail_calls(code, functions, start_label, function_label):
+
+    """Replaces the tail calls that functions make to themselves with
+    assignments to their parameters and jumps to the start of their bodies.
+    Returns a list of the names of the functions changed, each with the
+    number of calls replaced. The main program starts at the start label
+    given."""
+    
+    entries = {}
+    for function in functions:
+        entries[function[3]] = function
+    
+    extents = callgraph.function_extents(code,
+                                         set(entries.keys()) | set([start_label]))
+    del extents[start_label]
+    
+    # Change the functions from the last to the first so that the extents of
+    # those still to be changed are not affected.
+    order = map(lambda (label, (start, end)): (start, end, label),
+                extents.items())
+    order.sort(reverse = True)
+    
+    changed = []
+    
+    for start, end, label in order:
+    
+        exit = exit_label(code, start, end)
+        if exit is None:
+            continue
+        
+        name, parameters = entries[label][:2]
+        body = ir.Label()
+        calls = 0
+        
+        i = end - 1
+        while i > start:
+        
+            instruction = code[i]
+            if instruction[0] != function_call or \
+               function_label(instruction[1]) is not label or \
+               not is_tail_call(code, i, end, exit):
+                i -= 1
+                continue
+            
+            first = call_start(code, i)
+            if first is None or first <= start:
+                i -= 1
+                continue
+            
+            # Arguments that refer to the frame cannot be used with a frame
+            # that is reused for the call.
+            arguments = code[first + 1:i]
+            if filter(lambda instruction: instruction[0] == get_variable_address,
+                      arguments):
+                i -= 1
+                continue
+            
+            replacement = arguments + assign_parameters(parameters) + \
+                          [[jump, body]]
+            if code[i + 1] == [jump, exit]:
+                i += 1
+            
+            code[first:i + 1] = replacement
+            end += len(replacement) - (i + 1 - first)
+            calls += 1
+            i = first - 1
+        
+        if calls:
+            code.insert(start + 3, ["label", body])
+            changed.insert(0, (name, calls))
+    
+    return changed
@@ -20,7 +20,8 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import os, sys
-import compiler, generator, opcodes, simulator
+import compiler, opcodes, simulator
+from arch._6502 import parsing
 
 expected_results = {
     "address-1.txt": [109, 121, 102, 105, 108, 101, 127, 14],
@@ -39,6 +40,7 @@ expected_results = {
     "assignment-7.txt": [2, 8],
     "assignment-8.txt": [74, 101, 108, 108, 111],
     "assignment-9.txt": [65, 66, 67, 68, 69, 70, 6],
+    "compare-branch-1.txt": [43, 28, 34, 21, 15, 10],
     "def-1.txt": [],
     "def-2.txt": [],
     "def-3.txt": [],
@@ -57,6 +59,7 @@ expected_results = {
     "def-16.txt": [],
     "def-17.txt": [],
     "def-18.txt": [5],
+    "elif-1.txt": [1, 2, 3, 4, 255, 1, 0],
     "eor-1.txt": [255, 31, 224, 32, 255],
     "expression-1.txt": [],
     "expression-2.txt": [],
@@ -68,6 +71,9 @@ expected_results = {
     "expression-8.txt": [255, 255, 1, 255],
     "expression-9.txt": [3],
     "expression-10.txt": [],
+    "fold-1.txt": [55, 44, 18, 255, 255, 0, 0, 254],
+    "for-1.txt": [10, 0, 32, 10, 0, 14, 198, 3],
+    "hoist-1.txt": [32, 12, 18, 39],
     "if-1.txt": [],
     "if-2.txt": [],
     "if-3.txt": [],
@@ -75,13 +81,22 @@ expected_results = {
     "if-5.txt": [1],
     "if-6.txt": [2],
     "if-8.txt": [1],
+    "immediate-1.txt": [10, 4, 9, 68, 1, 91, 7],
+    "immediate-2.txt": [116, 66],
+    "inline-1.txt": [5, 6, 3],
+    "inline-2.txt": [114, 8],
     "minus-1.txt": [123, 133],
     "minus-2.txt": [158],
     "minus-3.txt": [1, 252],
+    "narrow-1.txt": [1, 0, 2, 1, 0, 255],
     "not-1.txt": [255, 31, 210, 4, 0, 224, 45, 251],
     "not-2.txt": [121, 1, 0, 0],
     "or-1.txt": [255, 31, 255, 63, 255],
+    "peephole-1.txt": [59, 0],
+    "reuse-1.txt": [14, 16, 133, 12, 2],
+    "reuse-2.txt": [89],
     "shift-1.txt": [61, 0, 1, 152, 0, 34],
+    "shortcircuit-1.txt": [13, 10, 0, 255, 0],
     "string-1.txt": [72, 101, 108, 108, 111],
     "string-2.txt": [72, 101, 108, 108, 111, 0, 119, 111, 114, 108, 100],
     "string-3.txt": [],
@@ -93,8 +108,11 @@ expected_results = {
     "string-9.txt": [83, 116, 114, 105, 110, 103, 6],
     "string-10.txt": [83, 116, 114, 105, 110, 103, 6],
     "string-11.txt": [72, 101, 108, 108, 111, 72, 101, 108, 108, 111],
+    "strength-1.txt": [40, 24, 41, 21, 0, 6],
     "subtract-1.txt": [10, 12, 254],
     "subtract-2.txt": [2, 0, 3, 0, 255, 255],
+    "switch-1.txt": [10, 11, 99, 13, 14, 99, 1, 3, 4, 0],
+    "tailcall-1.txt": [5, 12],
     "while-2.txt": [0],
     "while-3.txt": [1, 88],
     "while-4.txt": [1, 14]
@@ -129,6 +147,38 @@ compile_only = [
 
 if __name__ == "__main__":
 
+    # Examples are compiled with tail calls replaced if -T is given, with
+    # small functions inlined if -i is given, without unused functions if -e
+    # is given, with constant folding if -f is given, with strength reduction
+    # if -R is given, with comparisons narrowed if -N is given, with
+    # loop-invariant expressions hoisted if -L is given, with values reused if
+    # -V is given, with peephole optimisations if -O is given and with
+    # superinstructions if -s is given.
+    tail_calls = "-T" in sys.argv[1:]
+    
+    if "-i" in sys.argv[1:]:
+        inline = 8
+    else:
+        inline = 0
+    
+    eliminate = "-e" in sys.argv[1:]
+    fold = "-f" in sys.argv[1:]
+    strength = "-R" in sys.argv[1:]
+    narrow = "-N" in sys.argv[1:]
+    hoist = "-L" in sys.argv[1:]
+    reuse = "-V" in sys.argv[1:]
+    optimise = "-O" in sys.argv[1:]
+    if "-s" in sys.argv[1:]:
+        fuse = 8
+    else:
+        fuse = 0
+    
+    c = compiler.Compiler(os.path.join("include", "6502"), parsing, fold = fold,
+                          optimise = optimise, superinstructions = fuse,
+                          eliminate = eliminate, inline = inline,
+                          tail_calls = tail_calls, strength = strength,
+                          narrow = narrow, hoist = hoist, reuse = reuse)
+    
     i = 2
     examples = os.listdir("Examples")
     examples.sort()
@@ -145,13 +195,10 @@ if __name__ == "__main__":
         
         print name,
         
-        compiler.tokeniser.reset()
-        reload(compiler)
-        reload(generator)
         load_address = 0x0e02 + (opcodes.end - 256 + 1) * 2
         
         try:
-            start_address = compiler.parse_program(stream, load_address)
+            program = c.compile(stream, load_address)
         except SyntaxError as exception:
             if name.endswith("fail.txt"):
                 print "failed as expected"
@@ -167,10 +214,11 @@ if __name__ == "__main__":
             continue
         
         reload(simulator)
+        simulator.add_superinstructions(program.superinstructions)
         
-        simulator.load(generator.code, load_address)
+        simulator.load(program.code, load_address)
         
-        result = simulator.run(start_address, step = False, verbose = False)
+        result = simulator.run(program.start_address, step = False, verbose = False)
         try:
             expected = expected_results[name]
         except KeyError:
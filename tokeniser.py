@@ -19,14 +19,7 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-line = 1
-newline = False
-indent = 0
-indent_stack = [0]
-pending_token = ""
-in_comment = False
-in_string = False
-at_eof = False
+import re
 
 indent_token = "\ti"
 dedent_token = "\td"
@@ -43,161 +36,279 @@ comment_token = "#"
 index_begin_token = "["
 index_end_token = "]"
 
-def reset():
+# Patterns used by the buffered tokeniser to consume runs of characters that
+# the character-based tokeniser would handle one at a time in the same way.
+ordinary_chars = re.compile(r'[^ \t\n()\[\]\-~,#"]+')
+blank_chars = re.compile(r'[ \t]+')
 
-    global at_eof, in_comment, in_string, indent, indent_stack, line, newline
-    global pending_token
-    
-    line = 1
-    newline = False
-    indent = 0
-    indent_stack = [0]
-    pending_token = ""
-    in_comment = False
-    in_string = False
-    at_eof = False
-
-def read_token(stream):
+class Tokeniser:
 
-    global at_eof, indent, indent_stack, line, in_comment, in_string, newline
-    global pending_token
+    """Reads tokens from a stream, keeping track of the position in the stream
+    and the indentation of the lines read. Each file is read by its own
+    tokeniser.
     
-    # If we have encountered tokens and the indentation level is less than
-    # previously then emit a dedent token.
-    if not newline and indent < indent_stack[-1]:
-        indent_stack.pop()
-        return dedent_token
+    If buffered is True, the contents of the stream are read into memory and
+    tokens are scanned using index arithmetic instead of single character
+    reads."""
     
-    # If there is (the start of) a pending token then use this as the basis for
-    # the next token.
-    if pending_token:
-        token = pending_token
-        pending_token = ""
-    else:
-        token = ""
+    def __init__(self, stream, buffered = False):
     
-    # If the token is a newline or parenthesis then emit this immediately.
-    if token in (newline_token, arguments_begin_token, arguments_end_token,
-                 index_begin_token, index_end_token):
-        return token
+        self.line = 1
+        self.newline = False
+        self.indent = 0
+        self.indent_stack = [0]
+        self.pending_token = ""
+        self.in_comment = False
+        self.in_string = False
+        self.at_eof = False
+        
+        self.buffered = buffered
+        if buffered:
+            self.text = stream.read()
+            self.pos = 0
+        else:
+            self.stream = stream
     
-    while True:
+    def read_token(self):
     
-        ch = stream.read(1)
+        if self.buffered:
+            return self.read_buffered_token()
         
-        if not ch:
-            # At the end of a file, set a flag and start emitting dedent tokens
-            # unless the indentation is already zero.
-            if indent < indent_stack[-1]:
-                indent_stack.pop()
-                pending_token = dedent_token
-            else:
-                pending_token = eof_token
+        # If we have encountered tokens and the indentation level is less
+        # than previously then emit a dedent token.
+        if not self.newline and self.indent < self.indent_stack[-1]:
+            self.indent_stack.pop()
+            return dedent_token
+        
+        # If there is (the start of) a pending token then use this as the
+        # basis for the next token.
+        if self.pending_token:
+            token = self.pending_token
+            self.pending_token = ""
+        else:
+            token = ""
+        
+        # If the token is a newline or parenthesis then emit this immediately.
+        if token in (newline_token, arguments_begin_token, arguments_end_token,
+                     index_begin_token, index_end_token):
+            return token
+        
+        while True:
+        
+            ch = self.stream.read(1)
+            
+            if not ch:
+                # At the end of a file, set a flag and start emitting dedent
+                # tokens unless the indentation is already zero.
+                if self.indent < self.indent_stack[-1]:
+                    self.indent_stack.pop()
+                    self.pending_token = dedent_token
+                else:
+                    self.pending_token = eof_token
+                
+                if not token:
+                    token = self.pending_token
+                    self.pending_token = ""
+                
+                if token == eof_token:
+                    self.at_eof = True
+                
+                break
             
-            if not token:
-                token = pending_token
-                pending_token = ""
+            elif ch == "\t" or ch == " ":
+                # Substitute four spaces for each tab.
+                if ch == "\t":
+                    ch = "    "
+                
+                # Spaces separate tokens unless in a string. Emit the current
+                # token if already started; otherwise continue reading.
+                if self.newline:
+                    self.indent += len(ch)
+                elif self.in_string or self.in_comment:
+                    token += ch
+                elif token:
+                    break
             
-            if token == eof_token:
-                at_eof = True
+            elif ch == "\n":
+                # Newlines reset the indentation level and end comments and
+                # strings. Emit any current token and queue a newline token, or
+                # just emit the newline token if there is no current token.
+                self.end_statement()
+                self.line += 1
+                
+                if token:
+                    self.pending_token = newline_token
+                    break
+                else:
+                    return newline_token
             
-            break
-        
-        elif ch == "\t" or ch == " ":
-            # Substitute four spaces for each tab.
-            if ch == "\t":
-                ch = "    "
+            elif ch == "(" or ch == ")" or ch == "[" or ch == "]":
+                # Opening and closing parentheses are emitted as separate tokens.
+                if token:
+                    self.pending_token = ch
+                    break
+                else:
+                    return ch
             
-            # Spaces separate tokens unless in a string. Emit the current token
-            # if already started; otherwise continue reading.
-            if newline:
-                indent += len(ch)
-            elif in_string or in_comment:
-                token += ch
-            elif token:
-                break
-        
-        elif ch == "\n":
-            # Newlines reset the indentation level and end comments and
-            # strings. Emit any current token and queue a newline token, or
-            # just emit the newline token if there is no current token.
-            end_statement()
-            line += 1
+            elif ch in (minus_token, system_call_token, logical_not_token,
+                        bitwise_not_token, ","):
+                # Unary operators are emitted as separate tokens.
+                if token:
+                    self.pending_token = ch
+                    break
+                else:
+                    return ch
             
-            if token:
-                pending_token = newline_token
-                break
             else:
-                return newline_token
+                # Any non-whitespace characters are treated separately.
+                
+                # Test for comments and the beginnings and ends of strings.
+                if ch == comment_token:
+                    self.in_comment = True
+                elif ch == '"':
+                    self.in_string = not self.in_string
+                
+                if self.newline:
+                    # For the first token on a new line, ensure that the
+                    # appropriate indent and dedent tokens are emitted and
+                    # queue the latest character read as the beginning of a
+                    # new token.
+                    self.newline = False
+                    
+                    if self.indent > self.indent_stack[-1]:
+                        # Emit an indent token and keep the character for later.
+                        self.pending_token = ch
+                        self.indent_stack.append(self.indent)
+                        return indent_token
+                    elif self.indent < self.indent_stack[-1]:
+                        # Emit an dedent token and keep the character for later.
+                        self.pending_token = ch
+                        self.indent_stack.pop()
+                        return dedent_token
+                
+                # Extend the current token with the new character.
+                token += ch
         
-        elif ch == "(" or ch == ")" or ch == "[" or ch == "]":
-            # Opening and closing parentheses are emitted as separate tokens.
-            if token:
-                pending_token = ch
-                break
-            else:
-                return ch
+        return token
+    
+    def read_buffered_token(self):
+    
+        # This method produces the same tokens as read_token but scans an
+        # in-memory buffer, consuming runs of ordinary characters and
+        # whitespace in one step where the result would be the same.
         
-        elif ch in (minus_token, system_call_token, logical_not_token, bitwise_not_token, ","):
-            # Unary operators are emitted as separate tokens.
-            if token:
-                pending_token = ch
-                break
-            else:
-                return ch
+        if not self.newline and self.indent < self.indent_stack[-1]:
+            self.indent_stack.pop()
+            return dedent_token
         
+        if self.pending_token:
+            token = self.pending_token
+            self.pending_token = ""
         else:
-            # Any non-whitespace characters are treated separately.
+            token = ""
+        
+        if token in (newline_token, arguments_begin_token, arguments_end_token,
+                     index_begin_token, index_end_token):
+            return token
+        
+        text = self.text
+        pos = self.pos
+        length = len(text)
+        
+        while True:
+        
+            if pos == length:
+                if self.indent < self.indent_stack[-1]:
+                    self.indent_stack.pop()
+                    self.pending_token = dedent_token
+                else:
+                    self.pending_token = eof_token
+                
+                if not token:
+                    token = self.pending_token
+                    self.pending_token = ""
+                
+                if token == eof_token:
+                    self.at_eof = True
+                
+                break
             
-            # Test for comments and the beginnings and ends of strings.
-            if ch == comment_token:
-                in_comment = True
-            elif ch == '"':
-                in_string = not in_string
+            ch = text[pos]
             
-            if newline:
-                # For the first token on a new line, ensure that the
-                # appropriate indent and dedent tokens are emitted and queue
-                # the latest character read as the beginning of a new token.
-                newline = False
-                
-                if indent > indent_stack[-1]:
-                    # Emit an indent token and keep the character for later.
-                    pending_token = ch
-                    indent_stack.append(indent)
-                    return indent_token
-                elif indent < indent_stack[-1]:
-                    # Emit an dedent token and keep the character for later.
-                    pending_token = ch
-                    indent_stack.pop()
-                    return dedent_token
+            if ch == "\t" or ch == " ":
+                # Read all the following spaces and tabs, substituting four
+                # spaces for each tab.
+                match = blank_chars.match(text, pos)
+                pos = match.end()
+                spaces = match.group().replace("\t", "    ")
+                
+                if self.newline:
+                    self.indent += len(spaces)
+                elif self.in_string or self.in_comment:
+                    token += spaces
+                elif token:
+                    break
             
-            # Extend the current token with the new character.
-            token += ch
-    
-    return token
-
-def end_statement():
-
-    global indent, in_comment, in_string, newline
+            elif ch == "\n":
+                pos += 1
+                self.end_statement()
+                self.line += 1
+                
+                if token:
+                    self.pending_token = newline_token
+                    break
+                else:
+                    self.pos = pos
+                    return newline_token
+            
+            elif ch in "()[]-~,":
+                pos += 1
+                if token:
+                    self.pending_token = ch
+                    break
+                else:
+                    self.pos = pos
+                    return ch
+            
+            else:
+                pos += 1
+                
+                if ch == comment_token:
+                    self.in_comment = True
+                elif ch == '"':
+                    self.in_string = not self.in_string
+                
+                if self.newline:
+                    self.newline = False
+                    
+                    if self.indent > self.indent_stack[-1]:
+                        self.pending_token = ch
+                        self.indent_stack.append(self.indent)
+                        self.pos = pos
+                        return indent_token
+                    elif self.indent < self.indent_stack[-1]:
+                        self.pending_token = ch
+                        self.indent_stack.pop()
+                        self.pos = pos
+                        return dedent_token
+                
+                # Extend the current token with the new character and any
+                # ordinary characters that follow it.
+                token += ch
+                match = ordinary_chars.match(text, pos)
+                if match:
+                    token += match.group()
+                    pos = match.end()
+        
+        self.pos = pos
+        return token
     
-    indent = 0
-    newline = True
-    in_comment = False
-    in_string = False
-
-def save_state():
-
-    return (line, newline, indent, indent_stack, pending_token,
-            in_comment, in_string, at_eof)
-
-def restore_state(state):
-
-    global at_eof, in_comment, in_string, indent, indent_stack, line, newline
-    global pending_token
+    def end_statement(self):
     
-    (line, newline, indent, indent_stack, pending_token,
-     in_comment, in_string, at_eof) = state
+        self.indent = 0
+        self.newline = True
+        self.in_comment = False
+        self.in_string = False
 
 
 if __name__ == "__main__":
@@ -208,7 +319,7 @@ if __name__ == "__main__":
         sys.stderr.write("Usage: %s <file>\n" % sys.argv[0])
         sys.exit(1)
     
-    stream = open(sys.argv[1])
+    t = Tokeniser(open(sys.argv[1]))
     
-    while not at_eof:
-        print repr(read_token(stream))
+    while not t.at_eof:
+        print repr(t.read_token())